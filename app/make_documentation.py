@@ -1,16 +1,12 @@
 #!/usr/bin/env python
 # encoding: utf-8
 from __future__ import unicode_literals
-import queries
-from queries import PREFIX_LIBRARY
+from queries import PREFIX_LIBRARY, registry
+from queries.registry import METADATA_QUERY_ARGS
 
 class DocsCreator(object):
     """ Creates documentation for a particular Newsreader SPARQL endpoint. """
     def __init__(self, root_url, user_api_key, endpoint_path):
-        self.query_ignore_list = ['__all__', '__builtins__', '__doc__',
-                                  '__file__', '__name__', '__package__',
-                                  '__path__', 'queries', 'SparqlQuery',
-                                  'QueryException', 'PREFIX_LIBRARY']
         self.root_url = root_url
         self.endpoint_path = endpoint_path
         self.user_api_key = user_api_key if user_api_key else '<YOUR_API_KEY>'
@@ -25,6 +21,12 @@ class DocsCreator(object):
                                          "",
                                          "Vist this page with a URL of the form: " + self.root_url + self.endpoint_path + "?api_key=<YOUR_API_KEY>",
                                          "to put the API key into the example URLs",
+                                         "",
+                                         "Every result of a query can be downloaded in one response, as NDJSON or CSV, from:",
+                                         self.root_url + self.endpoint_path + "/query_name/export?format={ndjson|csv}&param1=[string]&api_key=<YOUR_API_KEY>",
+                                         "",
+                                         "Several queries can be run at once by POSTing a JSON list of objects such as {\"id\": \"a\", \"query\": \"query_name\", \"page\": 1, \"param1\": \"[string]\"} to:",
+                                         self.root_url + self.endpoint_path + "/batch?api_key=<YOUR_API_KEY>",
                                          "",                                         
                                          "An API key can be obtained by contacting dataservices@scraperwiki.com",
                                          ""],
@@ -34,22 +36,17 @@ class DocsCreator(object):
                                         "uris.[n] = a URI to a thing, e.g. dbpedia:David_Beckham",
                                         "datefilter = YYYY, YYYY-MM or YYYY-MM-DD, filter to a year, month or day",
                                         "api_key = a UUID api key, e.g. 1c867db8-a364-4f1e-a33c-e5e55775a76e",
+                                        "cursor = the 'next cursor' of a JSON result, to fetch the page after it; quick however deep the page",
+                                        "timeout = seconds to spend on a query, up to 300; a count not ready in time is null, and results cut short are marked partial",
+                                        "explain = 1 to get, in place of the results, the SPARQL of the query and its count, where each came from and how long each stage took, as JSON",
                                         "REMOVED offset = an offset into the returned results",
                                         "REMOVED limit = a number of results to return"],
                          "prefixes": prefixes,
                          "queries": []}
 
-        query_long_list = dir(queries)
-
-        for query in query_long_list:
-            if query in self.query_ignore_list:
-                continue
-            query_name = getattr(queries, query)
-
-            query_object = query_name(offset=0, limit=100,
-                                      uris=["{uri_0}", "{uri_1}"],
-                                      filter='{string}',
-                                      datefilter='{datefilter}', output='html')
+        for query in sorted(registry.names()):
+            metadata = registry.metadata(query)
+            query_object = registry.get_class(query)(**METADATA_QUERY_ARGS)
             example_query_fragment = self._get_example_from_query(query_object)
             if "=" in example_query_fragment:
                 example_query = ''.join([self.root_url, self.endpoint_path, '/',
@@ -61,12 +58,12 @@ class DocsCreator(object):
                                     '?api_key=', self.user_api_key])
 
             function_list['queries'].append({
-                "title": query_object.query_title,
-                "description": query_object.description,
-                "url": query_object.url,
-                "required_parameters": query_object.required_parameters,
-                "optional_parameters": query_object.optional_parameters,
-                "output_columns": query_object.headers,
+                "title": metadata['query_title'],
+                "description": metadata['description'],
+                "url": metadata['url'],
+                "required_parameters": metadata['required_parameters'],
+                "optional_parameters": metadata['optional_parameters'],
+                "output_columns": metadata['headers'],
                 "example": example_query,
                 "sparql": query_object.query})
         return function_list
@@ -84,26 +81,22 @@ class DocsCreator(object):
         return prefixes
 
 class WorldCupDocsCreator(DocsCreator):
-    # TODO: Set self.query_ignore_list if it needs to be different.
     @staticmethod
     def _get_example_from_query(query_object):
         return query_object.world_cup_example
 
 
 class CarsDocsCreator(DocsCreator):
-    # TODO: Set self.query_ignore_list if it needs to be different.
     @staticmethod
     def _get_example_from_query(query_object):
         return query_object.cars_example
 
 class FTDocsCreator(DocsCreator):
-    # TODO: Set self.query_ignore_list if it needs to be different.
     @staticmethod
     def _get_example_from_query(query_object):
         return query_object.ft_example
 
 class WikiNewsDocsCreator(DocsCreator):
-    # TODO: Set self.query_ignore_list if it needs to be different.
     @staticmethod
     def _get_example_from_query(query_object):
         try:
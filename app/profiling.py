@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import cProfile
+import errno
+import os
+import pstats
+import resource
+import sys
+import tempfile
+import time
+
+# Functions listed in a profile report, by cumulative time.
+PROFILE_TOP = int(os.environ.get('NEWSREADER_PROFILE_TOP', 30))
+# Where the full profile of each profiled request is kept, for loading into
+# pstats or a call graph viewer; set to an empty string to keep none.
+PROFILE_DIR = os.environ.get('NEWSREADER_PROFILE_DIR',
+                             '/tmp/newsreader_profiles')
+
+# The CPU time of the calling thread alone; Python 2 does not name the
+# Linux constant.
+if sys.platform.startswith('linux'):
+    RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+else:
+    RUSAGE_THREAD = resource.RUSAGE_SELF
+
+
+def thread_cpu_time():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def describe_function(function):
+    """ Return e.g. 'app/views.py:12(run_query)' for a pstats key. """
+    return pstats.func_std_string(function)
+
+
+class RequestProfiler(object):
+    """ Runs the stages of a request under cProfile, keeping the wall clock
+    time they took apart from the CPU time of this thread, so that time
+    waiting, mostly on the endpoint, can be told from time computing.
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def call(self, function, *args, **kwargs):
+        """ Return function(*args, **kwargs), profiled. """
+        t0 = time.time()
+        cpu0 = thread_cpu_time()
+        try:
+            return self.profile.runcall(function, *args, **kwargs)
+        finally:
+            self.wall_seconds += time.time() - t0
+            self.cpu_seconds += thread_cpu_time() - cpu0
+
+    def top_functions(self, top=PROFILE_TOP):
+        """ Return the top functions by cumulative time, with the functions
+        which called each.
+        """
+        stats = pstats.Stats(self.profile).stats
+        ranked = sorted(stats.iteritems(), key=lambda item: item[1][3],
+                        reverse=True)[:top]
+        functions = []
+        for function, (_, calls, total, cumulative, callers) in ranked:
+            functions.append({
+                "function": describe_function(function),
+                "calls": calls,
+                "own_seconds": round(total, 6),
+                "cumulative_seconds": round(cumulative, 6),
+                "callers": [describe_function(caller) for caller in
+                            sorted(callers, key=lambda caller:
+                                   stats.get(caller, (0, 0, 0, 0))[3],
+                                   reverse=True)[:5]]})
+        return functions
+
+    def save(self, directory=PROFILE_DIR):
+        """ Write the full profile to directory; return its path, or None.
+        """
+        if not directory:
+            return None
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.prof',
+                                    prefix=time.strftime('%Y%m%d-%H%M%S-'))
+        os.close(fd)
+        self.profile.dump_stats(path)
+        return path
+
+    def report(self, top=PROFILE_TOP):
+        """ Return a dict of the times taken and the top functions. """
+        return {"wall_seconds": round(self.wall_seconds, 6),
+                "cpu_seconds": round(self.cpu_seconds, 6),
+                "wait_seconds": round(max(self.wall_seconds -
+                                          self.cpu_seconds, 0), 6),
+                "top_functions": self.top_functions(top)}
@@ -1,42 +1,12 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-# TODO: Is this needed?
-__all__ = ["properties_of_a_type"]
+# Query classes are imported on first use, through the registry; see
+# registry.py to add a query.
+__all__ = ["SparqlQuery", "QueryException", "PREFIX_LIBRARY", "registry",
+           "get_query_class"]
 
-import queries
-
-from .properties_of_a_type import properties_of_a_type
-from .types_of_actors import types_of_actors
 from .queries import SparqlQuery
 from .queries import QueryException
 from .queries import PREFIX_LIBRARY
-
-
-from .actors_of_a_type import actors_of_a_type
-from .property_of_actors_of_a_type import property_of_actors_of_a_type
-from .property_of_an_actor import property_of_an_actor
-
-from .event_details_filtered_by_actor import event_details_filtered_by_actor
-from .describe_uri import describe_uri
-
-from .people_sharing_event_with_a_person import (
-                                        people_sharing_event_with_a_person)
-
-from .summary_of_events_with_two_actors import summary_of_events_with_two_actors
-from .summary_of_events_with_actor import summary_of_events_with_actor
-from .summary_of_events_with_actor_type import summary_of_events_with_actor_type
-
-from .summary_of_events_with_event_label import summary_of_events_with_event_label
-from .event_label_frequency_count import event_label_frequency_count
-
-from .summary_of_events_with_framenet import summary_of_events_with_framenet
-from .summary_of_events_with_eso import summary_of_events_with_eso
-from .framenet_frequency_count import framenet_frequency_count
-from .eso_frequency_count import eso_frequency_count
-
-from .get_document_metadata import get_document_metadata
-from .get_mention_metadata import get_mention_metadata
-from .get_document import get_document
-from .situation_graph import situation_graph
-from .event_precis import event_precis
+from .registry import registry, get_query_class
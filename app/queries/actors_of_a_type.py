@@ -48,6 +48,18 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT a.uri AS actor, COUNT(DISTINCT ea.event) AS count,
+       a.comment AS comment
+FROM actor_types ty
+JOIN actors a ON a.id = ty.actor
+JOIN event_actors ea ON ea.actor = a.id AND ea.role = 'actor'
+WHERE ty.type = :uri_0 {label_filter_clause}
+GROUP BY a.id
+                                  """)
+        self.snapshot_order = 'count DESC, actor'
+        self.snapshot_count_column = 'actor'
+
         self.jinja_template = 'table.html'
         self.headers = ['actor', 'count', 'comment']
 
@@ -58,6 +70,18 @@ WHERE {{
         self._make_uri_filter_block()
         self.query = self._build_query()
 
+    def _snapshot_blocks(self):
+        """ Match the filter to the DBpedia labels of the actors, as the
+        SPARQL query does.
+        """
+        blocks, parameters = super(actors_of_a_type, self)._snapshot_blocks()
+        blocks['label_filter_clause'] = ''
+        if self.filter != 'none':
+            blocks['label_filter_clause'] = (
+                'AND EXISTS (SELECT 1 FROM actor_labels f '
+                'WHERE f.actor = a.id ' + blocks['filter_clause'] + ')')
+        return blocks, parameters
+
     def _make_uri_filter_block(self):
             if self.filter != 'none':
                 #self.filter_block = 'FILTER (contains(LCASE(str(?filterfield)), "{filter}")) .'.format(filter=self.filter)
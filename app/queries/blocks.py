@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import os
+import threading
+
+# Set to 0 to fetch only the page asked for.
+BLOCK_FETCH = os.environ.get('NEWSREADER_BLOCK_FETCH', '1') != '0'
+# Pages per block are a power of two, no more than this.
+MAX_BLOCK_PAGES = int(os.environ.get('NEWSREADER_MAX_BLOCK_PAGES', 16))
+INITIAL_BLOCK_PAGES = 8
+# A query class whose fetches average longer than this has its blocks
+# halved; one averaging under half of it has them doubled.
+BLOCK_TARGET_SECONDS = float(
+    os.environ.get('NEWSREADER_BLOCK_TARGET_SECONDS', 2.0))
+# Blocks are also halved until their rows take about this many bytes.
+BLOCK_MAX_BYTES = int(os.environ.get('NEWSREADER_BLOCK_MAX_BYTES',
+                                     1024 * 1024))
+# Weight of the latest fetch in the moving averages.
+EWMA_WEIGHT = 0.3
+
+
+class _ClassStats(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.seconds = None
+        self.row_bytes = None
+        self.fetches = 0
+
+
+def _ewma(average, value):
+    if average is None:
+        return value
+    return (1 - EWMA_WEIGHT) * average + EWMA_WEIGHT * value
+
+
+class BlockSizer(object):
+    """ Chooses how many pages each query class fetches from upstream at
+    once, from moving averages of its fetch latency and row size.
+    """
+    def __init__(self, max_pages=MAX_BLOCK_PAGES,
+                 target_seconds=BLOCK_TARGET_SECONDS,
+                 max_bytes=BLOCK_MAX_BYTES):
+        self.max_pages = max_pages
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def pages(self, name):
+        """ Return the pages per block to fetch for the query class name. """
+        stats = self._classes.get(name)
+        if stats is None:
+            return self._initial_pages()
+        return stats.pages
+
+    def _initial_pages(self):
+        pages = 1
+        while pages * 2 <= min(INITIAL_BLOCK_PAGES, self.max_pages):
+            pages *= 2
+        return pages
+
+    def block_sizes(self):
+        """ Return every pages per block which may be in use, largest first.
+        """
+        sizes = []
+        pages = 2
+        while pages <= self.max_pages:
+            sizes.insert(0, pages)
+            pages *= 2
+        return sizes
+
+    def record(self, name, page_rows, rows, seconds, response_bytes):
+        """ Note an upstream fetch of rows in seconds by query class name.
+        """
+        with self._lock:
+            stats = self._classes.get(name)
+            if stats is None:
+                stats = self._classes[name] = _ClassStats(
+                    self._initial_pages())
+            stats.fetches += 1
+            stats.seconds = _ewma(stats.seconds, seconds)
+            if rows:
+                stats.row_bytes = _ewma(stats.row_bytes,
+                                        response_bytes / float(rows))
+
+            if stats.seconds > self.target_seconds:
+                stats.pages = max(1, stats.pages // 2)
+            elif (stats.seconds < self.target_seconds / 2 and
+                  stats.pages * 2 <= self.max_pages):
+                stats.pages *= 2
+            if stats.row_bytes:
+                while (stats.pages > 1 and stats.pages * page_rows *
+                       stats.row_bytes > self.max_bytes):
+                    stats.pages //= 2
+
+    def stats(self):
+        return dict((name, {"pages": stats.pages, "seconds": stats.seconds,
+                            "row_bytes": stats.row_bytes,
+                            "fetches": stats.fetches})
+                    for name, stats in self._classes.items())
+
+
+block_sizer = BlockSizer()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a result count is trusted for; counts only change when the
+# KnowledgeStore is reloaded.
+COUNT_CACHE_TTL = int(os.environ.get('NEWSREADER_COUNT_CACHE_TTL', 172800))
+# Default seconds a query result is kept for; query classes may set their
+# own cache_ttl.
+RESULT_CACHE_TTL = int(os.environ.get('NEWSREADER_RESULT_CACHE_TTL', 172800))
+# Whole-dataset aggregates are slow to compute and change least.
+FREQUENCY_CACHE_TTL = int(
+    os.environ.get('NEWSREADER_FREQUENCY_CACHE_TTL', 7 * 86400))
+# Documents and metadata from the CRUD endpoint.
+DOCUMENT_CACHE_TTL = int(os.environ.get('NEWSREADER_DOCUMENT_CACHE_TTL', 86400))
+
+# The memory tier holds live objects, whose size is taken to be that of their
+# pickles; they take several times that in memory.
+MEMORY_CACHE_MAX_PICKLED_BYTES = int(
+    os.environ.get('NEWSREADER_MEMORY_CACHE_MAX_PICKLED_BYTES',
+                   64 * 1024 * 1024))
+DISK_CACHE_MAX_BYTES = int(
+    os.environ.get('NEWSREADER_DISK_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Set to an empty string to keep results in memory only.
+CACHE_DIR = os.environ.get('NEWSREADER_CACHE_DIR', '/tmp/newsreader_cache')
+
+
+class CacheTier(object):
+    """ Base class for a cache tier, keeping hit and miss statistics. """
+    persistent = False
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return (expires, value) stored under key, or None. """
+        raise NotImplementedError
+
+    def set(self, key, value, data, expires):
+        """ Store value, whose pickle is data, until expires. """
+        raise NotImplementedError
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "sets": self.sets,
+                "evictions": self.evictions, "max_bytes": self.max_bytes}
+
+
+class MemoryTier(CacheTier):
+    """ A thread-safe, size-bounded, in-process LRU cache tier.
+
+    Values are kept as they are, and max_bytes bounds the total length of
+    their pickles rather than the memory they take.
+    """
+    def __init__(self, max_bytes=MEMORY_CACHE_MAX_PICKLED_BYTES):
+        super(MemoryTier, self).__init__(max_bytes)
+        self.pickled_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.pickled_bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def set(self, key, value, data, expires):
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.pickled_bytes -= old[2]
+            self._entries[key] = (expires, value, size)
+            self.pickled_bytes += size
+            self.sets += 1
+            while self.pickled_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.pickled_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.pickled_bytes = 0
+
+    def stats(self):
+        stats = super(MemoryTier, self).stats()
+        stats.update({"entries": len(self._entries),
+                      "pickled_bytes": self.pickled_bytes})
+        return stats
+
+
+class DiskTier(CacheTier):
+    """ A size-bounded cache tier of one file per entry, shared by workers.
+
+    Entries are written to a temporary file which is renamed into place, so
+    concurrent writers from any number of processes need no locks: readers
+    see either the old or the new file. Once a process has written a tenth
+    of max_bytes it sweeps the directory, removing the least recently used
+    files until the total is under max_bytes.
+    """
+    persistent = True
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=DISK_CACHE_MAX_BYTES):
+        super(DiskTier, self).__init__(max_bytes)
+        self.directory = directory
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires = float(f.readline())
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError,
+                pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        if expires < time.time():
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return expires, value
+
+    def set(self, key, value, data, expires):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            fd, temporary_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(repr(expires) + b'\n')
+                f.write(data)
+            os.rename(temporary_path, path)
+        except (IOError, OSError):
+            return
+        self.sets += 1
+
+        with self._lock:
+            self._written += len(data)
+            sweep = self._written > self.max_bytes // 10
+            if sweep:
+                self._written = 0
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """ Remove least recently used files until under max_bytes. """
+        files = []
+        total = 0
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                files.append((status.st_mtime, status.st_size, path))
+                total += status.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            self.evictions += 1
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                self._remove(os.path.join(directory, name))
+
+
+class TieredCache(object):
+    """ A cache which looks in each of its tiers in turn.
+
+    Values found in a lower tier are copied into the tiers above it. Entries
+    set with persist=False, e.g. those from private endpoints, are only held
+    in tiers which do not persist them.
+    """
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    @staticmethod
+    def _key(key):
+        return repr(key).encode('utf-8')
+
+    def get(self, key, persist=True):
+        """ Return the value stored under key, or None if absent or expired.
+        """
+        key = self._key(key)
+        missed = []
+        for tier in self.tiers:
+            if tier.persistent and not persist:
+                continue
+            entry = tier.get(key)
+            if entry is not None:
+                expires, value = entry
+                if missed:
+                    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                    for upper_tier in missed:
+                        upper_tier.set(key, value, data, expires)
+                return value
+            missed.append(tier)
+        return None
+
+    def set(self, key, value, ttl, persist=True):
+        """ Store value under key for ttl seconds. """
+        if ttl <= 0:
+            return
+        key = self._key(key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = time.time() + ttl
+        for tier in self.tiers:
+            if tier.persistent and not persist:
+                continue
+            tier.set(key, value, data, expires)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def stats(self):
+        """ Return hit and miss statistics for each tier. """
+        return dict((type(tier).__name__, tier.stats()) for tier in self.tiers)
+
+
+def _make_result_cache():
+    tiers = [MemoryTier()]
+    if CACHE_DIR:
+        tiers.append(DiskTier())
+    return TieredCache(tiers)
+
+
+result_cache = _make_result_cache()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import heapq
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+# Set to 1 to answer people_sharing_event_with_a_person from an in-memory
+# index of each snapshot, built on first use.
+COOCCURRENCE_INDEX = os.environ.get('NEWSREADER_COOCCURRENCE_INDEX',
+                                    '0') == '1'
+PERSON_TYPE = 'http://dbpedia.org/ontology/Person'
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _adjacency(pairs, size):
+    """ Return (offsets, values) for pairs sorted by key, keys in 1..size.
+
+    The values of key k are values[offsets[k]:offsets[k + 1]].
+    """
+    offsets = array(b'i', [0]) * (size + 2)
+    values = array(b'i')
+    for key, value in pairs:
+        offsets[key + 1] += 1
+        values.append(value)
+    for key in xrange(1, size + 2):
+        offsets[key] += offsets[key - 1]
+    return offsets, values
+
+
+class ActorEventIndex(object):
+    """ Which events each actor takes part in, and which actors each event
+    has, for the actors with role 'actor' in a snapshot.
+
+    Both are held as sorted integer arrays of the snapshot's event and
+    actor numbers, about 8 bytes per actor/event pair.
+    """
+    def __init__(self, connection):
+        actors = connection.execute(
+            'SELECT id, uri, comment FROM actors ORDER BY id').fetchall()
+        size = actors[-1][0] if actors else 0
+        self.uris = [None] * (size + 1)
+        self.comments = [None] * (size + 1)
+        self.ids = {}
+        for actor_id, uri, comment in actors:
+            self.uris[actor_id] = uri
+            self.comments[actor_id] = comment
+            self.ids[uri] = actor_id
+        self.is_person = bytearray(size + 1)
+        for actor_id, in connection.execute(
+                'SELECT actor FROM actor_types WHERE type = ?',
+                (PERSON_TYPE,)):
+            self.is_person[actor_id] = 1
+
+        events_size, = connection.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM events').fetchone()
+        self.actor_offsets, self.actor_events = _adjacency(connection.execute(
+            "SELECT DISTINCT actor, event FROM event_actors "
+            "WHERE role = 'actor' ORDER BY actor, event"), size)
+        self.event_offsets, self.event_actors = _adjacency(connection.execute(
+            "SELECT DISTINCT event, actor FROM event_actors "
+            "WHERE role = 'actor' ORDER BY event, actor"), events_size)
+
+    def events_of(self, actor_id):
+        return self.actor_events[self.actor_offsets[actor_id]:
+                                 self.actor_offsets[actor_id + 1]]
+
+    def partner_counts(self, uri):
+        """ Return {actor number: events shared} for the people sharing an
+        event with the actor uri.
+        """
+        actor_id = self.ids.get(uri)
+        if actor_id is None:
+            return {}
+        counts = {}
+        event_offsets = self.event_offsets
+        event_actors = self.event_actors
+        is_person = self.is_person
+        for event_id in self.events_of(actor_id):
+            for position in xrange(event_offsets[event_id],
+                                   event_offsets[event_id + 1]):
+                partner = event_actors[position]
+                if partner != actor_id and is_person[partner]:
+                    counts[partner] = counts.get(partner, 0) + 1
+        return counts
+
+    def top_partners(self, uri, offset, limit):
+        """ Return [(partner uri, events shared, comment)] for a page of the
+        people sharing an event with the actor uri, most shared first.
+        """
+        uris = self.uris
+        top = heapq.nsmallest(offset + limit,
+                              self.partner_counts(uri).iteritems(),
+                              key=lambda item: (-item[1], uris[item[0]]))
+        return [(uris[partner], count, self.comments[partner])
+                for partner, count in top[offset:]]
+
+    def partner_count(self, uri):
+        """ Return the number of people sharing an event with actor uri. """
+        return len(self.partner_counts(uri))
+
+
+def get_cooccurrence_index(store, endpoint_url):
+    """ Return the ActorEventIndex of the snapshot of endpoint_url in store,
+    or None if the index is disabled or there is no snapshot.
+
+    The index is rebuilt once the snapshot is replaced.
+    """
+    if not COOCCURRENCE_INDEX or not store.has_snapshot(endpoint_url):
+        return None
+    path = store.path(endpoint_url)
+    status = os.stat(path)
+    version = (status.st_ino, status.st_mtime)
+    entry = _indexes.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _indexes_lock:
+        entry = _indexes.get(path)
+        if entry is None or entry[0] != version:
+            t0 = time.time()
+            connection = sqlite3.connect(path)
+            try:
+                index = ActorEventIndex(connection)
+            finally:
+                connection.close()
+            logging.info("Built actor/event index of %s in %.2f seconds",
+                         endpoint_url, time.time() - t0)
+            entry = _indexes[path] = (version, index)
+    return entry[1]
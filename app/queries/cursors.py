@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import base64
+import json
+
+SPARQL_STRING_ESCAPES = [('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'),
+                         ('\r', '\\r')]
+
+
+def encode_cursor(values):
+    """ Return an opaque, URL-safe cursor for a list of key values. """
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """ Return the list of key values in a cursor; ValueError if malformed.
+    """
+    try:
+        data = unicode(cursor).encode('ascii')
+        data += b'=' * (-len(data) % 4)
+        values = json.loads(base64.urlsafe_b64decode(data).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Cursor is malformed")
+    if (not isinstance(values, list) or len(values) != length or
+            not all(isinstance(value, unicode) for value in values)):
+        raise ValueError("Cursor is malformed")
+    return values
+
+
+def sparql_string(value):
+    """ Return value as a quoted SPARQL string literal. """
+    for character, escaped in SPARQL_STRING_ESCAPES:
+        value = value.replace(character, escaped)
+    return '"' + value + '"'
+
+
+def make_keyset_filter(variables, values):
+    """ Return a FILTER admitting only rows ordered after values.
+
+    Rows are taken to be ordered by the string value of each of variables
+    in turn, as by ORDER BY STR(?a) STR(?b) ...
+    """
+    condition = None
+    for variable, value in reversed(zip(variables, values)):
+        term = 'STR(?{0})'.format(variable)
+        literal = sparql_string(value)
+        if condition is None:
+            condition = '{0} > {1}'.format(term, literal)
+        else:
+            condition = '{0} > {1} || ({0} = {1} && ({2}))'.format(
+                term, literal, condition)
+    return 'FILTER ({0})'.format(condition)
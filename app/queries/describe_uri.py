@@ -12,14 +12,18 @@ class describe_uri(SparqlQuery):
     def __init__(self, *args, **kwargs):
         super(describe_uri, self).__init__(*args, **kwargs)
         self.query_title = 'Details of a URI returned by the DESCRIBE query'
-        self.description = 'Uses the SPARQL DESCRIBE keyword which returns a network not compatible with HTML display'
+        self.description = ('Uses the SPARQL DESCRIBE keyword which returns a network not compatible with HTML display.'
+          ' Further URIs may be given as uris.1, uris.2 ...')
         self.url = 'describe_uri'
         self.world_cup_example = 'describe_uri?uris.0=dbpedia:Thierry_Henry&output=json'
         self.cars_example = 'describe_uri?uris.0=dbpedia:Martin_Winterkorn&output=json'
         self.ft_example = 'describe_uri?uris.0=dbpedianl:ING_(bank)&output=json'
         self.wikinews_example = 'describe_uri?uris.0=dbpedia:Barack_Obama&output=json'
         self.query_template = ("""
-DESCRIBE {uri_0}
+DESCRIBE ?actor
+WHERE {{
+  VALUES ?actor {{ {uri_values} }}
+}}
                                """)
 
         self.count_template = ("")
@@ -31,6 +35,7 @@ DESCRIBE {uri_0}
         self.optional_parameters = ["output"]
         self.headers = ['**output is a graph**']
         self.number_of_uris_required = 1
+        self.accepts_uri_values = True
 
         self.query = self._build_query()
 
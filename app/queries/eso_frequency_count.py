@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 from queries import SparqlQuery
+from cache import FREQUENCY_CACHE_TTL
 
 class eso_frequency_count(SparqlQuery):
 
@@ -48,6 +49,8 @@ BIND (?filterfield AS ?eso) .
                                """)
 
         self.jinja_template = 'table.html'
+        self.cache_ttl = FREQUENCY_CACHE_TTL
+        self.materialized = True
         self.headers = ['eso', 'count']
 
         self.required_parameters = []
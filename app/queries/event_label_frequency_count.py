@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 from queries import SparqlQuery
+from cache import FREQUENCY_CACHE_TTL
 
 class event_label_frequency_count(SparqlQuery):
 
@@ -44,6 +45,8 @@ WHERE {{
                                """)
 
         self.jinja_template = 'table.html'
+        self.cache_ttl = FREQUENCY_CACHE_TTL
+        self.materialized = True
         self.headers = ['event_label', 'count']
 
         self.required_parameters = []
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import calendar
+import collections
+import datetime
+import functools
+import logging
+import os
+
+from queries import (OFFSET_LIMIT, QueryException, get_bulk_executor,
+                     iter_ordered)
+
+# Rows fetched from the KnowledgeStore per upstream request.
+EXPORT_BLOCK_SIZE = int(os.environ.get('NEWSREADER_EXPORT_BLOCK_SIZE', 1000))
+# Upstream requests an export may have in flight at once.
+EXPORT_CONCURRENCY = int(os.environ.get('NEWSREADER_EXPORT_CONCURRENCY', 4))
+# Results are split by year from this one to the present.
+EXPORT_FIRST_YEAR = int(os.environ.get('NEWSREADER_EXPORT_FIRST_YEAR', 1900))
+
+# A result is split by date once its count exceeds this. Counts are of
+# distinct events while rows may repeat an event, e.g. once per label, so
+# this leaves room under OFFSET_LIMIT.
+SPLIT_THRESHOLD = OFFSET_LIMIT // 2
+
+# Parameters which the export sets itself.
+EXPORT_IGNORED_PARAMETERS = ['offset', 'limit', 'cursor', 'callback']
+
+
+def split_datefilter(datefilter):
+    """ Return the datefilters for the years, months or days of datefilter.
+
+    A datefilter of None is split into years. Returns an empty list for a
+    single day, which cannot be split further.
+    """
+    if datefilter is None:
+        return ['{0:04d}'.format(year) for year in
+                range(EXPORT_FIRST_YEAR, datetime.date.today().year + 1)]
+    parts = unicode(datefilter).split('-')
+    if len(parts) == 1:
+        return ['{0}-{1:02d}'.format(parts[0], month)
+                for month in range(1, 13)]
+    if len(parts) == 2:
+        _, days = calendar.monthrange(int(parts[0]), int(parts[1]))
+        return ['{0}-{1}-{2:02d}'.format(parts[0], parts[1], day)
+                for day in range(1, days + 1)]
+    return []
+
+
+class QueryExporter(object):
+    """ Iterates over every result row of a query, fetched in large blocks.
+
+    Queries which support cursor paging are walked with their cursor, each
+    block being fetched while the one before it is consumed. Others are
+    paged with OFFSET, several blocks at a time; results too large for that
+    are split by year, then month, then day with the datefilter parameter.
+    At most concurrency blocks are held at once, however large the result.
+    Materialized queries are read from their tables unless use_materialized
+    is False. Each block and count query has deadline_seconds to run, if
+    given, in place of the deadline of its query class.
+
+    Raises QueryException on construction if the query cannot be made, or
+    if its results are not a table.
+    """
+    def __init__(self, query_class, query_args, username, password,
+                 block_size=EXPORT_BLOCK_SIZE, concurrency=EXPORT_CONCURRENCY,
+                 use_materialized=True, deadline_seconds=None):
+        self.query_class = query_class
+        self.query_args = dict((key, value) for key, value in
+                               query_args.iteritems()
+                               if key not in EXPORT_IGNORED_PARAMETERS)
+        self.query_args['output'] = 'json'
+        self.username = username
+        self.password = password
+        self.block_size = block_size
+        self.concurrency = concurrency
+        self.use_materialized = use_materialized
+        self.deadline_seconds = deadline_seconds
+        # Set if some rows could not be reached.
+        self.truncated = False
+
+        query = self._make_query()
+        if not query.result_is_tabular:
+            raise QueryException("Query result cannot be exported")
+        self.headers = query.headers
+        self.supports_cursor = query.supports_cursor
+        self.splittable = '{date_filter_block}' in query.query_template
+
+    def _make_query(self, offset=0, limit=None, **kwargs):
+        query_args = dict(self.query_args)
+        query_args.update(kwargs)
+        query = self.query_class(offset=offset,
+                                 limit=limit or self.block_size,
+                                 **query_args)
+        # Caching export blocks would only evict interactive results, and
+        # they are already as large as we want.
+        query.cache_ttl = 0
+        query.block_fetch = False
+        if not self.use_materialized:
+            query.materialized = False
+        if self.deadline_seconds is not None:
+            query.deadline_seconds = self.deadline_seconds
+        return query
+
+    def _fetch(self, **kwargs):
+        """ Return a submitted query for one block of rows. """
+        query = self._make_query(**kwargs)
+        try:
+            query.submit_query(self.username, self.password)
+        except QueryException:
+            # An empty block is the end of the result, not an error.
+            if query.clean_json is None or len(query.clean_json) > 0:
+                raise
+        if query.partial:
+            # A short block would be taken for the end of the result.
+            raise QueryException("Export block was cut short at the "
+                                 "query deadline")
+        return query
+
+    def _count(self, datefilter):
+        query = self._make_query(datefilter=datefilter)
+        return query.get_total_result_count(self.username, self.password)
+
+    def __iter__(self):
+        if self.supports_cursor:
+            blocks = self._iter_cursor_blocks()
+        else:
+            datefilter = self.query_args.get('datefilter')
+            count = None
+            if self.splittable:
+                count = self._count(datefilter)
+            blocks = self._iter_split_blocks(datefilter, count)
+        for rows in blocks:
+            for row in rows:
+                yield row
+
+    def _iter_cursor_blocks(self):
+        executor = get_bulk_executor()
+        pending = executor.apply_async(self._fetch)
+        while pending is not None:
+            query = pending.get()
+            pending = None
+            if query.next_cursor is not None:
+                pending = executor.apply_async(
+                    self._fetch, (), {"cursor": query.next_cursor})
+            yield query.clean_json
+
+    def _iter_split_blocks(self, datefilter, count):
+        """ Yield the blocks of rows within datefilter, splitting it by date
+        if its count shows there are too many to page through with OFFSET.
+
+        A count of None, which ran out of time, is not split: counts of its
+        parts would likely run out of time as well, so it is paged through
+        with OFFSET as far as the limit allows.
+        """
+        subfilters = []
+        if count is not None and count > SPLIT_THRESHOLD:
+            subfilters = split_datefilter(datefilter)
+        if not subfilters:
+            for rows in self._iter_offset_blocks(datefilter):
+                yield rows
+            return
+        counts = iter_ordered(
+            [functools.partial(self._count, subfilter)
+             for subfilter in subfilters], self.concurrency,
+            get_bulk_executor())
+        for subfilter, subcount in zip(subfilters, counts):
+            if subcount != 0:
+                for rows in self._iter_split_blocks(subfilter, subcount):
+                    yield rows
+
+    def _iter_offset_blocks(self, datefilter):
+        """ Yield blocks of rows within datefilter, paging with OFFSET. """
+        executor = get_bulk_executor()
+        offsets = iter(range(0, OFFSET_LIMIT - 1, self.block_size))
+        pending = collections.deque()
+
+        def submit(offset):
+            limit = min(self.block_size, OFFSET_LIMIT - 1 - offset)
+            pending.append((limit, executor.apply_async(
+                self._fetch, (),
+                {"offset": offset, "limit": limit,
+                 "datefilter": datefilter})))
+
+        for offset in offsets:
+            submit(offset)
+            if len(pending) >= self.concurrency:
+                break
+        while pending:
+            limit, result = pending.popleft()
+            rows = result.get().clean_json
+            yield rows
+            if len(rows) < limit:
+                # Blocks still in flight are beyond the end; drop them.
+                return
+            offset = next(offsets, None)
+            if offset is not None:
+                submit(offset)
+
+        logging.warning("Export of %s reached the OFFSET limit within "
+                        "datefilter %s", self.query_class.__name__,
+                        datefilter)
+        self.truncated = True
@@ -2,7 +2,8 @@
 # encoding: utf-8
 from __future__ import unicode_literals
 
-from queries import CRUDQuery, QueryException
+from queries import CONNECT_TIMEOUT, CRUDQuery, QueryException
+from sessions import get_session_pool
 import os
 import time
 
@@ -63,10 +64,28 @@ class get_document(CRUDQuery):
         endpoint_url = self.endpoint_stub_url.format(action=self.action)
         print "\n\n**New CRUD query**"
         print endpoint_url, payload
+
+        cache_key = ('crud', self.endpoint_stub_url, self.action, self.query)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            self.cache_status = 'hit'
+            print "From cache: True"
+            self.json_result = cached
+            self.clean_json = self.json_result
+            return
+
+        self.cache_status = 'miss'
+        remaining = self.remaining_time()
+        if remaining <= 0:
+            raise self._deadline_exceeded()
         t0 = time.time()
         try:
-            response = requests.get(endpoint_url, auth=(username, password),
-                                    params=payload)
+            response = get_session_pool(self.endpoint_stub_url).get(
+                endpoint_url, username, password, params=payload,
+                timeout=(CONNECT_TIMEOUT, remaining))
+        except requests.Timeout:
+            print "Query timed out"
+            raise self._deadline_exceeded()
         except Exception as e:
             print "Query raised an exception"
             print type(e)
@@ -76,15 +95,16 @@ class get_document(CRUDQuery):
         else:
             t1 = time.time()
             total = t1-t0
+            self.timings['upstream'] = total
             print "Time to return from query: {0:.2f} seconds".format(total)
             print "Response code: {0}".format(response.status_code)
-            print "From cache: {0}".format(response.from_cache)
 
             #print response.content
             
             if response and (response.status_code == requests.codes.ok):
                 self.json_result = {"content":response.content}
                 self.clean_json = self.json_result
+                self._set_cached(cache_key, self.json_result)
             else:
                 raise QueryException("Response code not OK: {0}".format(response.status_code))
 
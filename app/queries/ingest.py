@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import logging
+import os
+import time
+
+from queries import BACKGROUND_QUERY_DEADLINE, QueryException, SparqlQuery
+from snapshots import snapshot_store
+
+# Rows fetched from the KnowledgeStore per upstream request.
+INGEST_BLOCK_SIZE = int(os.environ.get('NEWSREADER_INGEST_BLOCK_SIZE', 5000))
+
+# The relations copied into a snapshot: (name, query_template, cursor_key).
+# Each is walked with a cursor, so none is limited by OFFSET_LIMIT.
+RELATIONS = [
+    ('events', """
+SELECT ?event (COUNT(*) AS ?size)
+WHERE {{
+  ?event a sem:Event .
+  {keyset_filter_block}
+  ?event ?p ?o .
+}}
+GROUP BY ?event
+ORDER BY STR(?event)
+OFFSET {offset}
+LIMIT {limit}
+""", [('event', 'event')]),
+    ('event_times', """
+SELECT DISTINCT ?event ?datetime ?year ?month ?day
+WHERE {{
+  ?event a sem:Event ; sem:hasTime ?t .
+  ?t owltime:inDateTime ?d .
+  ?d rdfs:label ?datetime .
+  {keyset_filter_block}
+  OPTIONAL {{ ?d owltime:year ?year }}
+  OPTIONAL {{ ?d owltime:month ?month }}
+  OPTIONAL {{ ?d owltime:day ?day }}
+}}
+ORDER BY STR(?event) STR(?datetime)
+OFFSET {offset}
+LIMIT {limit}
+""", [('event', 'event'), ('datetime', 'datetime')]),
+    ('event_labels', """
+SELECT DISTINCT ?event ?event_label
+WHERE {{
+  ?event a sem:Event ; rdfs:label ?event_label .
+  {keyset_filter_block}
+}}
+ORDER BY STR(?event) STR(?event_label)
+OFFSET {offset}
+LIMIT {limit}
+""", [('event', 'event'), ('event_label', 'event_label')]),
+    ('event_types', """
+SELECT DISTINCT ?event ?type
+WHERE {{
+  ?event a sem:Event ; a ?type .
+  FILTER (?type != sem:Event)
+  {keyset_filter_block}
+}}
+ORDER BY STR(?event) STR(?type)
+OFFSET {offset}
+LIMIT {limit}
+""", [('event', 'event'), ('type', 'type')]),
+    ('event_actors', """
+SELECT DISTINCT ?event ?actor ?role
+WHERE {{
+  ?event a sem:Event .
+  {{ ?event sem:hasActor ?actor . BIND ("actor" AS ?role) }}
+  UNION
+  {{ ?event sem:hasPlace ?actor . BIND ("place" AS ?role) }}
+  {keyset_filter_block}
+}}
+ORDER BY STR(?event) STR(?actor) STR(?role)
+OFFSET {offset}
+LIMIT {limit}
+""", [('event', 'event'), ('actor', 'actor'), ('role', 'role')]),
+    ('actor_types', """
+SELECT DISTINCT ?actor ?type
+WHERE {{
+  ?event sem:hasActor|sem:hasPlace ?actor .
+  ?actor a ?type .
+  {keyset_filter_block}
+}}
+ORDER BY STR(?actor) STR(?type)
+OFFSET {offset}
+LIMIT {limit}
+""", [('actor', 'actor'), ('type', 'type')]),
+    ('actor_labels', """
+SELECT DISTINCT ?actor ?label
+WHERE {{
+  ?event sem:hasActor ?actor .
+  ?g dct:source <http://dbpedia.org/> .
+  GRAPH ?g {{ ?actor rdfs:label ?label }}
+  {keyset_filter_block}
+}}
+ORDER BY STR(?actor) STR(?label)
+OFFSET {offset}
+LIMIT {limit}
+""", [('actor', 'actor'), ('label', 'label')]),
+    ('actor_comments', """
+SELECT ?actor (SAMPLE(?comment) AS ?comment)
+WHERE {{
+  ?event sem:hasActor|sem:hasPlace ?actor .
+  {keyset_filter_block}
+  ?actor rdfs:comment ?comment .
+}}
+GROUP BY ?actor
+ORDER BY STR(?actor)
+OFFSET {offset}
+LIMIT {limit}
+""", [('actor', 'actor')]),
+]
+
+
+class IngestQuery(SparqlQuery):
+    """ Fetches a block of one of the RELATIONS copied into a snapshot. """
+    def __init__(self, name, template, cursor_key, *args, **kwargs):
+        super(IngestQuery, self).__init__(*args, **kwargs)
+        self.query_title = 'Snapshot ingestion: ' + name
+        self.url = 'ingest_' + name
+        self.query_template = template
+        self.cursor_key = cursor_key
+        self.headers = [column for column, _ in cursor_key]
+        # Blocks are only read once, and nobody is waiting on them.
+        self.cache_ttl = 0
+        self.deadline_seconds = BACKGROUND_QUERY_DEADLINE
+        self.block_fetch = False
+        self.query = self._build_query()
+
+
+def iter_relation(relation, endpoint_url, username, password,
+                  block_size=INGEST_BLOCK_SIZE):
+    """ Yield every row of relation, one of RELATIONS, from endpoint_url. """
+    name, template, cursor_key = relation
+    cursor = None
+    while True:
+        query = IngestQuery(name, template, cursor_key, limit=block_size,
+                            endpoint_url=endpoint_url, cursor=cursor)
+        try:
+            query.submit_query(username, password)
+        except QueryException:
+            # An empty block is the end of the relation, not an error.
+            if query.clean_json == []:
+                return
+            raise
+        if query.partial:
+            # The rest of the relation would be missed.
+            raise QueryException("Ingestion of {0} was cut short at the "
+                                 "query deadline".format(name))
+        for row in query.clean_json:
+            yield row
+        cursor = query.next_cursor
+        if cursor is None:
+            return
+
+
+def _number(value):
+    return None if value is None else int(value)
+
+
+def _store_row(writer, name, row):
+    if name == 'events':
+        writer.event_id(row['event'], _number(row.get('size')))
+    elif name == 'event_times':
+        writer.add('event_times', (writer.event_id(row['event']),
+                                   row['datetime'], _number(row.get('year')),
+                                   _number(row.get('month')),
+                                   _number(row.get('day'))))
+    elif name == 'event_labels':
+        writer.add('event_labels', (writer.event_id(row['event']),
+                                    row['event_label'],
+                                    row['event_label'].lower()))
+    elif name == 'event_types':
+        writer.add('event_types', (writer.event_id(row['event']),
+                                   row['type']))
+    elif name == 'event_actors':
+        writer.add('event_actors', (writer.event_id(row['event']),
+                                    writer.actor_id(row['actor']),
+                                    row['role']))
+    elif name == 'actor_types':
+        writer.add('actor_types', (writer.actor_id(row['actor']),
+                                   row['type']))
+    elif name == 'actor_labels':
+        writer.add('actor_labels', (writer.actor_id(row['actor']),
+                                    row['label'], row['label'].lower()))
+    elif name == 'actor_comments':
+        writer.actor_id(row['actor'], row.get('comment'))
+
+
+def ingest_endpoint(endpoint_url, username, password, store=None,
+                    block_size=INGEST_BLOCK_SIZE):
+    """ Copy the RELATIONS of endpoint_url into a new snapshot, which
+    replaces the old one only once complete. Returns the rows copied.
+    """
+    store = store or snapshot_store
+    writer = store.writer(endpoint_url)
+    total = 0
+    try:
+        for relation in RELATIONS:
+            t0 = time.time()
+            count = 0
+            for row in iter_relation(relation, endpoint_url, username,
+                                     password, block_size):
+                _store_row(writer, relation[0], row)
+                count += 1
+            logging.info("Ingested %d rows of %s in %.2f seconds", count,
+                         relation[0], time.time() - t0)
+            total += count
+        writer.commit()
+    except BaseException:
+        writer.abandon()
+        raise
+    return total
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Whole-dataset aggregates whose every row is stored locally, with the
+# column their filter parameter is matched against.
+MATERIALIZED_QUERIES = [('eso_frequency_count', 'eso'),
+                        ('framenet_frequency_count', 'frame'),
+                        ('event_label_frequency_count', 'event_label'),
+                        ('types_of_actors', 'type')]
+
+# Set to an empty string to always query the KnowledgeStore.
+MATERIALIZED_DIR = os.environ.get('NEWSREADER_MATERIALIZED_DIR',
+                                  '/tmp/newsreader_tables')
+# Snapshots older than this are not served.
+MATERIALIZED_MAX_AGE = int(
+    os.environ.get('NEWSREADER_MATERIALIZED_MAX_AGE', 30 * 86400))
+# Rows fetched from the KnowledgeStore per upstream request on refresh.
+MATERIALIZED_BLOCK_SIZE = int(
+    os.environ.get('NEWSREADER_MATERIALIZED_BLOCK_SIZE', 1000))
+
+Snapshot = namedtuple('Snapshot', 'created complete rows')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    query TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    complete INTEGER NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+    query TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    search TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (query, rank)
+);
+"""
+
+
+def search_text(value):
+    """ Return the lower case text of value which filters are matched to.
+
+    For a URI this is its local name, e.g. racingdriver for
+    http://dbpedia.org/ontology/RacingDriver.
+    """
+    value = unicode(value or '')
+    if value.startswith('http'):
+        value = value.rsplit('#', 1)[-1].rsplit('/', 1)[-1]
+    return value.lower()
+
+
+def parse_filter(filter_string):
+    """ Return the filter as a list of alternatives, each a list of words.
+
+    Reads the subset of bif:contains syntax in use: words, which must all
+    appear, separated by OR. Quotes and * wildcards are dropped, as every
+    word is matched as a substring.
+    """
+    alternatives = []
+    for alternative in filter_string.lower().split(' or '):
+        words = [word.strip('"\'*') for word in alternative.split()
+                 if word != 'and']
+        words = [word for word in words if word]
+        if words:
+            alternatives.append(words)
+    return alternatives
+
+
+def filter_clause(filter_string, column='search'):
+    """ Return (SQL condition, named parameters) matching the text in column,
+    as made by search_text(), to filter_string.
+    """
+    conditions = []
+    parameters = {}
+    if filter_string and filter_string != 'none':
+        for words in parse_filter(filter_string):
+            terms = []
+            for word in words:
+                name = 'filter_{0}'.format(len(parameters))
+                parameters[name] = word
+                terms.append('instr({0}, :{1}) > 0'.format(column, name))
+            conditions.append('(' + ' AND '.join(terms) + ')')
+    if not conditions:
+        return '1', {}
+    return '(' + ' OR '.join(conditions) + ')', parameters
+
+
+class MaterializedTables(object):
+    """ Stores every row of each materialized query, one SQLite file per
+    endpoint.
+
+    A refresh replaces a query's rows in a single transaction, so readers
+    in other workers see either the old snapshot or the new one.
+    """
+    def __init__(self, directory=MATERIALIZED_DIR,
+                 max_age=MATERIALIZED_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def path(self, endpoint_url):
+        digest = hashlib.sha1(endpoint_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.sqlite')
+
+    def _connect(self, endpoint_url):
+        """ Return this thread's read-only connection to the tables of
+        endpoint_url.
+
+        Connections are reopened when the file is replaced.
+        """
+        path = self.path(endpoint_url)
+        inode = os.stat(path).st_ino
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        entry = connections.get(path)
+        if entry is None or entry[0] != inode:
+            if entry is not None:
+                entry[1].close()
+            connection = sqlite3.connect(path)
+            connection.execute('PRAGMA query_only = ON')
+            entry = connections[path] = (inode, connection)
+        return entry[1]
+
+    def _connect_for_writing(self, endpoint_url):
+        connection = sqlite3.connect(self.path(endpoint_url), timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    def snapshot(self, endpoint_url, query_name):
+        """ Return the Snapshot of query_name to serve, or None. """
+        if (not self.directory or endpoint_url is None or
+                not os.path.exists(self.path(endpoint_url))):
+            return None
+        try:
+            row = self._connect(endpoint_url).execute(
+                'SELECT created, complete, rows FROM snapshots '
+                'WHERE query = ?', (query_name,)).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Materialized tables unreadable: %s", e)
+            return None
+        if row is None or time.time() - row[0] > self.max_age:
+            return None
+        return Snapshot(row[0], bool(row[1]), row[2])
+
+    def page(self, endpoint_url, query_name, filter_string, offset, limit):
+        """ Return the rows of a page of query_name matching filter_string.
+        """
+        condition, parameters = filter_clause(filter_string)
+        parameters.update(query=query_name, limit=limit, offset=offset)
+        rows = self._connect(endpoint_url).execute(
+            'SELECT data FROM rows WHERE query = :query AND ' + condition +
+            ' ORDER BY rank LIMIT :limit OFFSET :offset',
+            parameters).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def count(self, endpoint_url, query_name, filter_string):
+        """ Return the number of rows of query_name matching filter_string.
+        """
+        condition, parameters = filter_clause(filter_string)
+        parameters['query'] = query_name
+        count, = self._connect(endpoint_url).execute(
+            'SELECT COUNT(*) FROM rows WHERE query = :query AND ' +
+            condition, parameters).fetchone()
+        return count
+
+    def store(self, endpoint_url, query_name, search_column, rows,
+              complete=True):
+        """ Replace the snapshot of query_name with rows, in order. """
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        connection = self._connect_for_writing(endpoint_url)
+        try:
+            with connection:
+                connection.execute('DELETE FROM rows WHERE query = ?',
+                                   (query_name,))
+                count = 0
+                for rank, row in enumerate(rows):
+                    connection.execute(
+                        'INSERT INTO rows VALUES (?, ?, ?, ?)',
+                        (query_name, rank, search_text(row.get(search_column)),
+                         json.dumps(row)))
+                    count += 1
+                connection.execute(
+                    'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)',
+                    (query_name, time.time(), int(complete), count))
+        finally:
+            connection.close()
+
+    def lock(self, endpoint_url):
+        """ Return an open lock file if no other process is refreshing
+        endpoint_url, else None. Close the file to release the lock.
+        """
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        lock_file = open(self.path(endpoint_url) + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+
+materialized_tables = MaterializedTables()
+
+
+def refresh_endpoint(endpoint_url, username, password, max_age=0,
+                     tables=None):
+    """ Run each materialized query against an endpoint and store its rows.
+
+    Queries whose snapshot is younger than max_age seconds are left alone,
+    as is the endpoint if another process is refreshing it. A query which
+    fails is logged and left with its old snapshot. Returns the names of the
+    queries refreshed.
+    """
+    # Imported here as export.py and the query classes import queries.py,
+    # which imports this module.
+    from export import QueryExporter
+    from queries import BACKGROUND_QUERY_DEADLINE
+    from registry import get_query_class
+
+    tables = tables or materialized_tables
+    lock_file = tables.lock(endpoint_url)
+    if lock_file is None:
+        logging.info("Materialized tables for %s are being refreshed "
+                     "elsewhere", endpoint_url)
+        return []
+    refreshed = []
+    try:
+        for query_name, search_column in MATERIALIZED_QUERIES:
+            snapshot = tables.snapshot(endpoint_url, query_name)
+            if (snapshot is not None and
+                    time.time() - snapshot.created < max_age):
+                continue
+            t0 = time.time()
+            try:
+                exporter = QueryExporter(
+                    get_query_class(query_name),
+                    {"endpoint_url": endpoint_url}, username, password,
+                    block_size=MATERIALIZED_BLOCK_SIZE,
+                    use_materialized=False,
+                    deadline_seconds=BACKGROUND_QUERY_DEADLINE)
+                rows = list(exporter)
+                tables.store(endpoint_url, query_name, search_column, rows,
+                             complete=not exporter.truncated)
+            except Exception:
+                # The other queries may still be refreshed.
+                logging.exception("Refresh of %s for %s failed", query_name,
+                                  endpoint_url)
+                continue
+            logging.info("Materialized %d rows of %s in %.2f seconds",
+                         len(rows), query_name, time.time() - t0)
+            refreshed.append(query_name)
+    finally:
+        lock_file.close()
+    return refreshed
+
+
+def start_scheduler(endpoints, interval, tables=None):
+    """ Refresh the materialized tables of endpoints every interval seconds
+    in a daemon thread.
+
+    endpoints is a list of (endpoint_url, username, password). Every worker
+    may run a scheduler; a refresh already done by another is skipped.
+    """
+    def run():
+        while True:
+            for endpoint_url, username, password in endpoints:
+                try:
+                    refresh_endpoint(endpoint_url, username, password,
+                                     max_age=interval, tables=tables)
+                except Exception:
+                    logging.exception("Refresh of materialized tables for "
+                                      "%s failed", endpoint_url)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='materialize')
+    thread.daemon = True
+    thread.start()
+    return thread
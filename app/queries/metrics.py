@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from cache import result_cache
+from sessions import session_pool_stats
+
+# Each worker process writes its metrics to a file of its own here, and the
+# metrics route adds up every file, so that it reports on all workers
+# whichever one serves it. Clear it when the service is restarted. Set to
+# an empty string to report on the serving worker alone.
+METRICS_DIR = os.environ.get('NEWSREADER_METRICS_DIR',
+                             '/tmp/newsreader_metrics')
+# Seconds between writes of a worker's metrics to its file.
+METRICS_FLUSH_SECONDS = float(
+    os.environ.get('NEWSREADER_METRICS_FLUSH_SECONDS', 5))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 120, 300)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+
+LABELS = ('query', 'endpoint', 'format')
+# Any other output a caller asks for is labelled 'other', so that callers
+# cannot add label values at will.
+FORMATS = ('json', 'jsonp', 'csv', 'html')
+# The stages of a request timed in SparqlQuery.timings and by the views,
+# with the histogram each is recorded in.
+HISTOGRAMS = [
+    ('upstream', 'newsreader_upstream_seconds',
+     'Seconds for the endpoint to answer a page query', SECONDS_BUCKETS),
+    ('count', 'newsreader_count_seconds',
+     'Seconds to count the results of a query', SECONDS_BUCKETS),
+    ('parse', 'newsreader_parse_seconds',
+     'Seconds to read and parse the rows of a page query', SECONDS_BUCKETS),
+    ('render', 'newsreader_render_seconds',
+     'Seconds to write a response', SECONDS_BUCKETS),
+    ('bytes', 'newsreader_response_bytes',
+     'Bytes in the body of a response', BYTES_BUCKETS),
+]
+CACHE_COUNTER = 'newsreader_cache_lookups_total'
+CACHE_HELP = ('Page and count lookups of a query by where their result '
+              'came from: hit, miss, shared, materialized or snapshot')
+CACHE_LABELS = LABELS + ('lookup', 'result')
+# Totals each worker keeps of its own, read by its collectors whenever its
+# metrics are written: name, type, help text and label names.
+STATS = [
+    ('newsreader_http_sessions', 'gauge',
+     'Keep-alive sessions open to an endpoint', ('endpoint_url',)),
+    ('newsreader_http_session_events_total', 'counter',
+     'Session checkouts, reuses and waits, connections opened and requests '
+     'made to an endpoint', ('endpoint_url', 'event')),
+    ('newsreader_http_session_wait_seconds_total', 'counter',
+     'Seconds spent waiting for a free session to an endpoint',
+     ('endpoint_url',)),
+    ('newsreader_cache_tier_events_total', 'counter',
+     'Lookups that hit and missed each tier of the result cache, and '
+     'entries set in and evicted from it', ('tier', 'event')),
+    ('newsreader_cache_tier_entries', 'gauge',
+     'Entries held in an in-memory tier of the result cache', ('tier',)),
+    ('newsreader_cache_tier_pickled_bytes', 'gauge',
+     'Total length of the pickles of the entries held in an in-memory tier '
+     'of the result cache', ('tier',)),
+]
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
+
+
+def session_pool_samples():
+    """ Yield (name, labels, value) for each session pool of this worker. """
+    for url, stats in session_pool_stats().iteritems():
+        yield 'newsreader_http_sessions', (url,), stats['sessions']
+        for event in ('checkouts', 'reuses', 'waits', 'new_connections',
+                      'requests'):
+            yield ('newsreader_http_session_events_total', (url, event),
+                   stats[event])
+        yield ('newsreader_http_session_wait_seconds_total', (url,),
+               stats['wait_time'])
+
+
+def cache_tier_samples(cache=result_cache):
+    """ Yield (name, labels, value) for each tier of this worker's cache. """
+    for tier, stats in cache.stats().iteritems():
+        for event in ('hits', 'misses', 'sets', 'evictions'):
+            yield ('newsreader_cache_tier_events_total', (tier, event),
+                   stats[event])
+        for stat in ('entries', 'pickled_bytes'):
+            if stat in stats:
+                yield 'newsreader_cache_tier_' + stat, (tier,), stats[stat]
+
+
+class Metrics(object):
+    """ Histograms of the time spent on each stage of a query, and counts
+    of its cache lookups, labelled by query, endpoint and output format.
+
+    Each of collectors is called when the metrics are written, to yield
+    (name, labels, value) for the totals in STATS.
+    """
+    def __init__(self, directory=METRICS_DIR,
+                 flush_seconds=METRICS_FLUSH_SECONDS, collectors=()):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.collectors = list(collectors)
+        self.buckets = dict((name, buckets)
+                            for _, name, _, buckets in HISTOGRAMS)
+        self._lock = threading.Lock()
+        # Held while writing, so that an older snapshot of this worker's
+        # metrics never replaces a newer one.
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._histograms = {}
+        self._counters = {}
+        self._flushed = 0
+
+    def _check_pid(self):
+        # A forked worker starts counting afresh, in a file of its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._histograms = {}
+            self._counters = {}
+            self._flushed = 0
+
+    def observe(self, name, labels, value):
+        """ Record value in the histogram name with labels. """
+        buckets = self.buckets[name]
+        with self._lock:
+            self._check_pid()
+            key = (name, tuple(labels))
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(buckets) + 1), 0]
+            position = 0
+            while position < len(buckets) and value > buckets[position]:
+                position += 1
+            entry[0][position] += 1
+            entry[1] += value
+        self._maybe_flush()
+
+    def increment(self, name, labels, amount=1):
+        """ Add amount to the counter name with labels. """
+        with self._lock:
+            self._check_pid()
+            key = (name, tuple(labels))
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._maybe_flush()
+
+    def record_query(self, query, endpoint, response_bytes=None):
+        """ Record the timings and cache lookups of a completed query, and
+        the size of its response if known.
+        """
+        output = query.output if query.output in FORMATS else 'other'
+        labels = (query.url, endpoint, output)
+        timings = dict(query.timings)
+        if response_bytes is not None:
+            timings['bytes'] = response_bytes
+        for stage, name, _, _ in HISTOGRAMS:
+            if stage in timings:
+                self.observe(name, labels, timings[stage])
+        for lookup, result in (('page', query.cache_status),
+                               ('count', query.count_cache_status)):
+            if result is not None:
+                self.increment(CACHE_COUNTER, labels + (lookup, result))
+
+    def _maybe_flush(self):
+        if self.directory and (time.time() - self._flushed >=
+                               self.flush_seconds):
+            self.flush()
+
+    def _snapshot(self):
+        with self._lock:
+            self._check_pid()
+            snapshot = {
+                "histograms": [[name, list(labels), list(entry[0]), entry[1]]
+                               for (name, labels), entry
+                               in self._histograms.iteritems()],
+                "counters": [[name, list(labels), value]
+                             for (name, labels), value
+                             in self._counters.iteritems()]}
+        for collector in self.collectors:
+            snapshot["counters"].extend([name, list(labels), value]
+                                        for name, labels, value in collector())
+        return snapshot
+
+    def flush(self):
+        """ Write this worker's metrics to its file. """
+        with self._flush_lock:
+            self._flushed = time.time()
+            self._write(json.dumps(self._snapshot()))
+
+    def _write(self, data):
+        try:
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, temporary_path = tempfile.mkstemp(dir=self.directory,
+                                                  suffix='.tmp')
+            with os.fdopen(fd, 'wb') as temporary_file:
+                temporary_file.write(data)
+            os.rename(temporary_path, os.path.join(
+                self.directory, '{0}.json'.format(os.getpid())))
+        except (IOError, OSError) as e:
+            logging.warning("Metrics could not be written: %s", e)
+
+    def _load_all(self):
+        """ Return the metrics of every worker, this one's up to date. """
+        if not self.directory:
+            return [self._snapshot()]
+        self.flush()
+        loaded = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    loaded.append(json.load(f))
+            except (IOError, ValueError):
+                # Only removed files can be unreadable, as writes are
+                # renamed into place.
+                continue
+        return loaded
+
+    def collect(self):
+        """ Return ({(name, labels): [bucket counts, sum]},
+        {(name, labels): count}) added up over every worker.
+        """
+        histograms = {}
+        counters = {}
+        for data in self._load_all():
+            for name, labels, counts, total in data['histograms']:
+                key = (name, tuple(labels))
+                entry = histograms.get(key)
+                if entry is None:
+                    histograms[key] = [list(counts), total]
+                else:
+                    entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                    entry[1] += total
+            for name, labels, value in data['counters']:
+                key = (name, tuple(labels))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def render(self):
+        """ Return every worker's metrics in the Prometheus text format. """
+        histograms, counters = self.collect()
+        lines = []
+        for _, name, help_text, buckets in HISTOGRAMS:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} histogram'.format(name))
+            for key in sorted(key for key in histograms if key[0] == name):
+                labels = key[1]
+                counts, total = histograms[key]
+                cumulative = 0
+                bounds = [_format_number(bound) for bound in buckets]
+                for bound, count in zip(bounds + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _format_labels(LABELS, labels,
+                                             [('le', bound)]), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, _format_labels(LABELS, labels),
+                    _format_number(total)))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, _format_labels(LABELS, labels), cumulative))
+        lines.append('# HELP {0} {1}'.format(CACHE_COUNTER, CACHE_HELP))
+        lines.append('# TYPE {0} counter'.format(CACHE_COUNTER))
+        for key in sorted(key for key in counters
+                          if key[0] == CACHE_COUNTER):
+            lines.append('{0}{1} {2}'.format(
+                CACHE_COUNTER, _format_labels(CACHE_LABELS, key[1]),
+                counters[key]))
+        for name, kind, help_text, label_names in STATS:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for key in sorted(key for key in counters if key[0] == name):
+                lines.append('{0}{1} {2}'.format(
+                    name, _format_labels(label_names, key[1]),
+                    _format_number(counters[key])))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(collectors=[session_pool_samples, cache_tier_samples])
@@ -43,6 +43,22 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT a.uri AS actor, a2.uri AS actor2,
+       COUNT(DISTINCT ea2.event) AS numEvent, a2.comment AS comment
+FROM actors a
+JOIN event_actors ea ON ea.actor = a.id AND ea.role = 'actor'
+JOIN event_actors ea2 ON ea2.event = ea.event AND ea2.role = 'actor'
+                         AND ea2.actor != a.id
+JOIN actors a2 ON a2.id = ea2.actor
+JOIN actor_types ty ON ty.actor = a2.id
+                       AND ty.type = 'http://dbpedia.org/ontology/Person'
+WHERE a.uri = :uri_0
+GROUP BY a2.id
+                                  """)
+        self.snapshot_order = 'numEvent DESC, actor2'
+        self.snapshot_count_column = 'actor2'
+
         self.jinja_template = 'table.html'
         self.headers = ['actor', 'actor2', 'numEvent', 'comment']
 
@@ -51,3 +67,27 @@ WHERE {{
         self.number_of_uris_required = 1
 
         self.query = self._build_query()
+
+    def _query_snapshot(self):
+        """ Use the actor/event index of the snapshot, if there is one. """
+        index = self._cooccurrence_index()
+        if index is None:
+            return super(people_sharing_event_with_a_person,
+                         self)._query_snapshot()
+        actor = self.uris[0].strip('<>')
+        rows = []
+        for partner, count, comment in index.top_partners(
+                actor, self.offset, self.limit):
+            row = {'actor': actor, 'actor2': partner,
+                   'numEvent': unicode(count)}
+            if comment is not None:
+                row['comment'] = comment
+            rows.append(row)
+        return rows
+
+    def _query_snapshot_count(self):
+        index = self._cooccurrence_index()
+        if index is None:
+            return super(people_sharing_event_with_a_person,
+                         self)._query_snapshot_count()
+        return index.partner_count(self.uris[0].strip('<>'))
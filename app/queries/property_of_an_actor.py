@@ -12,27 +12,30 @@ class property_of_an_actor(SparqlQuery):
     def __init__(self, *args, **kwargs):
         super(property_of_an_actor, self).__init__(*args, **kwargs)
         self.query_title = 'Get a property of a particular actor'
-        self.description = ('Gives the value of a property for a specified actor')
+        self.description = ('Gives the value of a property for a specified actor.'
+          ' Further actors may be given as uris.2, uris.3 ...')
         self.url = 'property_of_an_actor'
         self.world_cup_example = 'property_of_an_actor/page/1?uris.0=dbpedia:Barack_Obama&uris.1=dbo:birthPlace'
         self.cars_example = 'property_of_an_actor/page/1?uris.0=dbpedia:Barack_Obama&uris.1=dbo:birthPlace'
         self.ft_example = 'property_of_an_actor/page/1?uris.0=dbpedia:Barack_Obama&uris.1=dbo:birthPlace'
         self.wikinews_example = 'property_of_an_actor/page/1?uris.0=dbpedia:Barack_Obama&uris.1=dbo:birthPlace'
         self.query_template = ("""
-SELECT ({uri_0} AS ?actor) ?value
+SELECT ?actor ?value
 WHERE {{
-  OPTIONAL {{ {uri_0} {uri_1} ?value }}
+  VALUES ?actor {{ {uri_values} }}
+  OPTIONAL {{ ?actor {uri_1} ?value }}
 }}
-ORDER BY DESC(?value)
+ORDER BY ?actor DESC(?value)
 OFFSET {offset}
 LIMIT {limit}
                                """)
 
         self.count_template = ("""
 SELECT (COUNT(*) as ?count){{
-SELECT ({uri_0} AS ?actor) ?value
+SELECT ?actor ?value
 WHERE {{
-  OPTIONAL {{ {uri_0} {uri_1} ?value }}
+  VALUES ?actor {{ {uri_values} }}
+  OPTIONAL {{ ?actor {uri_1} ?value }}
 }}
 }}
                                """)
@@ -43,6 +46,7 @@ WHERE {{
         self.required_parameters = ["uris"]
         self.optional_parameters = ["output", "offset", "limit", "field"]
         self.number_of_uris_required = 2
+        self.accepts_uri_values = True
 
         self._make_uri_filter_block()
         self.query = self._build_query()
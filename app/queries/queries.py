@@ -2,16 +2,38 @@
 # encoding: utf-8
 from __future__ import unicode_literals
 
+import collections
+import functools
 import json
 import logging
 import os
+import re
+import threading
 import time
 from collections import namedtuple
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing.pool import ThreadPool
 
 import requests
-import requests_cache
 
-requests_cache.install_cache('/tmp/requests_cache', expire_after=172800)
+from blocks import BLOCK_FETCH, block_sizer
+from cache import (COUNT_CACHE_TTL, DOCUMENT_CACHE_TTL, RESULT_CACHE_TTL,
+                   result_cache)
+from cooccurrence import get_cooccurrence_index
+from cursors import decode_cursor, encode_cursor, make_keyset_filter
+from materialized import filter_clause, materialized_tables
+from registry import COST_AGGREGATE, registry
+from sessions import get_session_pool
+from singleflight import SingleFlightTimeout, single_flight
+from snapshots import SnapshotError, snapshot_store
+from streaming import (RESULT_CHUNK_SIZE, RESULT_FORMAT, RESULT_FORMATS,
+                       NoBindingsError, iter_clean_rows, load_result,
+                       rows_to_sparql_json)
+
+try:
+    from gevent import Timeout as GreenletTimeout
+except ImportError:
+    GreenletTimeout = PoolTimeoutError
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -43,10 +65,147 @@ PREFIX_LIBRARY = {
                     "help":"semanticweb, key to the NewsReader technology"}
         }
 
+# Virtuoso will not page beyond this many rows of a result with OFFSET.
+OFFSET_LIMIT = 10000
+
+# Most URIs a query may look up at once with a VALUES block.
+MAX_URI_VALUES = 100
+
+# Seconds a request may spend on its page and count queries together, by
+# the cost class the query is registered with in registry.py. Query classes
+# may set their own deadline_seconds, and callers may ask for more or less
+# with the timeout parameter, up to MAX_QUERY_DEADLINE.
+QUERY_DEADLINE = float(os.environ.get('NEWSREADER_QUERY_DEADLINE', 60))
+AGGREGATE_QUERY_DEADLINE = float(
+    os.environ.get('NEWSREADER_AGGREGATE_QUERY_DEADLINE', 180))
+COST_DEADLINES = {COST_AGGREGATE: AGGREGATE_QUERY_DEADLINE}
+MAX_QUERY_DEADLINE = float(os.environ.get('NEWSREADER_MAX_QUERY_DEADLINE',
+                                          300))
+# Seconds allowed to each query of a background job, such as a refresh of
+# the materialized tables or snapshots, which nobody is waiting on.
+BACKGROUND_QUERY_DEADLINE = float(
+    os.environ.get('NEWSREADER_BACKGROUND_QUERY_DEADLINE', 3600))
+# Seconds allowed to connect to the endpoint, and for its response to
+# arrive after the time Virtuoso was asked to stop work at.
+CONNECT_TIMEOUT = 10
+DEADLINE_GRACE = 5.0
+# Virtuoso's SQL state for an anytime query which returned partial results.
+PARTIAL_RESULT_STATE = 'S1TAT'
+
+# Number of upstream requests a worker process may have in flight at once
+# on behalf of the concurrent page/count path.
+QUERY_POOL_SIZE = int(os.environ.get('NEWSREADER_QUERY_POOL_SIZE', 8))
+# As above, when running on gevent, where an in-flight request costs a
+# greenlet rather than a thread.
+ASYNC_POOL_SIZE = int(os.environ.get('NEWSREADER_ASYNC_POOL_SIZE', 500))
+# Upstream requests a worker process may have in flight at once on behalf
+# of batches and exports, which run on a pool of their own so that they
+# cannot take the whole of the query pool from single requests.
+BULK_POOL_SIZE = int(os.environ.get('NEWSREADER_BULK_POOL_SIZE', 4))
+
+# Pools by name, each with the pid of the process which made it.
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+PREFIX_PATTERN = re.compile(r'(?<![\w:/#.<-])({0}):'.format(
+    '|'.join(sorted(PREFIX_LIBRARY, key=len, reverse=True))))
+
+# Query templates joined with their header and PREFIX declarations, keyed by
+# (header, template, extra prefixes).
+_compiled_templates = {}
+
+
 class QueryException(Exception):
     pass
 
 
+class DeadlineExceeded(QueryException):
+    pass
+
+
+def used_prefixes(text):
+    """ Return the set of PREFIX_LIBRARY prefixes used in text. """
+    return set(PREFIX_PATTERN.findall(text))
+
+
+def make_prefix_block(prefixes):
+    """ Return PREFIX declarations for prefixes, in a stable order. """
+    return "".join("PREFIX {k}: <{v}>\n".format(k=k,
+                                                v=PREFIX_LIBRARY[k]['stub'])
+                   for k in sorted(prefixes))
+
+
+def compile_template(header, template, extra_prefixes=frozenset()):
+    """ Return a query template ready for a single str.format() call.
+
+    The header comment and the PREFIX declarations for the prefixes the
+    template uses, together with extra_prefixes used by the blocks to be
+    substituted into it, are joined to the template once per process.
+    """
+    key = (header, template, extra_prefixes)
+    compiled = _compiled_templates.get(key)
+    if compiled is None:
+        prefixes = used_prefixes(template) | extra_prefixes
+        compiled = header + "\n" + make_prefix_block(prefixes) + template
+        _compiled_templates[key] = compiled
+    return compiled
+
+
+def _make_executor(threads=QUERY_POOL_SIZE, greenlets=ASYNC_POOL_SIZE):
+    """ Return a gevent pool if sockets are cooperative, else a thread pool.
+    """
+    try:
+        from gevent import monkey
+        from gevent.pool import Pool
+    except ImportError:
+        return ThreadPool(threads)
+    if monkey.is_module_patched('socket'):
+        return Pool(greenlets)
+    return ThreadPool(threads)
+
+
+def _get_pool(name, threads, greenlets):
+    with _executor_lock:
+        pid, executor = _executors.get(name, (None, None))
+        if executor is None or pid != os.getpid():
+            executor = _make_executor(threads, greenlets)
+            _executors[name] = (os.getpid(), executor)
+        return executor
+
+
+def get_executor():
+    """ Return the bounded pool used to run upstream queries.
+
+    The pool is created lazily, and recreated after a fork, as gunicorn forks
+    its workers after the app has been imported and threads do not survive.
+    Both pool types provide apply_async(), whose result has a get() which
+    returns the value or raises the exception of the call.
+    """
+    return _get_pool('query', QUERY_POOL_SIZE, ASYNC_POOL_SIZE)
+
+
+def get_bulk_executor():
+    """ Return the bounded pool used to run the queries of batches and
+    exports; see get_executor().
+    """
+    return _get_pool('bulk', BULK_POOL_SIZE, BULK_POOL_SIZE)
+
+
+def iter_ordered(tasks, window, executor=None):
+    """ Run each zero-argument callable of tasks on executor, by default the
+    query pool, at most window at a time, and yield their results in order.
+    """
+    executor = executor or get_executor()
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(executor.apply_async(task))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def convert_raw_json_to_clean(SPARQL_json):
     clean_json = []
     # This handles the describe_uri query
@@ -65,31 +224,52 @@ class SparqlQuery(object):
     """ Represents a general SPARQL query for the KnowledgeStore. """
     def __init__(self, offset=0, limit=100, uris=None, output='html',
                  endpoint_url=None, datefilter=None, callback=None, id=None,
-                 filter=None, **kwargs):
+                 filter=None, private_endpoint=False, cursor=None,
+                 backend='sparql', timeout=None, **kwargs):
 
         self.prefix_dict = PREFIX_LIBRARY
-        self._make_prefix_block()
-
-        self.allowed_parameters_block = """
-# All allowed parameters:
-# output: {output}, offset: {offset}, limit: {limit},
-# uri.0: {uri_0}, uri.1: {uri_1}
-# filter_block: {filter_block}, date_filter_block: {date_filter_block}
-# uri_filter_block: {uri_filter_block}
-                                        """
 
         self.offset = offset
         self.limit = limit
         self.query_time = None
         self.count_time = None
+        # Seconds spent on each stage of the query, e.g. 'upstream', and
+        # where its page and count came from, e.g. 'hit' for the cache;
+        # recorded by metrics.py.
+        self.timings = {}
+        self.cache_status = None
+        self.count_cache_status = None
+        # The block of pages fetched in place of query, if one was, and the
+        # bytes of the count query's response.
+        self.block_query = None
+        self.count_response_bytes = 0
+        # The page and count queries share one deadline, counted from now.
+        self.started = time.time()
+        # None for the deadline of the query's cost class.
+        self.deadline_seconds = None
+        self.timeout = self._parse_timeout(timeout)
+        self._deadline = None
+        # Set if the endpoint stopped at the deadline with only some rows.
+        self.partial = False
         self.filter = unicode(filter).lower()
         self.datefilter = unicode(datefilter)
         self.date_filter_block = None
         self.filter_block = None
         self.uri_filter_block = None
+        self.keyset_filter_block = ''
+        # Opaque key of the last row of the previous page, for keyset paging.
+        self.cursor = cursor
+        self.next_cursor = None
         self.original_uris = uris
         self.uris = []
+        self.uri_values = []
         self.endpoint_stub_url = endpoint_url
+        # Results from private endpoints are not written to disk.
+        self.private_endpoint = private_endpoint
+        # 'snapshot' to answer from the endpoint's local snapshot where the
+        # query has a snapshot_template; see snapshots.py.
+        self.backend = backend
+        self.cache_ttl = RESULT_CACHE_TTL
 
         self._process_input_uris(uris)
         self._make_date_filter_block()
@@ -106,17 +286,78 @@ class SparqlQuery(object):
         self.callback = callback
         self.headers = []
         self.result_is_tabular = True
+        self.result_format = RESULT_FORMAT
+        # Whether to fetch a block of several pages upstream and serve the
+        # page asked for from it; see blocks.py.
+        self.block_fetch = BLOCK_FETCH
+        self.response_bytes = 0
+        # Set for queries whose every row is stored by materialized.py, and
+        # so may be served from there; snapshot_age is then the seconds
+        # since the rows were fetched.
+        self.materialized = False
+        self.snapshot_age = None
         self.jinja_template = "default.html"
+        # Set for queries whose query_template looks up every URI in
+        # {uri_values} at once, rather than only {uri_0}.
+        self.accepts_uri_values = False
+        # For queries which support keyset paging, a list of (output column,
+        # SPARQL variable) which together order the rows uniquely. The
+        # query_template orders its rows by STR() of each variable in turn
+        # and includes {keyset_filter_block} where they are all bound.
+        self.cursor_key = None
+        # SQL selecting the rows of the query, with the same columns as its
+        # headers, from the tables in snapshots.py; with the output column
+        # order to page by and the column whose distinct values are counted.
+        self.snapshot_template = None
+        self.snapshot_order = None
+        self.snapshot_count_column = None
 
         self.required_parameters = []
         self.optional_parameters = ["output", "offset", "limit"]
         self.number_of_uris_required = 0
 
-    def _make_prefix_block(self):
-        prefixes = []
-        for k, v in self.prefix_dict.iteritems():
-            prefixes.append("PREFIX {k}: <{v}>".format(k=k, v=v['stub']))
-        self.prefix_block = "\n".join(prefixes)
+    @staticmethod
+    def _parse_timeout(timeout):
+        if timeout is None:
+            return None
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            timeout = 0
+        if timeout <= 0:
+            raise QueryException("timeout must be a positive number of "
+                                 "seconds")
+        return timeout
+
+    @property
+    def deadline(self):
+        """ The time by which the page and count queries must be done. """
+        if self._deadline is None:
+            seconds = self.deadline_seconds
+            if seconds is None:
+                # The base classes are not registered, and have no url.
+                name = getattr(self, 'url', None)
+                seconds = QUERY_DEADLINE
+                if name in registry:
+                    seconds = COST_DEADLINES.get(registry.cost(name),
+                                                 seconds)
+            if self.timeout is not None:
+                seconds = min(self.timeout, MAX_QUERY_DEADLINE)
+            self._deadline = self.started + seconds
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, value):
+        self._deadline = value
+
+    def remaining_time(self):
+        """ Return the seconds left before the deadline. """
+        return self.deadline - time.time()
+
+    def _deadline_exceeded(self):
+        return DeadlineExceeded(
+            "Query deadline of {0:.0f} seconds exceeded".format(
+                self.deadline - self.started))
 
     def _process_input_uris(self, uris):
         if uris is None:
@@ -130,10 +371,25 @@ class SparqlQuery(object):
                     self.uris.append('<' + item + '>')
                 else:
                     self.uris.append(self.expand_prefix(item))
-            if len(self.uris) == 1:
+            while len(self.uris) < 2:
                 self.uris.append(None)
             #self.uris = ['<' + item + '>' for item in uris if "http" in item]
 
+    def _make_uri_values(self):
+        """ Set the URIs looked up in place of uris.0.
+
+        These are uris.0 and any URIs beyond those the query requires, e.g.
+        uris.0, uris.2, uris.3 ... where uris.1 is a property.
+        """
+        extra_uris = self.uris[max(self.number_of_uris_required, 1):]
+        # Leave out the documentation's {uri_1}, as expand_prefix keeps it.
+        self.uri_values = [uri for uri in self.uris[:1] if uri is not None]
+        self.uri_values += [uri for uri in extra_uris
+                            if uri is not None and not uri.startswith('{')]
+        if len(self.uri_values) > MAX_URI_VALUES:
+            raise QueryException("At most {0} URIs may be looked up at once"
+                                 .format(MAX_URI_VALUES))
+
     def expand_prefix(self, item):
         # This catches the documentation {uri_0} and {uri_1}
         if item.startswith('{'):
@@ -193,99 +449,633 @@ class SparqlQuery(object):
                                   "Insufficient_uris_supplied: {0}"
                                   .format(message)})
 
+    def _make_keyset_filter_block(self):
+        if self.cursor is None:
+            self.keyset_filter_block = ''
+            return
+        if self.cursor_key is None:
+            raise QueryException(
+                "Query {0} does not support cursor paging".format(self.url))
+        if len(self.uri_values) > 1:
+            # Rows for different URIs may share a key.
+            raise QueryException(
+                "Cursor paging is not supported with more than one URI")
+        try:
+            values = decode_cursor(self.cursor, len(self.cursor_key))
+        except ValueError as e:
+            raise QueryException(unicode(e))
+        # The cursor takes the place of OFFSET.
+        self.offset = 0
+        self.keyset_filter_block = make_keyset_filter(
+            [variable for _, variable in self.cursor_key], values)
+
+    @property
+    def supports_cursor(self):
+        return self.cursor_key is not None
+
+    def _make_next_cursor(self):
+        """ Return the cursor for the page after this one, if it may exist.
+        """
+        if (not self.supports_cursor or len(self.uri_values) > 1 or
+                self.partial or len(self.clean_json) < self.limit):
+            return None
+        last_row = self.clean_json[-1]
+        return encode_cursor([last_row.get(column, '')
+                              for column, _ in self.cursor_key])
+
+    def _block_prefixes(self):
+        """ Returns the prefixes used by the blocks substituted in queries.
+        """
+        return frozenset(used_prefixes(
+            (self.filter_block or '') + (self.uri_filter_block or '') +
+            (self.date_filter_block or '')))
+
     def _build_query(self):
         """ Returns a query string. """
         self._check_parameters()
+        if self.accepts_uri_values:
+            self._make_uri_values()
+        self._make_keyset_filter_block()
+        return self._format_query(self.offset, self.limit)
 
-        full_query = ("#NewsReader Simple API Query: " + self.url + "\n" +
-                      self.prefix_block +
-                      self.allowed_parameters_block +
-                      self.query_template)
-        query = full_query.format(offset=self.offset,
-                                  limit=self.limit,
-                                  output=self.output,
+    def _format_query(self, offset, limit):
+        """ Returns the query string for rows offset to offset + limit. """
+        full_query = compile_template(
+            "#NewsReader Simple API Query: " + self.url, self.query_template,
+            self._block_prefixes())
+        query = full_query.format(offset=offset,
+                                  limit=limit,
                                   filter_block=self.filter_block,
                                   date_filter_block=self.date_filter_block,
                                   uri_filter_block=self.uri_filter_block,
+                                  keyset_filter_block=self.keyset_filter_block,
+                                  uri_values=' '.join(self.uri_values),
                                   uri_0=self.uris[0],
                                   uri_1=self.uris[1]
                                   )
         return query
 
     def _build_count_query(self):
-        """ Returns a count query string. """
-        full_query = ("#NewsReader Simple API Counting Query: " + self.url
-                      + "\n" + self.prefix_block +
-                      self.allowed_parameters_block + self.count_template)
-        return full_query.format(offset=self.offset,
-                                 limit=self.limit,
-                                 output=self.output,
-                                 filter_block=self.filter_block,
+        """ Returns a count query string.
+
+        The string does not depend on the page requested, so that it can be
+        used to look up a cached count for any page of the query.
+        """
+        full_query = compile_template(
+            "#NewsReader Simple API Counting Query: " + self.url,
+            self.count_template, self._block_prefixes())
+        return full_query.format(filter_block=self.filter_block,
                                  date_filter_block=self.date_filter_block,
                                  uri_filter_block=self.uri_filter_block,
+                                 uri_values=' '.join(self.uri_values),
                                  uri_0=self.uris[0],
                                  uri_1=self.uris[1])
 
     def submit_query(self, username, password):
         """ Submit query to endpoint; return result. """
-        payload = {'query': self.query}
         logging.debug("\n\n**New query**")
         logging.debug(self.query)
-        if self.offset + self.limit >= 10000:
+        if self._submit_materialized():
+            return
+        if self._uses_snapshot():
+            self._submit_snapshot()
+            return
+        if self.offset + self.limit >= OFFSET_LIMIT:
             raise QueryException(
                 "OFFSET exceeds 10000, add filter or datefilter "
                 "to narrow results")
 
+        result_format = self._requested_result_format()
+        t0 = time.time()
+        query_text, start, pages, cached = self._choose_block(result_format)
+        self._add_timing('cache', t0)
+        if query_text != self.query:
+            self.block_query = query_text
+        cache_key = self._result_cache_key(result_format, query_text)
+        if cached is not None:
+            self.query_time = '0.00'
+            self.cache_status = 'hit'
+            print "From cache: True"
+            self._use_result(cached)
+        else:
+            # Identical queries in flight at the same time share one call.
+            t0 = time.time()
+            result, shared = self._single_flight(
+                cache_key,
+                functools.partial(self._fetch_and_cache, username, password,
+                                  result_format, cache_key, query_text,
+                                  pages),
+                shareable=lambda result: not result[1])
+            if shared:
+                self.query_time = '{0:.2f}'.format(time.time() - t0)
+                self.cache_status = 'shared'
+                print "Shared result of identical query"
+                self._use_result(result[0])
+        if query_text != self.query:
+            self._use_result(self.clean_json[start:start + self.limit])
+
+        if len(self.clean_json) == 0:
+            raise QueryException(
+                "Result empty, possibly as a result of paging "
+                "beyond results")
+        self.next_cursor = self._make_next_cursor()
+
+    def _materialized_snapshot(self):
+        """ Return the materialized snapshot to serve this query from, or
+        None to query the endpoint.
+        """
+        # Private endpoints are never materialized, so there is no snapshot
+        # to look for.
+        if not self.materialized or self.private_endpoint:
+            return None
+        return materialized_tables.snapshot(self.endpoint_stub_url, self.url)
+
+    def _submit_materialized(self):
+        """ Serve the page from the materialized snapshot; return whether
+        there was one to serve it.
+
+        A snapshot cut short by the OFFSET limit only serves the unfiltered
+        pages it holds.
+        """
+        snapshot = self._materialized_snapshot()
+        if snapshot is None:
+            return False
+        if not snapshot.complete and (self.filter != 'none' or
+                                      self.offset + self.limit >
+                                      snapshot.rows):
+            return False
+        self.snapshot_age = int(time.time() - snapshot.created)
+        t0 = time.time()
+        self._use_result(materialized_tables.page(
+            self.endpoint_stub_url, self.url, self.filter, self.offset,
+            self.limit))
+        self.query_time = '{0:.2f}'.format(time.time() - t0)
+        self.cache_status = 'materialized'
+        print "From materialized snapshot: True"
+        if len(self.clean_json) == 0:
+            raise QueryException(
+                "Result empty, possibly as a result of paging "
+                "beyond results")
+        return True
+
+    def _uses_snapshot(self):
+        return (self.backend == 'snapshot' and
+                self.snapshot_template is not None and
+                snapshot_store.has_snapshot(self.endpoint_stub_url))
+
+    def _snapshot_blocks(self):
+        """ Return (blocks, parameters) to complete snapshot_template.
+
+        The template refers to event_times as t and to the table of the
+        text the filter is matched against as f.
+        """
+        parameters = {}
+        for position, uri in enumerate(self.uris):
+            if uri is not None:
+                parameters['uri_{0}'.format(position)] = uri.strip('<>')
+        for position, uri in enumerate(self.uri_values):
+            parameters['uri_value_{0}'.format(position)] = uri.strip('<>')
+        blocks = {'uri_values': ', '.join(
+            ':uri_value_{0}'.format(position)
+            for position in range(len(self.uri_values)))}
+
+        date_filter_clause = ''
+        if self.datefilter != 'None':
+            parts = self.datefilter.split('-')
+            if len(parts) > 3 or not all(part.isdigit() for part in parts):
+                raise QueryException(
+                    "datefilter must be of the form YYYY, YYYY-MM or "
+                    "YYYY-MM-DD")
+            for name, part in zip(['year', 'month', 'day'], parts):
+                date_filter_clause += ' AND t.{0} = :{0}'.format(name)
+                parameters[name] = int(part)
+        blocks['date_filter_clause'] = date_filter_clause
+
+        condition, filter_parameters = filter_clause(self.filter, 'f.search')
+        blocks['filter_clause'] = 'AND ' + condition
+        parameters.update(filter_parameters)
+        return blocks, parameters
+
+    def _query_snapshot(self):
+        """ Return the rows of this page from the endpoint's snapshot. """
+        blocks, parameters = self._snapshot_blocks()
+        keyset_clause = ''
+        if self.cursor is not None:
+            values = decode_cursor(self.cursor, len(self.cursor_key))
+            keyset_clause = 'AND ({0}) > ({1})'.format(
+                ', '.join(column for column, _ in self.cursor_key),
+                ', '.join(':cursor_{0}'.format(position)
+                          for position in range(len(values))))
+            parameters.update(('cursor_{0}'.format(position), value)
+                              for position, value in enumerate(values))
+        parameters.update(offset=self.offset, limit=self.limit)
+        sql = ('SELECT * FROM ({0}) WHERE 1 {1} ORDER BY {2} '
+               'LIMIT :limit OFFSET :offset').format(
+                   self.snapshot_template.format(**blocks), keyset_clause,
+                   self.snapshot_order)
+        return snapshot_store.execute(self.endpoint_stub_url, sql, parameters)
+
+    def _query_snapshot_count(self):
+        """ Return the result count from the endpoint's snapshot. """
+        blocks, parameters = self._snapshot_blocks()
+        sql = 'SELECT COUNT(DISTINCT {0}) AS count FROM ({1})'.format(
+            self.snapshot_count_column,
+            self.snapshot_template.format(**blocks))
+        rows = snapshot_store.execute(self.endpoint_stub_url, sql, parameters)
+        return int(rows[0]['count'])
+
+    def _cooccurrence_index(self):
+        """ Return the actor/event index of the endpoint's snapshot, or None.
+        """
+        return get_cooccurrence_index(snapshot_store, self.endpoint_stub_url)
+
+    def _submit_snapshot(self):
+        """ Set clean_json from the endpoint's snapshot. """
         t0 = time.time()
         try:
-            response = requests.get(self.endpoint_stub_url.format(action='sparql'), 
-                                    auth=(username, password),
-                                    params=payload)
-        except Exception as e:
-            print "Query raised an exception"
-            print type(e)
-            t1 = time.time()
-            total = t1-t0
-            self.query_time = '{0:.2f}'.format(total)
-            print "Time to return from query: {0:.2f} seconds".format(total)
-            raise QueryException("Query raised an exception: {0}"
+            self._use_result(self._query_snapshot())
+        except SnapshotError as e:
+            raise QueryException(unicode(e))
+        self.query_time = '{0:.2f}'.format(time.time() - t0)
+        self.snapshot_age = snapshot_store.age(self.endpoint_stub_url)
+        self.cache_status = 'snapshot'
+        print "From snapshot: True"
+        if len(self.clean_json) == 0:
+            raise QueryException(
+                "Result empty, possibly as a result of paging "
+                "beyond results")
+        self.next_cursor = self._make_next_cursor()
+
+    def _count_snapshot(self):
+        t0 = time.time()
+        try:
+            count = self._query_snapshot_count()
+        except SnapshotError as e:
+            raise QueryException("Count query failed with exception: {0}"
+                                 .format(unicode(e)))
+        self.count_time = '{0:.2f}'.format(time.time() - t0)
+        return count
+
+    def _result_cache_key(self, result_format, query_text):
+        return ('sparql', self.endpoint_stub_url, result_format, query_text)
+
+    def _block_fetch_applies(self):
+        return (self.block_fetch and self.result_is_tabular and
+                self.cursor is None and
+                '{offset}' in (self.query_template or ''))
+
+    def _block_bounds(self, pages):
+        """ Return (offset, limit) of the block of pages holding this page,
+        or None if it would not hold all of it.
+        """
+        block_limit = pages * self.limit
+        block_offset = self.offset - self.offset % block_limit
+        block_limit = min(block_limit, OFFSET_LIMIT - 1 - block_offset)
+        if self.offset + self.limit > block_offset + block_limit:
+            return None
+        return block_offset, block_limit
+
+    def _choose_block(self, result_format):
+        """ Return (query text, offset of this page within its result,
+        pages fetched, cached result or None) for the query to run.
+
+        A cached block of any size holding this page is used if there is
+        one; otherwise the block size comes from block_sizer.
+        """
+        if not self._block_fetch_applies():
+            return (self.query, 0, 1, self._get_cached(
+                self._result_cache_key(result_format, self.query)))
+
+        candidates = [(pages, self._block_bounds(pages))
+                      for pages in block_sizer.block_sizes()]
+        candidates = [(pages, bounds) for pages, bounds in candidates
+                      if bounds is not None]
+        for pages, (block_offset, block_limit) in candidates:
+            query_text = self._format_query(block_offset, block_limit)
+            cached = self._get_cached(
+                self._result_cache_key(result_format, query_text))
+            if cached is not None:
+                return query_text, self.offset - block_offset, pages, cached
+        cached = self._get_cached(
+            self._result_cache_key(result_format, self.query))
+        if cached is not None:
+            return self.query, 0, 1, cached
+
+        wanted = block_sizer.pages(self.url)
+        for pages, (block_offset, block_limit) in candidates:
+            if pages <= wanted:
+                query_text = self._format_query(block_offset, block_limit)
+                return query_text, self.offset - block_offset, pages, None
+        return self.query, 0, 1, None
+
+    def _use_result(self, clean_json):
+        """ Use a result obtained by another query object. """
+        self.clean_json = clean_json
+        self.json_result = None if self.result_is_tabular else clean_json
+
+    def _fetch_and_cache(self, username, password, result_format, cache_key,
+                         query_text=None, pages=1):
+        """ Fetch and cache results, unless another worker has meanwhile.
+
+        Returns (clean_json, partial).
+        """
+        t0 = time.time()
+        cached = self._get_cached(cache_key)
+        self._add_timing('cache', t0)
+        if cached is not None:
+            self.query_time = '0.00'
+            self.cache_status = 'hit'
+            print "From cache: True"
+            self._use_result(cached)
+        else:
+            self.cache_status = 'miss'
+            t0 = time.time()
+            self._fetch_results(username, password, result_format, query_text)
+            if self._block_fetch_applies():
+                block_sizer.record(self.url, self.limit, len(self.clean_json),
+                                   time.time() - t0, self.response_bytes)
+            # A partial result would be served as if it were complete.
+            if not self.partial:
+                self._set_cached(cache_key, self.clean_json)
+        return self.clean_json, self.partial
+
+    def _fetch_results(self, username, password, result_format,
+                       query_text=None):
+        """ Submit query to endpoint and read the response.
+
+        Virtuoso is asked to stop at the deadline and return the rows it
+        has, as an anytime query; the request is abandoned soon after.
+        """
+        remaining = self.remaining_time()
+        if remaining <= 0:
+            raise self._deadline_exceeded()
+        payload = {'query': query_text or self.query,
+                   'timeout': int(remaining * 1000)}
+        headers = {'Accept': RESULT_FORMATS[result_format]}
+
+        t0 = time.time()
+        pool = get_session_pool(self.endpoint_stub_url)
+        # The session stays checked out while its streamed body is read.
+        with pool.session(username, password) as session:
+            try:
+                response = session.get(
+                    self.endpoint_stub_url.format(action='sparql'),
+                    params=payload, headers=headers, stream=True,
+                    timeout=(CONNECT_TIMEOUT, remaining + DEADLINE_GRACE))
+            except requests.Timeout:
+                self.query_time = '{0:.2f}'.format(time.time() - t0)
+                print "Query timed out"
+                raise self._deadline_exceeded()
+            except Exception as e:
+                print "Query raised an exception"
+                print type(e)
+                t1 = time.time()
+                total = t1-t0
+                self.query_time = '{0:.2f}'.format(total)
+                print "Time to return from query: {0:.2f} seconds".format(total)
+                raise QueryException("Query raised an exception: {0}"
+                                     .format(type(e).__name__))
+            try:
+                t1 = time.time()
+                total = t1-t0
+                self.query_time = '{0:.2f}'.format(total)
+                self.timings['upstream'] = total
+                print "Time to return from query: {0:.2f} seconds".format(total)
+                print "Response code: {0}".format(response.status_code)
+
+                if response and (response.status_code == requests.codes.ok):
+                    self.partial = (response.headers.get('X-SQL-State') ==
+                                    PARTIAL_RESULT_STATE)
+                    self._read_results(response, result_format)
+                else:
+                    raise QueryException("Response code not OK: {0}"
+                                         .format(response.status_code))
+            finally:
+                response.close()
+
+    def _get_cached(self, key):
+        """ Returns the result cached under key, or None. """
+        return result_cache.get(key, persist=not self.private_endpoint)
+
+    def _set_cached(self, key, value, ttl=None):
+        """ Caches a result under key for ttl, by default self.cache_ttl. """
+        if ttl is None:
+            ttl = self.cache_ttl
+        result_cache.set(key, value, ttl, persist=not self.private_endpoint)
+
+    def _count_cache_key(self):
+        return ('count', self.endpoint_stub_url, self._build_count_query())
+
+    def get_cached_count(self):
+        """ Returns cached result count for query, or None if not cached. """
+        t0 = time.time()
+        try:
+            return self._get_cached(self._count_cache_key())
+        finally:
+            self._add_timing('count_cache', t0)
+
+    def _add_timing(self, stage, t0):
+        """ Add the seconds since t0 to the timing of stage. """
+        self.timings[stage] = self.timings.get(stage, 0) + time.time() - t0
+
+    def _requested_result_format(self):
+        """ Returns the result format to ask the endpoint for.
+
+        Only results with rows can be written in the tabular formats.
+        """
+        if self.result_is_tabular and self.result_format in RESULT_FORMATS:
+            return self.result_format
+        return 'json'
+
+    def _read_results(self, response, result_format='json'):
+        """ Set clean_json from a response, parsing it as it is read.
+
+        The raw response is only kept if it is not a result set, e.g. a
+        DESCRIBE graph, to be parsed into json_result if that is asked for.
+        The json_result of a result set is made from its clean rows.
+        """
+        t0 = time.time()
+        stream = response.iter_content(RESULT_CHUNK_SIZE)
+        variables = []
+
+        def read():
+            for chunk in stream:
+                self.response_bytes += len(chunk)
+                if self._raw_chunks is not None:
+                    self._raw_chunks.append(chunk)
+                yield chunk
+
+        self.json_result = None
+        self._raw_chunks = []
+        self._raw_format = result_format
+        self.response_bytes = 0
+        self.clean_json = []
+        try:
+            for row in iter_clean_rows(read(), result_format, variables):
+                # The bindings were found, so this is a result set.
+                self._raw_chunks = None
+                self.clean_json.append(row)
+        except NoBindingsError:
+            if result_format != 'json':
+                # An empty body; there are no variables and no rows.
+                self.json_result = {"head": {"vars": []},
+                                    "results": {"bindings": []}}
+                return
+            # Not a result set, e.g. a DESCRIBE graph, so there are no rows.
+            self.clean_json = convert_raw_json_to_clean(self.json_result)
+        except ValueError as e:
+            self._raw_chunks = None
+            raise QueryException("Response could not be parsed: {0}"
                                  .format(type(e).__name__))
         else:
-            t1 = time.time()
-            total = t1-t0
-            self.query_time = '{0:.2f}'.format(total)
-            print "Time to return from query: {0:.2f} seconds".format(total)
-            print "Response code: {0}".format(response.status_code)
-            print "From cache: {0}".format(response.from_cache)
+            self._raw_chunks = None
+            self._result_variables = variables or None
+            # Read the rest of the document, which releases the connection.
+            for _ in read():
+                pass
+        finally:
+            # Reading overlaps with parsing, as the rows are parsed as
+            # they arrive.
+            self.timings['parse'] = time.time() - t0
 
-            if response and (response.status_code == requests.codes.ok):
-                self.json_result = json.loads(response.content)
-                self.clean_json = convert_raw_json_to_clean(self.json_result)
-                if len(self.clean_json) == 0:
-                    raise QueryException(
-                        "Result empty, possibly as a result of paging "
-                        "beyond results")
-            else:
-                raise QueryException("Response code not OK: {0}"
-                                     .format(response.status_code))
+    @property
+    def json_result(self):
+        """ The raw SPARQL JSON result, parsed on first use.
+
+        Results with rows give every value as a literal, as only their
+        clean rows are kept.
+        """
+        if self._json_result is None and self._raw_chunks is not None:
+            self._json_result = load_result(b''.join(self._raw_chunks),
+                                            self._raw_format)
+            self._raw_chunks = None
+        elif (self._json_result is None and self.clean_json is not None and
+              self.result_is_tabular):
+            self._json_result = rows_to_sparql_json(self.clean_json,
+                                                    self._result_variables)
+        return self._json_result
+
+    @json_result.setter
+    def json_result(self, value):
+        self._json_result = value
+        self._raw_chunks = None
+        self._result_variables = None
 
     def get_total_result_count(self, username, password):
-        """ Returns result count for query. """
-        count_query = CountQuery(self._build_count_query(), self.endpoint_stub_url)
-        count = count_query.get_count(username, password)
+        """ Returns result count for query, or None if it could not be
+        counted before the deadline.
+        """
+        t0 = time.time()
+        try:
+            return self._get_total_result_count(username, password)
+        except DeadlineExceeded:
+            print "Count query ran out of time"
+            return None
+        finally:
+            self.timings['count'] = time.time() - t0
+
+    def _get_total_result_count(self, username, password):
+        snapshot = self._materialized_snapshot()
+        if snapshot is not None and snapshot.complete:
+            self.snapshot_age = int(time.time() - snapshot.created)
+            self.count_time = '0.00'
+            self.count_cache_status = 'materialized'
+            return materialized_tables.count(self.endpoint_stub_url,
+                                             self.url, self.filter)
+        if self._uses_snapshot():
+            self.count_cache_status = 'snapshot'
+            return self._count_snapshot()
+        count = self.get_cached_count()
+        if count is not None:
+            self.count_time = '0.00'
+            self.count_cache_status = 'hit'
+            return count
+        t0 = time.time()
+        count, shared = self._single_flight(
+            self._count_cache_key(),
+            functools.partial(self._count_and_cache, username, password))
+        if shared:
+            self.count_time = '{0:.2f}'.format(time.time() - t0)
+            self.count_cache_status = 'shared'
+        return count
+
+    def _single_flight(self, key, function, shareable=None):
+        """ Return (value, shared) from single_flight.do(), waiting on an
+        identical call no later than the deadline.
+
+        A call that failed, perhaps on a shorter deadline than this
+        query's, or whose value is not shareable, is made again rather than
+        shared while time remains. Once the wait for another process's call runs out, function is
+        called, which finds its result in the cache or raises
+        DeadlineExceeded.
+        """
+        try:
+            return single_flight.do(
+                key, function, across_processes=not self.private_endpoint,
+                timeout=max(self.remaining_time(), 0), shareable=shareable)
+        except SingleFlightTimeout:
+            raise self._deadline_exceeded()
+
+    def _count_and_cache(self, username, password):
+        """ Count and cache results, unless another worker has meanwhile.
+        """
+        count = self.get_cached_count()
+        if count is not None:
+            self.count_time = '0.00'
+            self.count_cache_status = 'hit'
+            return count
+        self.count_cache_status = 'miss'
+        count_query = CountQuery(self._build_count_query(), self.endpoint_stub_url,
+                                 private_endpoint=self.private_endpoint)
+        count_query.deadline = self.deadline
+        try:
+            count = count_query.get_count(username, password)
+        finally:
+            self.count_response_bytes = count_query.response_bytes
+            if 'upstream' in count_query.timings:
+                self.timings['count_upstream'] = count_query.timings[
+                    'upstream']
         self.count_time = count_query.query_time
+        self._set_cached(self._count_cache_key(), count, COUNT_CACHE_TTL)
         return count
 
+    def submit_query_async(self, username, password):
+        """ Start submit_query() on the executor; return its pending result.
+
+        Call get() on the returned object to wait for the query to complete,
+        which raises any QueryException from the submission.
+        """
+        return get_executor().apply_async(self.submit_query,
+                                          (username, password))
+
+    def submit_query_and_count(self, username, password):
+        """ Submit query and count query concurrently; return count.
+
+        The count query runs on the shared executor while the main query runs
+        in this thread. A failure of the main query is raised in preference to
+        a failure of the count query, as when they were run one after another.
+        The count is None if it is not ready by the deadline.
+        """
+        pending_count = get_executor().apply_async(
+            self.get_total_result_count, (username, password))
+        self.submit_query(username, password)
+        try:
+            return pending_count.get(
+                timeout=max(self.remaining_time(), 0) + DEADLINE_GRACE)
+        except (PoolTimeoutError, GreenletTimeout):
+            print "Count query ran out of time"
+            return None
+
     def parse_query_results(self):
         # TODO: nicely parsed needs defining; may depend on query
         """ Returns nicely parsed result of query. """
         QueryResult = namedtuple('QueryResult', ' '.join(self.headers))
         # TODO: consider yielding results instead
         results = []
-        for result in self.json_result['results']['bindings']:
+        for result in self.clean_json:
             values = []
             for header in self.headers:
-                values.append(result.get(header, {}).get('value'))
+                values.append(result.get(header))
             next_entry = QueryResult._make(values)
             results.append(next_entry)
         return results
@@ -305,6 +1095,8 @@ class CountQuery(SparqlQuery):
         self.query_title = 'Count query'
         self.query_template = count_query
         self.endpoint_stub_url = endpoint_url
+        # The count itself is cached by the query being counted.
+        self.cache_ttl = 0
         self.query = self._build_query()
 
     def _build_query(self):
@@ -316,15 +1108,19 @@ class CountQuery(SparqlQuery):
         """ Parses and returns result from a count query. """
         try:
             self.submit_query(username, password)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             raise QueryException("Count query failed with exception: {0}"
                                  .format(type(e).__name__))
+        if self.partial:
+            # Only some of the matches were counted.
+            raise self._deadline_exceeded()
 
-        if self.json_result['results']['bindings'] == []:
+        if self.clean_json == []:
             return 0
         else:
-            return int(
-                self.json_result['results']['bindings'][0]['count']['value'])
+            return int(self.clean_json[0]['count'])
 
 
 class CRUDQuery(SparqlQuery):
@@ -337,11 +1133,13 @@ class CRUDQuery(SparqlQuery):
 
     def __init__(self, offset=0, limit=100, uris=None, output='json', 
                  endpoint_url=None, datefilter=None, callback=None, id=None,
-                 filter=None, **kwargs):
+                 filter=None, private_endpoint=False, **kwargs):
         super(CRUDQuery, self).__init__(**kwargs)
         self.query_title = 'CRUD query'
         self.query_template = "{uri_0}"
         self.endpoint_stub_url = endpoint_url
+        self.private_endpoint = private_endpoint
+        self.cache_ttl = DOCUMENT_CACHE_TTL
         self.original_uris = uris
         self.output = output
         self.callback = callback
@@ -370,10 +1168,27 @@ class CRUDQuery(SparqlQuery):
         query_url = endpoint_url + "?id=" + self.query
         print query_url
 
+        cache_key = ('crud', self.endpoint_stub_url, self.action, self.query)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            self.cache_status = 'hit'
+            print "From cache: True"
+            self.json_result = cached
+            self.clean_json = convert_raw_json_to_clean(self.json_result)
+            return
+
+        self.cache_status = 'miss'
+        remaining = self.remaining_time()
+        if remaining <= 0:
+            raise self._deadline_exceeded()
         t0 = time.time()
         try:
-            response = requests.get(query_url, auth=(username, password))
-
+            response = get_session_pool(self.endpoint_stub_url).get(
+                query_url, username, password,
+                timeout=(CONNECT_TIMEOUT, remaining))
+        except requests.Timeout:
+            print "Query timed out"
+            raise self._deadline_exceeded()
         except Exception as e:
             print "Query raised an exception"
             print type(e)
@@ -384,15 +1199,16 @@ class CRUDQuery(SparqlQuery):
         else:
             t1 = time.time()
             total = t1-t0
+            self.timings['upstream'] = total
             print "Time to return from query: {0:.2f} seconds".format(total)
             print "Response code: {0}".format(response.status_code)
-            print "From cache: {0}".format(response.from_cache)
 
             #print response.content
 
             if response and (response.status_code == requests.codes.ok):
                 self.json_result = json.loads(response.content)
                 self.clean_json = convert_raw_json_to_clean(self.json_result)
+                self._set_cached(cache_key, self.json_result)
             else:
                 raise QueryException("Response code not OK: {0}"
                                      .format(response.status_code))
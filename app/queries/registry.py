@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import importlib
+import threading
+from collections import OrderedDict
+
+# Cost classes, from cheapest to dearest upstream.
+COST_CRUD = 'crud'
+COST_PAGE = 'page'
+COST_AGGREGATE = 'aggregate'
+
+# Arguments with which a query is instantiated to read its metadata; the
+# same placeholders the documentation shows.
+METADATA_QUERY_ARGS = {"offset": 0, "limit": 100,
+                       "uris": ["{uri_0}", "{uri_1}"], "filter": '{string}',
+                       "datefilter": '{datefilter}', "output": 'html'}
+
+METADATA_ATTRIBUTES = ['query_title', 'description', 'url',
+                       'required_parameters', 'optional_parameters',
+                       'headers', 'number_of_uris_required',
+                       'result_is_tabular']
+
+
+class QueryRegistry(object):
+    """ Maps query names to the modules which define them.
+
+    A query's module is only imported when its class is first asked for,
+    so startup costs no more as queries are added. Each query is defined by
+    a class of the same name as its module.
+    """
+    def __init__(self, package):
+        self.package = package
+        self._modules = OrderedDict()
+        self._costs = {}
+        self._classes = {}
+        self._metadata = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, cost=COST_PAGE):
+        self._modules[name] = '.' + name
+        self._costs[name] = cost
+
+    def names(self):
+        """ Return the names of all registered queries, in order. """
+        return list(self._modules)
+
+    def __contains__(self, name):
+        return name in self._modules
+
+    def get_class(self, name):
+        """ Return the class of the query called name.
+
+        Raises KeyError if there is no such query.
+        """
+        query_class = self._classes.get(name)
+        if query_class is None:
+            module_name = self._modules[name]
+            with self._lock:
+                module = importlib.import_module(module_name, self.package)
+                query_class = getattr(module, name)
+                self._classes[name] = query_class
+        return query_class
+
+    def cost(self, name):
+        return self._costs[name]
+
+    def metadata(self, name):
+        """ Return a dict of the title, parameters, headers and cost class
+        of the query called name.
+        """
+        metadata = self._metadata.get(name)
+        if metadata is None:
+            query = self.get_class(name)(**METADATA_QUERY_ARGS)
+            metadata = dict((attribute, getattr(query, attribute))
+                            for attribute in METADATA_ATTRIBUTES)
+            metadata['cost'] = self._costs[name]
+            self._metadata[name] = metadata
+        return metadata
+
+
+registry = QueryRegistry(__name__.rpartition('.')[0])
+
+registry.register('properties_of_a_type', COST_AGGREGATE)
+registry.register('types_of_actors', COST_AGGREGATE)
+registry.register('actors_of_a_type')
+registry.register('property_of_actors_of_a_type')
+registry.register('property_of_an_actor')
+registry.register('event_details_filtered_by_actor')
+registry.register('describe_uri')
+registry.register('people_sharing_event_with_a_person')
+registry.register('summary_of_events_with_two_actors')
+registry.register('summary_of_events_with_actor')
+registry.register('summary_of_events_with_actor_type')
+registry.register('summary_of_events_with_event_label')
+registry.register('event_label_frequency_count', COST_AGGREGATE)
+registry.register('summary_of_events_with_framenet')
+registry.register('summary_of_events_with_eso')
+registry.register('framenet_frequency_count', COST_AGGREGATE)
+registry.register('eso_frequency_count', COST_AGGREGATE)
+registry.register('get_document_metadata', COST_CRUD)
+registry.register('get_mention_metadata', COST_CRUD)
+registry.register('get_document', COST_CRUD)
+registry.register('situation_graph')
+registry.register('event_precis')
+
+
+def get_query_class(name):
+    """ Return the class of the query called name; KeyError if unknown. """
+    return registry.get_class(name)
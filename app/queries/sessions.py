@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import os
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Sessions kept per KnowledgeStore endpoint, i.e. the number of requests a
+# worker process can have in flight to one endpoint at once.
+SESSION_POOL_SIZE = int(os.environ.get('NEWSREADER_SESSION_POOL_SIZE', 8))
+# Keep-alive connections each session holds open to the endpoint.
+CONNECTIONS_PER_SESSION = int(
+    os.environ.get('NEWSREADER_CONNECTIONS_PER_SESSION', 2))
+KEEP_ALIVE = os.environ.get('NEWSREADER_HTTP_KEEP_ALIVE', '1') != '0'
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+class SessionPool(object):
+    """ A pool of keep-alive HTTP sessions for one KnowledgeStore endpoint.
+
+    A session is checked out for the duration of each request, so sessions
+    are never shared between threads, while their connections (and so their
+    TLS sessions) are reused from one request to the next.
+    """
+    def __init__(self, endpoint_url, size=SESSION_POOL_SIZE,
+                 connections=CONNECTIONS_PER_SESSION, keep_alive=KEEP_ALIVE):
+        self.endpoint_url = endpoint_url
+        self.size = size
+        self.connections = connections
+        self.keep_alive = keep_alive
+
+        # LIFO, so the most recently used, warmest session is used first.
+        self._idle = Queue.LifoQueue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.reuses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.connections)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def _checkout(self):
+        try:
+            session = self._idle.get_nowait()
+        except Queue.Empty:
+            session = None
+
+        with self._lock:
+            self.checkouts += 1
+            if session is not None:
+                self.reuses += 1
+                return session
+            if len(self._sessions) < self.size:
+                session = self._new_session()
+                self._sessions.append(session)
+                return session
+
+        t0 = time.time()
+        session = self._idle.get()
+        with self._lock:
+            self.reuses += 1
+            self.waits += 1
+            self.wait_time += time.time() - t0
+        return session
+
+    @contextmanager
+    def session(self, username, password):
+        """ Check out a session authenticated with username and password. """
+        session = self._checkout()
+        try:
+            session.auth = (username, password)
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def get(self, url, username, password, **kwargs):
+        """ Make a GET request to url using a pooled session.
+
+        The session is returned to the pool as soon as this returns, so the
+        body must not be streamed; use session() for that, and read the
+        body within it.
+        """
+        if kwargs.get('stream'):
+            raise ValueError("Stream responses within session() instead")
+        with self.session(username, password) as session:
+            return session.get(url, **kwargs)
+
+    def stats(self):
+        """ Return a dict of usage statistics for this pool. """
+        new_connections = 0
+        requests_made = 0
+        with self._lock:
+            for session in self._sessions:
+                for adapter in session.adapters.values():
+                    for key in adapter.poolmanager.pools.keys():
+                        pool = adapter.poolmanager.pools.get(key)
+                        if pool is None:
+                            continue
+                        new_connections += pool.num_connections
+                        requests_made += pool.num_requests
+            return {"sessions": len(self._sessions),
+                    "checkouts": self.checkouts,
+                    "reuses": self.reuses,
+                    "waits": self.waits,
+                    "wait_time": round(self.wait_time, 4),
+                    "new_connections": new_connections,
+                    "requests": requests_made}
+
+
+def get_session_pool(endpoint_url):
+    """ Return the SessionPool for an endpoint, keyed by its stub URL.
+
+    Pools are per process: they are discarded after a fork, so gunicorn
+    workers never share sockets inherited from their parent.
+    """
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        pool = _pools.get(endpoint_url)
+        if pool is None:
+            pool = SessionPool(endpoint_url)
+            _pools[endpoint_url] = pool
+        return pool
+
+
+def session_pool_stats():
+    """ Return statistics for every endpoint pool in this process. """
+    with _pools_lock:
+        pools = dict(_pools)
+    return dict((url, pool.stats()) for url, pool in pools.iteritems())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Directory of lock files used to coalesce calls across worker processes.
+# Set to an empty string to coalesce within each process only.
+LOCK_DIR = os.environ.get('NEWSREADER_LOCK_DIR', '/tmp/newsreader_locks')
+# Seconds to wait for another process before making the call regardless.
+LOCK_TIMEOUT = float(os.environ.get('NEWSREADER_LOCK_TIMEOUT', 120))
+LOCK_POLL_INTERVAL = 0.05
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.shareable = False
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls made with the same key.
+
+    The first caller for a key makes the call; callers arriving while it is
+    in flight wait for it and share its value. If the call fails, or its
+    value is not shareable, waiters make the call again themselves, one of
+    them leading the rest as before. Across
+    processes the first caller holds a lock file for the key, so a call made
+    in another process waits for it and should then find its result in a
+    shared cache, which the function passed to do() is expected to check.
+    """
+    def __init__(self, lock_directory=LOCK_DIR, lock_timeout=LOCK_TIMEOUT):
+        self.lock_directory = lock_directory
+        self.lock_timeout = lock_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+        self.lock_waits = 0
+        self.retries = 0
+
+    def do(self, key, function, across_processes=True, timeout=None,
+           shareable=None):
+        """ Return (value, shared) from calling function, once per key.
+
+        shared is True if the value came from a call made by another
+        caller in this process. Only values from calls that succeeded, and
+        for which shareable(value) is true if given, are shared. A caller
+        waits at most timeout seconds in all for others' calls, raising
+        SingleFlightTimeout, and at most timeout seconds for another
+        process before making the call itself.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.calls += 1
+                    break
+                self.coalesced += 1
+
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            if not call.done.wait(remaining):
+                raise SingleFlightTimeout(
+                    "Timed out waiting for an identical call")
+            if call.shareable:
+                return call.value, True
+            self.retries += 1
+
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+        try:
+            if across_processes:
+                call.value = self._call_with_lock_file(key, function,
+                                                       timeout)
+            else:
+                call.value = function()
+            call.shareable = shareable is None or bool(shareable(call.value))
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def _call_with_lock_file(self, key, function, timeout=None):
+        lock_file = self._acquire_lock_file(key, timeout)
+        try:
+            return function()
+        finally:
+            if lock_file is not None:
+                self._release_lock_file(lock_file)
+
+    def _acquire_lock_file(self, key, timeout=None):
+        """ Return an open, locked file for key, or None if unavailable
+        within lock_timeout, or timeout if sooner.
+
+        The lock is polled rather than waited on, so that under gevent
+        other requests in this process keep running meanwhile.
+        """
+        if fcntl is None or not self.lock_directory:
+            return None
+        try:
+            os.makedirs(self.lock_directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return None
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        path = os.path.join(self.lock_directory, digest + '.lock')
+        try:
+            lock_file = open(path, 'a')
+        except IOError:
+            return None
+
+        lock_timeout = self.lock_timeout
+        if timeout is not None:
+            lock_timeout = min(lock_timeout, timeout)
+        deadline = time.time() + lock_timeout
+        waited = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock_file.close()
+                    return None
+                if time.time() > deadline:
+                    lock_file.close()
+                    return None
+                if not waited:
+                    waited = True
+                    self.lock_waits += 1
+                time.sleep(LOCK_POLL_INTERVAL)
+            else:
+                return lock_file
+
+    @staticmethod
+    def _release_lock_file(lock_file):
+        # Removing the file first means a process which opens it afresh
+        # may not wait for one still waiting on the old file; that costs a
+        # duplicate call, not a wrong result, and stops lock files piling up.
+        try:
+            os.remove(lock_file.name)
+        except OSError:
+            pass
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced,
+                "lock_waits": self.lock_waits, "retries": self.retries}
+
+
+single_flight = SingleFlight()
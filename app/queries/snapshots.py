@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Set to an empty string to disable the snapshot backend.
+SNAPSHOT_DIR = os.environ.get('NEWSREADER_SNAPSHOT_DIR',
+                              '/tmp/newsreader_snapshots')
+
+# Events and actors are numbered so that the relations between them are
+# compact; their URIs are looked up once per row returned.
+SCHEMA = """
+CREATE TABLE events (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    size INTEGER
+);
+CREATE TABLE actors (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE,
+    comment TEXT
+);
+CREATE TABLE event_times (
+    event INTEGER NOT NULL,
+    datetime TEXT NOT NULL,
+    year INTEGER,
+    month INTEGER,
+    day INTEGER
+);
+CREATE TABLE event_labels (
+    event INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    search TEXT NOT NULL
+);
+CREATE TABLE event_types (
+    event INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE TABLE event_actors (
+    event INTEGER NOT NULL,
+    actor INTEGER NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE TABLE actor_types (
+    actor INTEGER NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE TABLE actor_labels (
+    actor INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    search TEXT NOT NULL
+);
+"""
+
+# Created once the rows are loaded, which is much quicker than keeping
+# them up to date while loading.
+INDEXES = """
+CREATE INDEX event_times_event ON event_times (event);
+CREATE INDEX event_times_date ON event_times (year, month, day);
+CREATE INDEX event_labels_event ON event_labels (event);
+CREATE INDEX event_types_type ON event_types (type, event);
+CREATE INDEX event_actors_actor ON event_actors (actor, event);
+CREATE INDEX event_actors_event ON event_actors (event, actor);
+CREATE INDEX actor_types_type ON actor_types (type, actor);
+CREATE INDEX actor_types_actor ON actor_types (actor);
+CREATE INDEX actor_labels_actor ON actor_labels (actor);
+"""
+
+TABLE_COLUMNS = {'event_times': 5, 'event_labels': 3, 'event_types': 2,
+                 'event_actors': 3, 'actor_types': 2, 'actor_labels': 3}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotWriter(object):
+    """ Writes a new snapshot of an endpoint, which replaces the old one
+    when committed.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, self.temporary_path = tempfile.mkstemp(dir=directory,
+                                                   suffix='.sqlite')
+        os.close(fd)
+        self.connection = sqlite3.connect(self.temporary_path)
+        self.connection.executescript(SCHEMA)
+        self._events = {}
+        self._actors = {}
+
+    def event_id(self, uri, size=None):
+        """ Return the number of the event uri, adding it if new. """
+        event_id = self._events.get(uri)
+        if event_id is None:
+            event_id = self._events[uri] = len(self._events) + 1
+            self.connection.execute('INSERT INTO events VALUES (?, ?, ?)',
+                                    (event_id, uri, size))
+        elif size is not None:
+            self.connection.execute('UPDATE events SET size = ? WHERE id = ?',
+                                    (size, event_id))
+        return event_id
+
+    def actor_id(self, uri, comment=None):
+        """ Return the number of the actor uri, adding it if new. """
+        actor_id = self._actors.get(uri)
+        if actor_id is None:
+            actor_id = self._actors[uri] = len(self._actors) + 1
+            self.connection.execute(
+                'INSERT INTO actors VALUES (?, ?, ?)',
+                (actor_id, uri, comment))
+        elif comment is not None:
+            self.connection.execute(
+                'UPDATE actors SET comment = ? WHERE id = ?',
+                (comment, actor_id))
+        return actor_id
+
+    def add(self, table, values):
+        """ Add a row of values to one of the relations in TABLE_COLUMNS. """
+        self.connection.execute(
+            'INSERT INTO {0} VALUES ({1})'.format(
+                table, ', '.join(['?'] * TABLE_COLUMNS[table])), values)
+
+    def commit(self):
+        """ Index the snapshot and put it in place of the old one. """
+        self.connection.executescript(INDEXES)
+        self.connection.commit()
+        self.connection.execute('ANALYZE')
+        self.connection.close()
+        os.rename(self.temporary_path, self.path)
+
+    def abandon(self):
+        self.connection.close()
+        try:
+            os.remove(self.temporary_path)
+        except OSError:
+            pass
+
+
+class SnapshotStore(object):
+    """ Local copies of the events, actors, labels, times and types of
+    endpoints, one SQLite file per endpoint, made by ingest.py.
+
+    Queries with a snapshot_template are answered from these by
+    SparqlQuery when their endpoint's backend is 'snapshot'.
+    """
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        self._local = threading.local()
+
+    def path(self, endpoint_url):
+        digest = hashlib.sha1(endpoint_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.sqlite')
+
+    def has_snapshot(self, endpoint_url):
+        return bool(self.directory and endpoint_url and
+                    os.path.exists(self.path(endpoint_url)))
+
+    def age(self, endpoint_url):
+        """ Return the seconds since the snapshot of endpoint_url was made.
+        """
+        return int(time.time() - os.stat(self.path(endpoint_url)).st_mtime)
+
+    def _connect(self, endpoint_url):
+        """ Return this thread's connection to the snapshot of endpoint_url.
+
+        Connections are reopened when a new snapshot is put in place.
+        """
+        path = self.path(endpoint_url)
+        inode = os.stat(path).st_ino
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        entry = connections.get(path)
+        if entry is None or entry[0] != inode:
+            if entry is not None:
+                entry[1].close()
+            connection = sqlite3.connect(path)
+            connection.row_factory = sqlite3.Row
+            entry = connections[path] = (inode, connection)
+        return entry[1]
+
+    def execute(self, endpoint_url, sql, parameters):
+        """ Return the rows of a query of the snapshot as dicts of strings,
+        leaving out NULLs, as unbound variables are left out of results.
+        """
+        try:
+            cursor = self._connect(endpoint_url).execute(sql, parameters)
+            return [dict((key, unicode(row[key])) for key in row.keys()
+                         if row[key] is not None)
+                    for row in cursor]
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Snapshot query failed: %s", e)
+            raise SnapshotError("Snapshot query failed: {0}"
+                                .format(type(e).__name__))
+
+    def writer(self, endpoint_url):
+        return SnapshotWriter(self.path(endpoint_url))
+
+
+snapshot_store = SnapshotStore()
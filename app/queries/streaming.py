@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import unicode_literals
+
+import codecs
+import json
+import os
+import re
+
+import unicodecsv as csv
+
+# Bytes read from the response at a time.
+RESULT_CHUNK_SIZE = 64 * 1024
+
+# Media types requested for each result format. The tabular formats repeat
+# no per-cell type wrappers, so they are smaller and quicker to parse.
+RESULT_FORMATS = {
+    'json': 'application/sparql-results+json',
+    'tsv': 'text/tab-separated-values',
+    'csv': 'text/csv',
+}
+# Format requested for queries with tabular results, unless the query class
+# sets its own result_format.
+RESULT_FORMAT = os.environ.get('NEWSREADER_RESULT_FORMAT', 'json')
+
+TSV_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f',
+               '"': '"', "'": "'", '\\': '\\'}
+
+BINDINGS_START = re.compile(r'"bindings"\s*:\s*\[')
+VARS_START = re.compile(r'"vars"\s*:\s*\[')
+SEPARATORS = ' \t\r\n,'
+
+# Consumed text is dropped from the buffer once it grows beyond this.
+_TRIM_AT = 64 * 1024
+# Text kept from the end of a searched buffer, in case it ends part way
+# through BINDINGS_START.
+_SEARCH_OVERLAP = 64
+
+
+class NoBindingsError(ValueError):
+    """ Raised when a response is not a SPARQL SELECT result set. """
+    pass
+
+
+def iter_bindings(chunks, result_format='json', variables=None):
+    """ Yield each binding of a SPARQL result set in result_format.
+
+    If variables is a list, the result variables are appended to it.
+    """
+    if result_format == 'tsv':
+        return iter_tsv_bindings(chunks, variables)
+    elif result_format == 'csv':
+        return iter_csv_bindings(chunks, variables)
+    return iter_json_bindings(chunks, variables)
+
+
+def _read_variables(text, decoder):
+    """ Return the head.vars list in text, or None if it is not there. """
+    match = VARS_START.search(text)
+    if match is None:
+        return None
+    try:
+        names, _ = decoder.raw_decode(text, match.end() - 1)
+    except ValueError:
+        return None
+    return names
+
+
+def iter_json_bindings(chunks, variables=None):
+    """ Yield each binding of a SPARQL JSON result set as it is read.
+
+    chunks is an iterable of UTF-8 encoded byte strings, e.g. the output of
+    Response.iter_content(). Text is dropped once parsed, so at most about
+    _TRIM_AT characters, one chunk and the binding being read are held at a
+    time, whatever the size of the document. Raises NoBindingsError if the
+    document has no results.bindings array, as for DESCRIBE results, once
+    it has all been read. If variables is a list, the head.vars of the
+    result are appended to it.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+
+    def read_more():
+        for chunk in chunks:
+            text = text_decoder.decode(chunk)
+            if text:
+                return text
+        return None
+
+    # Find the start of the bindings array; what precedes it is the small
+    # "head" object. Only new text is searched, and a long document without
+    # bindings is not kept.
+    searched = 0
+    while True:
+        match = BINDINGS_START.search(buffer, searched)
+        if match:
+            position = match.end()
+            break
+        if len(buffer) > _TRIM_AT:
+            buffer = buffer[-_SEARCH_OVERLAP:]
+        searched = max(len(buffer) - _SEARCH_OVERLAP, 0)
+        more = read_more()
+        if more is None:
+            raise NoBindingsError("No results.bindings in SPARQL result")
+        buffer += more
+    if variables is not None:
+        variables.extend(_read_variables(buffer[:match.start()], decoder)
+                         or [])
+
+    while True:
+        while position < len(buffer) and buffer[position] in SEPARATORS:
+            position += 1
+        if position == len(buffer):
+            more = read_more()
+            if more is None:
+                raise ValueError("SPARQL result ended inside bindings")
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            binding, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # The binding is split across chunks.
+            more = read_more()
+            if more is None:
+                raise
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield binding
+        if position > _TRIM_AT:
+            buffer = buffer[position:]
+            position = 0
+
+
+def _iter_lines(chunks):
+    """ Yield the lines of a byte stream, each with its line ending. """
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+def _unescape_tsv(match):
+    escape = match.group(1)
+    if len(escape) > 1:
+        return unichr(int(escape[1:], 16))
+    return TSV_ESCAPES.get(escape, escape)
+
+
+def decode_tsv_term(term):
+    """ Return a SPARQL TSV RDF term as a SPARQL JSON binding value. """
+    if term.startswith('<') and term.endswith('>'):
+        return {'type': 'uri', 'value': term[1:-1]}
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    if term.startswith('"'):
+        end = term.rfind('"')
+        text = term[1:end]
+        if '\\' in text:
+            text = TSV_ESCAPE.sub(_unescape_tsv, text)
+        value = {'type': 'literal', 'value': text}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            value['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^<'):
+            value['type'] = 'typed-literal'
+            value['datatype'] = suffix[3:-1]
+        return value
+    # Numbers and booleans are written bare.
+    return {'type': 'typed-literal', 'value': term}
+
+
+def iter_tsv_bindings(chunks, variables=None):
+    """ Yield each binding of a SPARQL TSV result set as it is read.
+
+    If variables is a list, the result variables are appended to it.
+    """
+    lines = _iter_lines(chunks)
+    try:
+        header = next(lines).decode('utf-8').rstrip('\r\n')
+    except StopIteration:
+        raise NoBindingsError("Empty SPARQL TSV result")
+    names = [name.lstrip('?') for name in header.split('\t')]
+    if variables is not None:
+        variables.extend(names)
+
+    for line in lines:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            continue
+        binding = {}
+        for name, term in zip(names, line.split('\t')):
+            if term:
+                binding[name] = decode_tsv_term(term)
+        yield binding
+
+
+def iter_csv_bindings(chunks, variables=None):
+    """ Yield each binding of a SPARQL CSV result set as it is read.
+
+    CSV results carry no term types, so every value is given as a literal,
+    and an empty value is taken to be unbound. If variables is a list, the
+    result variables are appended to it.
+    """
+    reader = csv.reader(_iter_lines(chunks), encoding='utf-8')
+    try:
+        names = next(reader)
+    except StopIteration:
+        raise NoBindingsError("Empty SPARQL CSV result")
+    if variables is not None:
+        variables.extend(names)
+
+    for row in reader:
+        binding = {}
+        for name, value in zip(names, row):
+            if value != '':
+                binding[name] = {'type': 'literal', 'value': value}
+        yield binding
+
+
+def load_result(body, result_format='json'):
+    """ Return a whole SPARQL result in result_format as SPARQL JSON. """
+    if result_format == 'json':
+        return json.loads(body)
+    variables = []
+    if result_format == 'tsv':
+        bindings = list(iter_tsv_bindings([body], variables))
+    else:
+        bindings = list(iter_csv_bindings([body], variables))
+    return {"head": {"vars": variables},
+            "results": {"bindings": bindings}}
+
+
+def rows_to_sparql_json(rows, variables=None):
+    """ Return clean rows as SPARQL JSON, giving every value as a literal.
+
+    The variables are those of the rows, sorted, unless given.
+    """
+    if variables is None:
+        variables = sorted(set(key for row in rows for key in row))
+    bindings = [dict((key, {'type': 'literal', 'value': value})
+                     for key, value in row.iteritems()) for row in rows]
+    return {"head": {"vars": variables},
+            "results": {"bindings": bindings}}
+
+
+def clean_binding(binding):
+    """ Return a binding as a dict of variable name to value. """
+    return dict((key, value['value']) for key, value in binding.iteritems())
+
+
+def iter_clean_rows(chunks, result_format='json', variables=None):
+    """ Yield each binding of a SPARQL result set as a clean row. """
+    for binding in iter_bindings(chunks, result_format, variables):
+        yield clean_binding(binding)
@@ -14,38 +14,42 @@ class summary_of_events_with_actor(SparqlQuery):
         super(summary_of_events_with_actor, self).__init__(*args, **kwargs)
         self.query_title = 'Get events mentioning a named actor'
         self.description = ('A list of events mentioning a specified actor'
-          ', providing a link to the event and some summary information.')
+          ', providing a link to the event and some summary information.'
+          ' Further actors may be given as uris.1, uris.2 ...')
         self.url = 'summary_of_events_with_actor'
         self.world_cup_example = 'summary_of_events_with_actor?uris.0=dbpedia:Thierry_Henry'
         self.cars_example = 'summary_of_events_with_actor?uris.0=dbpedia:Alan_Mulally'
         self.ft_example = 'summary_of_events_with_actor?uris.0=dbpedianl:Rijkman_Groenink'
         self.wikinews_example = 'summary_of_events_with_actor?uris.0=dbpedia:Barack_Obama'
         self.query_template = ("""
-SELECT ?event (COUNT(*) AS ?event_size) ?datetime ?event_label
+SELECT ?event (COUNT(*) AS ?event_size) ?datetime ?event_label ?actor
 WHERE {{
   {{
-    SELECT DISTINCT ?event ?datetime ?event_label
+    SELECT DISTINCT ?event ?datetime ?event_label ?actor
     WHERE {{
-      ?event sem:hasActor|sem:hasPlace {uri_0} .
+      VALUES ?actor {{ {uri_values} }}
+      ?event sem:hasActor|sem:hasPlace ?actor .
       ?event rdfs:label ?event_label ; sem:hasTime ?t .
       ?t owltime:inDateTime ?d .
       {date_filter_block}
       ?d rdfs:label ?datetime .
+      {keyset_filter_block}
     }}
-    ORDER BY ?datetime
+    ORDER BY STR(?datetime) STR(?event) STR(?event_label) STR(?actor)
     OFFSET {offset}
     LIMIT {limit}
   }}
   ?event ?p ?o .
 }}
-GROUP BY ?event ?datetime ?event_label
-ORDER BY ?datetime
+GROUP BY ?event ?datetime ?event_label ?actor
+ORDER BY STR(?datetime) STR(?event) STR(?event_label) STR(?actor)
                                """)
 
         self.count_template = ("""
 SELECT (COUNT(DISTINCT ?event) as ?count)
 WHERE {{
-  ?event sem:hasActor|sem:hasPlace {uri_0} .
+  VALUES ?actor {{ {uri_values} }}
+  ?event sem:hasActor|sem:hasPlace ?actor .
   ?event rdfs:label ?event_label ; sem:hasTime ?t .
   ?t owltime:inDateTime ?d .
   {date_filter_block}
@@ -53,11 +57,28 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT DISTINCT e.uri AS event, e.size AS event_size, t.datetime AS datetime,
+       l.label AS event_label, a.uri AS actor
+FROM actors a
+JOIN event_actors ea ON ea.actor = a.id
+JOIN events e ON e.id = ea.event
+JOIN event_labels l ON l.event = e.id
+JOIN event_times t ON t.event = e.id
+WHERE a.uri IN ({uri_values}) {date_filter_clause}
+                                  """)
+        self.snapshot_order = 'datetime, event, event_label, actor'
+        self.snapshot_count_column = 'event'
+
         self.jinja_template = 'table.html'
-        self.headers = ['event', 'event_size', 'datetime', 'event_label']
+        self.cursor_key = [('datetime', 'datetime'), ('event', 'event'),
+                           ('event_label', 'event_label')]
+        self.headers = ['event', 'event_size', 'datetime', 'event_label',
+                        'actor']
 
         self.required_parameters = ["uris"]
-        self.optional_parameters = ["output", "datefilter"]
+        self.optional_parameters = ["output", "datefilter", "cursor"]
         self.number_of_uris_required = 1
+        self.accepts_uri_values = True
 
         self.query = self._build_query()
@@ -32,15 +32,16 @@ WHERE {{
       ?t owltime:inDateTime ?d .
       {date_filter_block}
       ?d rdfs:label ?datetime .
+      {keyset_filter_block}
     }}
-    ORDER BY ?datetime
+    ORDER BY STR(?datetime) STR(?event) STR(?actor)
     OFFSET {offset}
     LIMIT {limit}
   }}
   ?event ?p ?o .
 }}
 GROUP BY ?event ?datetime ?actor
-ORDER BY ?datetime
+ORDER BY STR(?datetime) STR(?event) STR(?actor)
                                """)
 
         self.count_template = ("""
@@ -55,11 +56,26 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT DISTINCT e.uri AS event, e.size AS event_size, t.datetime AS datetime,
+       a.uri AS actor
+FROM actor_types ty
+JOIN actors a ON a.id = ty.actor
+JOIN event_actors ea ON ea.actor = a.id
+JOIN events e ON e.id = ea.event
+JOIN event_times t ON t.event = e.id
+WHERE ty.type = :uri_0 {date_filter_clause}
+                                  """)
+        self.snapshot_order = 'datetime, event, actor'
+        self.snapshot_count_column = 'event'
+
         self.jinja_template = 'table.html'
+        self.cursor_key = [('datetime', 'datetime'), ('event', 'event'),
+                           ('actor', 'actor')]
         self.headers = ['event', 'event_size', 'datetime', 'actor']
 
         self.required_parameters = ["uris"]
-        self.optional_parameters = ["output", "datefilter"]
+        self.optional_parameters = ["output", "datefilter", "cursor"]
         self.number_of_uris_required = 1
 
         self.query = self._build_query()
@@ -28,15 +28,16 @@ WHERE {{
       ?t owltime:inDateTime ?d .
       {date_filter_block}
       ?d rdfs:label ?datetime .
+      {keyset_filter_block}
     }}
-    ORDER BY ?datetime
+    ORDER BY STR(?datetime) STR(?event) STR(?filterfield)
     OFFSET {offset}
     LIMIT {limit}
   }}
   ?event ?p ?o
 }}
 GROUP BY ?event ?datetime ?event_label
-ORDER BY ?datetime
+ORDER BY STR(?datetime) STR(?event) STR(?event_label)
                                """)
 
         self.count_template = ("""
@@ -50,11 +51,24 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT DISTINCT e.uri AS event, t.datetime AS datetime,
+       f.label AS event_label, e.size AS event_size
+FROM event_labels f
+JOIN events e ON e.id = f.event
+JOIN event_times t ON t.event = e.id
+WHERE 1 {filter_clause} {date_filter_clause}
+                                  """)
+        self.snapshot_order = 'datetime, event, event_label'
+        self.snapshot_count_column = 'event'
+
         self.jinja_template = 'table.html'
+        self.cursor_key = [('datetime', 'datetime'), ('event', 'event'),
+                           ('event_label', 'filterfield')]
         self.headers = ['event', 'datetime', 'event_label','event_size']
 
         self.required_parameters = ["filter"]
-        self.optional_parameters = ["output", "datefilter"]
+        self.optional_parameters = ["output", "datefilter", "cursor"]
         self.number_of_uris_required = 0
 
         self.query = self._build_query()
@@ -31,15 +31,16 @@ WHERE {{
       ?t owltime:inDateTime ?d .
       {date_filter_block}
       ?d rdfs:label ?datetime .
+      {keyset_filter_block}
     }}
-    ORDER BY ?datetime
+    ORDER BY STR(?datetime) STR(?event) STR(?filterfield)
     OFFSET {offset}
     LIMIT {limit}
   }}
   ?event ?p ?o .
 }}
 GROUP BY ?event ?datetime ?filterfield
-ORDER BY ?datetime
+ORDER BY STR(?datetime) STR(?event) STR(?filterfield)
                                """)
 
         self.count_template = ("""
@@ -56,11 +57,25 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT DISTINCT e.uri AS event, t.datetime AS datetime,
+       f.label AS event_label, e.size AS event_size
+FROM event_types ty
+JOIN events e ON e.id = ty.event
+JOIN event_labels f ON f.event = e.id
+JOIN event_times t ON t.event = e.id
+WHERE ty.type = :uri_0 {filter_clause} {date_filter_clause}
+                                  """)
+        self.snapshot_order = 'datetime, event, event_label'
+        self.snapshot_count_column = 'event'
+
         self.jinja_template = 'table.html'
+        self.cursor_key = [('datetime', 'datetime'), ('event', 'event'),
+                           ('event_label', 'filterfield')]
         self.headers = ['event', 'datetime', 'event_label', 'event_size']
 
         self.required_parameters = ["uris"]
-        self.optional_parameters = ["output", "datefilter", "filter"]
+        self.optional_parameters = ["output", "datefilter", "filter", "cursor"]
         self.number_of_uris_required = 1
 
         self.query = self._build_query()
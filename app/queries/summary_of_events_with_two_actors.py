@@ -32,15 +32,16 @@ WHERE {{
       ?t owltime:inDateTime ?d .
       {date_filter_block}
       ?d rdfs:label ?datetime .
+      {keyset_filter_block}
     }}
-    ORDER BY ?datetime
+    ORDER BY STR(?datetime) STR(?event) STR(?event_label)
     OFFSET {offset}
     LIMIT {limit}
   }}
   ?event ?p ?o
 }}
 GROUP BY ?event ?datetime ?event_label
-ORDER BY ?datetime
+ORDER BY STR(?datetime) STR(?event) STR(?event_label)
                                """)
 
         self.count_template = ("""
@@ -55,11 +56,28 @@ WHERE {{
 }}
                                """)
 
+        self.snapshot_template = ("""
+SELECT DISTINCT e.uri AS event, e.size AS event_size, t.datetime AS datetime,
+       l.label AS event_label
+FROM actors a0
+JOIN event_actors ea0 ON ea0.actor = a0.id AND ea0.role = 'actor'
+JOIN event_actors ea1 ON ea1.event = ea0.event AND ea1.role = 'actor'
+JOIN actors a1 ON a1.id = ea1.actor
+JOIN events e ON e.id = ea0.event
+JOIN event_labels l ON l.event = e.id
+JOIN event_times t ON t.event = e.id
+WHERE a0.uri = :uri_0 AND a1.uri = :uri_1 {date_filter_clause}
+                                  """)
+        self.snapshot_order = 'datetime, event, event_label'
+        self.snapshot_count_column = 'event'
+
         self.jinja_template = 'table.html'
+        self.cursor_key = [('datetime', 'datetime'), ('event', 'event'),
+                           ('event_label', 'event_label')]
         self.headers = ['event', 'event_size', 'datetime', 'event_label']
 
         self.required_parameters = ["uris"]
-        self.optional_parameters = ["output", "datefilter"]
+        self.optional_parameters = ["output", "datefilter", "cursor"]
         self.number_of_uris_required = 2
 
         self.query = self._build_query()
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 from queries import SparqlQuery
+from cache import FREQUENCY_CACHE_TTL
 
 class types_of_actors(SparqlQuery):
 
@@ -68,6 +69,8 @@ WHERE {{
                                 """)
 
         self.jinja_template = 'table.html'
+        self.cache_ttl = FREQUENCY_CACHE_TTL
+        self.materialized = True
         self.headers = ['type', 'count']
         self.required_parameters = []
         self.optional_parameters = ["output", "filter"]
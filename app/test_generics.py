@@ -7,13 +7,43 @@ import unittest
 from nose.tools import assert_equal
 
 from app import app
+from app.queries.cache import result_cache
 
+import json
 import os
 import mock
 from mock import patch
 import requests
 from requests import ConnectionError
 
+ACTOR_BINDINGS = [{"actor": {"type": "uri",
+                              "value": "http://example.org/a"}}] * 20
+
+
+def fake_endpoint(page_bindings, count=None):
+    """ Return a stand-in for requests.Session.get which answers page
+    queries with page_bindings, and count queries with count, or times out
+    on them if count is None.
+    """
+    def get(url, **kwargs):
+        if 'Counting Query' in kwargs['params']['query']:
+            if count is None:
+                raise requests.Timeout
+            bindings = [{"count": {"type": "literal",
+                                   "value": unicode(count)}}]
+        else:
+            bindings = page_bindings
+        fake_response = mock.Mock()
+        fake_response.status_code = 200
+        fake_response.headers = {}
+        fake_response.iter_content.return_value = iter([json.dumps(
+            {"head": {"vars": sorted(set(name for binding in bindings
+                                         for name in binding))},
+             "results": {"bindings": bindings}})])
+        return fake_response
+    return get
+
+
 class SimpleAPIGenericTests(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -24,7 +54,37 @@ class SimpleAPIGenericTests(unittest.TestCase):
     def test_root(self):
         rv = self.app.get('/')
         assert '<h2>NewsReader Simple API: Endpoints available at this location</h2>' in rv.data
-        
+
+    def test_root_substitutes_api_key(self):
+        rv = self.app.get('/wikinews?api_key=a<b')
+        assert 'api_key=a&lt;b' in rv.data.decode('UTF-8')
+        rv = self.app.get('/wikinews?output=json&api_key=a"b')
+        assert 'api_key=a\\"b' in rv.data.decode('UTF-8')
+        rv = self.app.get('/wikinews')
+        assert 'api_key=&lt;YOUR_API_KEY&gt;' in rv.data.decode('UTF-8')
+
+    def test_root_not_modified(self):
+        rv = self.app.get('/cars?api_key=abc')
+        etag = rv.headers['ETag']
+        rv = self.app.get('/cars?api_key=abc',
+                          headers={'If-None-Match': etag})
+        assert_equal(rv.status_code, 304)
+        rv = self.app.get('/cars?api_key=xyz',
+                          headers={'If-None-Match': etag})
+        assert_equal(rv.status_code, 200)
+
+    def test_root_other_outputs_get_the_html_page(self):
+        from app.views import _index_pages
+        for output in ['csv', 'nonsense', '{"a":1}']:
+            rv = self.app.get('/cars?output=' + output)
+            assert_equal(rv.status_code, 200)
+            assert_equal(rv.headers['Content-type'],
+                         'text/html; charset=utf-8')
+        rv = self.app.get('/cars?output.a=1')
+        assert_equal(rv.status_code, 200)
+        assert_equal(set(key[3] for key in _index_pages),
+                     set(['html', 'json']))
+
     def test_visit_a_non_existent_page(self):
         rv = self.app.get('/properties_of_a_type/page/14?uris.0=dbo%3AStadium' + self.api_key_query_string)
         print rv.data
@@ -41,22 +101,166 @@ class SimpleAPIGenericTests(unittest.TestCase):
         assert_equal(rv.data[-2:],");")
 
     def test_handles_connection_error(self):
-        with patch.object(requests, 'get') as mock_method:
+        with patch.object(requests.Session, 'get') as mock_method:
             mock_method.side_effect = ConnectionError
             rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=david&callback=mycallback' + self.api_key_query_string)
             assert_equal(rv.data, 'mycallback(Query raised an exception: ConnectionError);')
             #print rv.error_message
 
+    def test_count_is_null_when_it_runs_out_of_time(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = fake_endpoint(ACTOR_BINDINGS)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=deadline&output=json' + self.api_key_query_string)
+        output = json.loads(rv.data)
+        assert_equal(output['count'], None)
+        assert_equal(len(output['payload']), 20)
+        assert 'next page' in output
+
+    def test_metrics_are_served_in_prometheus_text_format(self):
+        rv = self.app.get('/metrics')
+        assert_equal(rv.status_code, 200)
+        assert rv.headers['Content-type'].startswith('text/plain')
+        assert '# TYPE newsreader_upstream_seconds histogram' in rv.data
+
+    def test_profile_needs_an_admin_api_key(self):
+        rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&profile=1' + self.api_key_query_string)
+        assert_equal(rv.status_code, 403)
+
+    def test_profile_reports_where_the_time_went(self):
+        result_cache.clear()
+        with patch.object(requests.Session, 'get') as mock_method, \
+                patch.dict(os.environ, {'NEWSREADER_ADMIN_API_KEY': 'admin',
+                                        'NEWSREADER_PUBLIC_API_KEY': 'admin'}):
+            mock_method.side_effect = fake_endpoint(ACTOR_BINDINGS, 20)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=profiled&output=json&profile=1&api_key=admin')
+        report = json.loads(rv.data)
+        assert_equal(report['query'], 'actors_of_a_type')
+        assert report['wall_seconds'] > 0
+        assert report['wait_seconds'] >= 0
+        assert 'upstream' in report['timings']
+        assert any('execute_query' in entry['function']
+                   for entry in report['top_functions'])
+
+    def test_explain_describes_the_page_and_count_queries(self):
+        result_cache.clear()
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = fake_endpoint(ACTOR_BINDINGS, 20)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=explained&explain=1' + self.api_key_query_string)
+        output = json.loads(rv.data)
+        assert 'bif:contains "explained"' in output['page query']['sparql']
+        assert_equal(output['page query']['cache'], 'miss')
+        assert output['page query']['upstream bytes'] > 0
+        assert 'Counting Query' in output['count query']['sparql']
+        assert_equal(output['count'], 20)
+        assert 'upstream' in output['timings']
+        assert 'upstream;desc="Upstream page query";dur=' in rv.headers['Server-Timing']
+
+    def test_csv_output_is_streamed_in_header_order(self):
+        result_cache.clear()
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = fake_endpoint(
+                [{"count": {"type": "literal", "value": "3"},
+                  "actor": {"type": "uri",
+                            "value": "http://example.org/a,b"}}] * 2, 2)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=streamed&output=csv' + self.api_key_query_string)
+        assert rv.is_streamed
+        assert_equal(rv.data.splitlines(),
+                     ['actor,count,comment', '"http://example.org/a,b",3,',
+                      '"http://example.org/a,b",3,'])
+        assert 'upstream' in rv.headers['Server-Timing']
+        assert 'render' not in rv.headers['Server-Timing']
+
+    def test_csv_output_leaves_out_values_without_a_header(self):
+        result_cache.clear()
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = fake_endpoint(
+                [{"count": {"type": "literal", "value": "3"},
+                  "actor": {"type": "uri", "value": "http://example.org/a"},
+                  "extra": {"type": "literal", "value": "x"}}], 1)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=extra&output=csv' + self.api_key_query_string)
+        assert_equal(rv.status_code, 200)
+        assert_equal(rv.data.splitlines(),
+                     ['actor,count,comment', 'http://example.org/a,3,'])
+
+    def test_profile_of_csv_output_covers_writing_it(self):
+        result_cache.clear()
+        with patch.object(requests.Session, 'get') as mock_method, \
+                patch.dict(os.environ, {'NEWSREADER_ADMIN_API_KEY': 'admin',
+                                        'NEWSREADER_PUBLIC_API_KEY': 'admin'}):
+            mock_method.side_effect = fake_endpoint(ACTOR_BINDINGS, 20)
+            rv = self.app.get('/actors_of_a_type?uris.0=dbo:Person&filter=profiled_csv&output=csv&profile=1&api_key=admin')
+        report = json.loads(rv.data)
+        assert report['response_bytes'] > len('actor,count,comment')
+        assert 'render' in report['timings']
+        assert any('iter_csv_rows' in entry['function']
+                   for entry in report['top_functions'])
+
     def test_query_does_not_exist(self):
         rv = self.app.get('/bogus_query?uris.0=dbo:Person&filter=david&output=json' + self.api_key_query_string)
         assert_equal(rv.data, '{"error": "Query **bogus_query** does not exist"}')
 
+    def test_export_rejects_unknown_format(self):
+        rv = self.app.get('/actors_of_a_type/export?uris.0=dbo:Person&format=xml' + self.api_key_query_string)
+        assert_equal(rv.data, '{"error": "format must be one of: csv, ndjson"}')
+
+    def test_export_reports_an_unexpected_failure_on_its_last_line(self):
+        def rows(exporter):
+            yield {"actor": "http://example.org/a"}
+            raise ValueError('unexpected')
+        with patch('app.views.QueryExporter.__iter__', rows):
+            rv = self.app.get('/actors_of_a_type/export?uris.0=dbo:Person' + self.api_key_query_string)
+            lines = rv.data.splitlines()
+        assert_equal(json.loads(lines[0]), {"actor": "http://example.org/a"})
+        assert_equal(json.loads(lines[-1]), {"error": "Export failed"})
+
+    def test_batch_reports_errors_per_query(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = ConnectionError
+            rv = self.app.post('/batch?' + self.api_key_query_string,
+                               data=json.dumps([
+                                   {"id": "a", "query": "actors_of_a_type",
+                                    "uris": ["dbo:Person"]},
+                                   {"query": "bogus_query"}]))
+        results = json.loads(rv.data)['results']
+        assert_equal(sorted(results), ['1', 'a'])
+        assert_equal(results['a']['error'],
+                     'Query raised an exception: ConnectionError')
+        assert_equal(results['1']['error'],
+                     'Query **bogus_query** does not exist')
+
+    def test_batch_rejects_pages_before_the_first(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            rv = self.app.post('/batch?' + self.api_key_query_string,
+                               data=json.dumps([
+                                   {"query": "actors_of_a_type", "page": 0,
+                                    "uris": ["dbo:Person"]}]))
+        assert_equal(json.loads(rv.data)['results']['0']['error'],
+                     'page must be 1 or more')
+        assert_equal(mock_method.call_count, 0)
+
+    def test_batch_runs_on_the_bulk_pool(self):
+        from app.queries.queries import get_bulk_executor, get_executor
+        assert get_bulk_executor() is not get_executor()
+        with patch.object(get_executor(), 'apply_async') as apply_async:
+            with patch.object(requests.Session, 'get') as mock_method:
+                mock_method.side_effect = ConnectionError
+                self.app.post('/batch?' + self.api_key_query_string,
+                              data=json.dumps([
+                                  {"query": "actors_of_a_type",
+                                   "uris": ["dbo:Person"]}]))
+        assert_equal(apply_async.call_count, 0)
+
+    def test_batch_rejects_a_body_which_is_not_a_list(self):
+        rv = self.app.post('/batch?' + self.api_key_query_string,
+                           data='{"query": "actors_of_a_type"}')
+        assert_equal(rv.status_code, 400)
+
     def test_cors_header(self):
         rv = self.app.get('/describe_uri?uris.0=dbpedia:Guangzhou_Evergrande_F.C.&output=json' + self.api_key_query_string)
         assert_equal(rv.headers['Access-Control-Allow-Origin'], '*')
 
     def test_handles_not_ok_response(self):
-        with patch.object(requests, 'get') as mock_method:
+        with patch.object(requests.Session, 'get') as mock_method:
             fake_response = mock.Mock()
             fake_response.status_code = 404
             mock_method.return_value = fake_response
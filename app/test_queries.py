@@ -2,12 +2,32 @@
 # encoding: utf-8
 
 from __future__ import unicode_literals
+import json
+import os
+import threading
 import unittest
 
+import mock
 from mock import patch
 import requests
 from requests import ConnectionError
 import queries
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from queries.blocks import BlockSizer
+from queries.cache import DiskTier, MemoryTier, TieredCache, result_cache
+from queries.cursors import decode_cursor, encode_cursor
+from queries.export import QueryExporter, split_datefilter
+from queries.ingest import ingest_endpoint
+from queries.materialized import MaterializedTables, refresh_endpoint
+from queries.metrics import Metrics
+from queries.snapshots import SnapshotStore
+from queries.sessions import SessionPool, get_session_pool
+from queries.singleflight import SingleFlight, SingleFlightTimeout
+from queries.streaming import NoBindingsError, iter_clean_rows, load_result
 
 from nose.tools import assert_equal, assert_is_instance, assert_raises
 
@@ -44,8 +64,1064 @@ class SparqlQuerySetupTestCase(unittest.TestCase):
 
 class SparqlQuerySubmitQueryTestCase(unittest.TestCase):
     def test_response_to_connection_error(self):
-        with patch.object(requests, 'get') as mock_method:
+        with patch.object(requests.Session, 'get') as mock_method:
             with assert_raises(queries.QueryException) as qe:
                 mock_method.side_effect = ConnectionError
                 self.query = queries.SparqlQuery()
                 self.query.submit_query('mock_username', 'mock_password')
+
+
+class SparqlQuerySubmitQueryAndCountTestCase(unittest.TestCase):
+    def test_returns_count_from_concurrent_count_query(self):
+        with patch.object(queries.SparqlQuery, 'submit_query'):
+            with patch.object(queries.SparqlQuery,
+                              'get_total_result_count') as mock_count:
+                mock_count.return_value = 42
+                query = queries.SparqlQuery()
+                count = query.submit_query_and_count('mock_username',
+                                                     'mock_password')
+        assert_equal(42, count)
+
+    def test_main_query_failure_takes_precedence(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = ConnectionError
+            query = queries.SparqlQuery(
+                endpoint_url='https://example.org/nwr/test/{action}')
+            query.query = 'SELECT'
+            with assert_raises(queries.QueryException) as qe:
+                query.submit_query_and_count('mock_username', 'mock_password')
+        assert_equal('Query raised an exception: ConnectionError',
+                     qe.exception.message)
+
+    def test_submit_query_async_raises_on_get(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = ConnectionError
+            query = queries.SparqlQuery(
+                endpoint_url='https://example.org/nwr/test/{action}')
+            query.query = 'SELECT'
+            pending = query.submit_query_async('mock_username',
+                                               'mock_password')
+            with assert_raises(queries.QueryException):
+                pending.get()
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    def test_pool_is_shared_per_endpoint(self):
+        url = 'https://example.org/nwr/test/{action}'
+        assert get_session_pool(url) is get_session_pool(url)
+
+    def test_sessions_are_reused(self):
+        pool = SessionPool('https://example.org/nwr/test/{action}')
+        with patch.object(requests.Session, 'get'):
+            pool.get('https://example.org/nwr/test/sparql', 'user', 'pass')
+            pool.get('https://example.org/nwr/test/sparql', 'user', 'pass')
+        stats = pool.stats()
+        assert_equal(1, stats['sessions'])
+        assert_equal(2, stats['checkouts'])
+        assert_equal(1, stats['reuses'])
+
+    def test_session_is_held_while_a_streamed_result_is_read(self):
+        url = 'https://example.org/nwr/held-session/{action}'
+        pool = get_session_pool(url)
+        idle_while_reading = []
+
+        def chunks(size):
+            idle_while_reading.append(pool._idle.qsize())
+            yield json.dumps({"head": {"vars": ["count"]},
+                              "results": {"bindings": []}})
+        with patch.object(requests.Session, 'get') as mock_method:
+            fake_response = mock.Mock()
+            fake_response.status_code = 200
+            fake_response.headers = {}
+            fake_response.iter_content.side_effect = chunks
+            mock_method.return_value = fake_response
+            query = queries.SparqlQuery(endpoint_url=url)
+            query.query = 'SELECT'
+            query._fetch_results('mock_username', 'mock_password', 'json')
+        assert_equal([0], idle_while_reading)
+        assert_equal(1, pool._idle.qsize())
+        assert fake_response.close.called
+
+
+class CountCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        result_cache.clear()
+
+    def make_query(self, offset):
+        return queries.get_query_class("summary_of_events_with_actor")(
+            offset=offset, limit=20, uris=['dbpedia:Alan_Mulally'],
+            endpoint_url='https://example.org/nwr/test/{action}')
+
+    def test_count_query_is_the_same_for_every_page(self):
+        assert_equal(self.make_query(0)._build_count_query(),
+                     self.make_query(40)._build_count_query())
+
+    def test_cached_count_is_used_for_other_pages(self):
+        with patch.object(queries.queries.CountQuery, 'get_count') as mock_count:
+            mock_count.return_value = 55
+            assert_equal(55, self.make_query(0).get_total_result_count(
+                'mock_username', 'mock_password'))
+            query = self.make_query(40)
+            assert_equal(55, query.get_cached_count())
+            assert_equal(55, query.get_total_result_count(
+                'mock_username', 'mock_password'))
+        assert_equal(1, mock_count.call_count)
+
+    def test_count_is_cached_for_the_count_ttl(self):
+        query = self.make_query(0)
+        with patch.object(queries.queries.CountQuery, 'get_count') as mock_count:
+            mock_count.return_value = 55
+            with patch.object(queries.queries, 'COUNT_CACHE_TTL', 0):
+                query.get_total_result_count('mock_username', 'mock_password')
+        assert_equal(None, query.get_cached_count())
+
+
+class TieredCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_expire(self):
+        tier = MemoryTier(max_bytes=1024)
+        tier.set('key', 1, b'x', time.time() - 1)
+        assert_equal(None, tier.get('key'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        tier = MemoryTier(max_bytes=2)
+        expires = time.time() + 60
+        tier.set('a', 1, b'x', expires)
+        tier.set('b', 2, b'x', expires)
+        tier.get('a')
+        tier.set('c', 3, b'x', expires)
+        assert_equal(None, tier.get('b'))
+        assert_equal((expires, 1), tier.get('a'))
+        assert_equal(1, tier.stats()['evictions'])
+
+    def test_disk_entries_are_promoted_to_memory(self):
+        memory = MemoryTier(max_bytes=1024)
+        cache = TieredCache([memory, DiskTier(self.directory, 1024)])
+        cache.set(('sparql', 'query'), [{'a': 'b'}], ttl=60)
+        memory.clear()
+        assert_equal([{'a': 'b'}], cache.get(('sparql', 'query')))
+        assert_equal(2, memory.stats()['sets'])
+        assert_equal([{'a': 'b'}], cache.get(('sparql', 'query')))
+        assert_equal(1, memory.stats()['hits'])
+
+    def test_private_entries_are_not_written_to_disk(self):
+        disk = DiskTier(self.directory, 1024)
+        cache = TieredCache([MemoryTier(max_bytes=1024), disk])
+        cache.set('private', 1, ttl=60, persist=False)
+        assert_equal(1, cache.get('private', persist=False))
+        assert_equal([], os.listdir(self.directory))
+
+    def test_disk_tier_is_size_bounded(self):
+        disk = DiskTier(self.directory, max_bytes=2000)
+        cache = TieredCache([disk])
+        for i in range(20):
+            cache.set(i, 'x' * 500, ttl=60)
+        total = sum(os.path.getsize(os.path.join(d, name))
+                    for d, _, names in os.walk(self.directory)
+                    for name in names)
+        assert total <= 2000 + 600
+        assert disk.stats()['evictions'] > 0
+
+
+SELECT_RESULT = json.dumps({
+    "head": {"link": [], "vars": ["event", "datetime"]},
+    "results": {"distinct": False, "ordered": True, "bindings": [
+        {"event": {"type": "uri", "value": "http://example.org/ev1"},
+         "datetime": {"type": "literal", "value": "2010-01-01"}},
+        {"event": {"type": "uri", "value": "http://example.org/ev2"}},
+        {"event": {"type": "uri", "value": "http://example.org/\u00e9v3"},
+         "datetime": {"type": "literal", "value": "2010-01-03"}}]}},
+    ensure_ascii=False).encode('utf-8')
+
+
+def split_into_chunks(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class StreamingParserTestCase(unittest.TestCase):
+    def setUp(self):
+        result_cache.clear()
+
+    def test_rows_match_whole_document_parse(self):
+        expected = queries.queries.convert_raw_json_to_clean(
+            json.loads(SELECT_RESULT))
+        for size in [1, 7, len(SELECT_RESULT)]:
+            rows = list(iter_clean_rows(split_into_chunks(SELECT_RESULT,
+                                                          size)))
+            assert_equal(expected, rows)
+
+    def test_describe_result_has_no_bindings(self):
+        body = json.dumps({"http://example.org/ev1": {}}).encode('utf-8')
+        with assert_raises(NoBindingsError):
+            list(iter_clean_rows([body]))
+
+    def test_submit_query_keeps_no_raw_result(self):
+        fake_response = mock.Mock()
+        fake_response.status_code = 200
+        fake_response.iter_content.return_value = iter(
+            split_into_chunks(SELECT_RESULT, 10))
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.return_value = fake_response
+            query = queries.SparqlQuery(
+                endpoint_url='https://example.org/nwr/test/{action}')
+            query.query = 'SELECT'
+            query.submit_query('mock_username', 'mock_password')
+        assert_equal(3, len(query.clean_json))
+        assert_equal(None, query._raw_chunks)
+        assert_equal(None, query._json_result)
+        assert_equal(query.json_result['head']['vars'], ['event', 'datetime'])
+        assert_equal(query.json_result['results']['bindings'][1],
+                     {'event': {'type': 'literal',
+                                'value': 'http://example.org/ev2'}})
+
+    def test_long_describe_result_is_searched_once(self):
+        graph = dict(('http://example.org/ev{0}'.format(i),
+                      {'http://www.w3.org/2000/01/rdf-schema#label': [
+                          {'type': 'literal', 'value': 'x' * 100}]})
+                     for i in range(2000))
+        body = json.dumps(graph).encode('utf-8')
+        with patch.object(queries.streaming, 'BINDINGS_START',
+                          wraps=queries.streaming.BINDINGS_START) as start:
+            with assert_raises(NoBindingsError):
+                list(iter_clean_rows(split_into_chunks(body, 1024)))
+        searched = sum(len(call[0][0]) - call[0][1]
+                       for call in start.search.call_args_list)
+        assert searched < 2 * len(body)
+
+    def test_json_variables_are_read_from_the_head(self):
+        variables = []
+        rows = list(iter_clean_rows(split_into_chunks(SELECT_RESULT, 7),
+                                    variables=variables))
+        assert_equal(len(rows), 3)
+        assert_equal(variables, ['event', 'datetime'])
+
+    def test_tsv_rows_match_json_rows(self):
+        body = ('?event\t?datetime\t?label\n'
+                '<http://example.org/ev1>\t"2010-01-01"\t"a\\tb"@en\n'
+                '<http://example.org/ev2>\t\t"3"^^<http://www.w3.org/2001/XMLSchema#int>\n'
+                ).encode('utf-8')
+        rows = list(iter_clean_rows(split_into_chunks(body, 5), 'tsv'))
+        assert_equal([{'event': 'http://example.org/ev1',
+                       'datetime': '2010-01-01', 'label': 'a\tb'},
+                      {'event': 'http://example.org/ev2', 'label': '3'}],
+                     rows)
+        raw = load_result(body, 'tsv')
+        assert_equal(['event', 'datetime', 'label'], raw['head']['vars'])
+        assert_equal('en', raw['results']['bindings'][0]['label']['xml:lang'])
+
+    def test_csv_rows_match_json_rows(self):
+        body = ('event,datetime,label\r\n'
+                'http://example.org/ev1,2010-01-01,"two\nlines"\r\n'
+                'http://example.org/ev2,,\u00e9\r\n').encode('utf-8')
+        rows = list(iter_clean_rows(split_into_chunks(body, 3), 'csv'))
+        assert_equal([{'event': 'http://example.org/ev1',
+                       'datetime': '2010-01-01', 'label': 'two\nlines'},
+                      {'event': 'http://example.org/ev2', 'label': '\u00e9'}],
+                     rows)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_concurrently(self, *calls):
+        results = [None] * len(calls)
+
+        def run(i, call):
+            try:
+                results[i] = call()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i, call))
+                   for i, call in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_call(self):
+        flight = SingleFlight(self.directory)
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait()
+            return 'value'
+        timer = threading.Timer(0.2, release.set)
+        timer.start()
+        results = self.run_concurrently(lambda: flight.do('key', slow),
+                                        lambda: flight.do('key', slow))
+        assert_equal([('value', False), ('value', True)], results)
+        assert_equal(1, len(calls))
+        assert_equal(1, flight.stats()['coalesced'])
+
+    def test_failed_call_is_made_again_by_a_waiter(self):
+        flight = SingleFlight(self.directory)
+        calls = []
+
+        def fails_first():
+            calls.append(1)
+            time.sleep(0.2)
+            if len(calls) == 1:
+                raise queries.QueryException('failed')
+            return 'value'
+        results = self.run_concurrently(lambda: flight.do('key', fails_first),
+                                        lambda: flight.do('key', fails_first))
+        assert_is_instance(results[0], queries.QueryException)
+        assert_equal(('value', False), results[1])
+        assert_equal(1, flight.stats()['retries'])
+
+    def test_unshareable_value_is_not_shared(self):
+        flight = SingleFlight(self.directory)
+        values = ['partial', 'complete']
+
+        def fetch():
+            time.sleep(0.2)
+            return values.pop(0)
+        shareable = lambda value: value == 'complete'
+        results = self.run_concurrently(
+            lambda: flight.do('key', fetch, shareable=shareable),
+            lambda: flight.do('key', fetch, shareable=shareable),
+            lambda: flight.do('key', fetch, shareable=shareable))
+        assert_equal([('partial', False), ('complete', False),
+                      ('complete', True)], results)
+
+    def test_calls_in_other_processes_wait_on_lock_file(self):
+        # Two instances stand in for two worker processes sharing a cache.
+        cache = {}
+
+        def fetch():
+            if 'key' in cache:
+                return 'cached'
+            time.sleep(0.2)
+            cache['key'] = 'fetched'
+            return 'fetched'
+        results = self.run_concurrently(
+            lambda: SingleFlight(self.directory).do('key', fetch),
+            lambda: SingleFlight(self.directory).do('key', fetch))
+        assert_equal([('fetched', False), ('cached', False)], results)
+
+    def test_waits_end_at_the_timeout(self):
+        flight = SingleFlight(self.directory)
+
+        def slow():
+            time.sleep(0.5)
+            return 'value'
+        t0 = time.time()
+        results = self.run_concurrently(
+            lambda: flight.do('key', slow),
+            lambda: flight.do('key', slow, timeout=0.1),
+            lambda: SingleFlight(self.directory).do('key', lambda: 'own',
+                                                    timeout=0.1))
+        assert_equal(('value', False), results[0])
+        assert_is_instance(results[1], SingleFlightTimeout)
+        assert_equal(('own', False), results[2])
+        assert time.time() - t0 < 0.9
+
+
+class CompiledTemplateTestCase(unittest.TestCase):
+    def test_only_used_prefixes_are_declared(self):
+        query = queries.get_query_class("summary_of_events_with_actor")(
+            uris=['dbpedia:Alan_Mulally'],
+            endpoint_url='https://example.org/nwr/test/{action}')
+        assert 'PREFIX sem:' in query.query
+        assert 'PREFIX rdfs:' in query.query
+        assert 'PREFIX dbo:' not in query.query
+        assert '# All allowed parameters' not in query.query
+
+    def test_prefixes_used_by_substituted_blocks_are_declared(self):
+        query = queries.get_query_class("actors_of_a_type")(
+            uris=['dbo:Company'], filter='motor',
+            endpoint_url='https://example.org/nwr/test/{action}')
+        assert 'PREFIX dct:' in query.query
+        assert 'PREFIX rdfs:' in query.query
+
+    def test_template_is_compiled_once(self):
+        first = queries.queries.compile_template('#header', 'sem:x {uri_0}')
+        second = queries.queries.compile_template('#header', 'sem:x {uri_0}')
+        assert first is second
+
+
+class QueryRegistryTestCase(unittest.TestCase):
+    def test_query_class_is_found_by_name(self):
+        query_class = queries.get_query_class('describe_uri')
+        assert_equal(query_class.__name__, 'describe_uri')
+
+    def test_unknown_query_raises_key_error(self):
+        with assert_raises(KeyError):
+            queries.get_query_class('bogus_query')
+
+    def test_metadata_includes_cost_class(self):
+        metadata = queries.registry.metadata('eso_frequency_count')
+        assert_equal(metadata['url'], 'eso_frequency_count')
+        assert_equal(metadata['cost'], 'aggregate')
+
+    def test_deadline_is_that_of_the_cost_class(self):
+        query = queries.get_query_class('eso_frequency_count')(
+            endpoint_url='https://example.org/nwr/test/{action}')
+        assert_equal(query.deadline, query.started +
+                     queries.queries.AGGREGATE_QUERY_DEADLINE)
+        query = queries.get_query_class('actors_of_a_type')(
+            uris=['dbo:Company'],
+            endpoint_url='https://example.org/nwr/test/{action}')
+        assert_equal(query.deadline,
+                     query.started + queries.queries.QUERY_DEADLINE)
+
+
+class CursorPagingTestCase(unittest.TestCase):
+    def make_query(self, **kwargs):
+        return queries.get_query_class("summary_of_events_with_actor")(
+            offset=40, limit=2, uris=['dbpedia:Alan_Mulally'],
+            endpoint_url='https://example.org/nwr/test/{action}', **kwargs)
+
+    def test_cursor_round_trips(self):
+        values = ['2004-04-30', 'http://example.org/e#ev1', 'say "hi"']
+        assert_equal(decode_cursor(encode_cursor(values), 3), values)
+
+    def test_malformed_cursor_raises_query_exception(self):
+        with assert_raises(queries.QueryException):
+            self.make_query(cursor='not a cursor')
+
+    def test_cursor_replaces_offset_with_keyset_filter(self):
+        cursor = encode_cursor(['2004-04-30', 'http://example.org/e#ev1',
+                                'say "hi"'])
+        query = self.make_query(cursor=cursor)
+        assert 'OFFSET 0' in query.query
+        assert 'STR(?datetime) > "2004-04-30"' in query.query
+        assert 'STR(?event_label) > "say \\"hi\\""' in query.query
+
+    def test_query_without_cursor_key_refuses_cursor(self):
+        with assert_raises(queries.QueryException):
+            queries.get_query_class("actors_of_a_type")(
+                uris=['dbo:Company'], cursor=encode_cursor(['a']),
+                endpoint_url='https://example.org/nwr/test/{action}')
+
+    def test_next_cursor_is_key_of_last_row_of_a_full_page(self):
+        query = self.make_query()
+        query.clean_json = [
+            {'event': 'e1', 'datetime': '2004', 'event_label': 'a',
+             'event_size': '3'},
+            {'event': 'e2', 'datetime': '2005', 'event_label': 'b',
+             'event_size': '4'}]
+        assert_equal(decode_cursor(query._make_next_cursor(), 3),
+                     ['2005', 'e2', 'b'])
+        query.clean_json = query.clean_json[:1]
+        assert_equal(query._make_next_cursor(), None)
+
+
+class QueryExporterTestCase(unittest.TestCase):
+    ENDPOINT_URL = 'https://example.org/nwr/test/{action}'
+
+    def make_exporter(self, query_name, uris, rows, **kwargs):
+        def submit_query(query, username, password):
+            if query.cursor is None:
+                start = query.offset
+            else:
+                start = int(decode_cursor(query.cursor, 3)[0]) + 1
+            query.clean_json = rows[start:start + query.limit]
+            if len(query.clean_json) == 0:
+                raise queries.QueryException("Result empty")
+            query.next_cursor = query._make_next_cursor()
+
+        patcher = patch.object(queries.SparqlQuery, 'submit_query',
+                               submit_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return QueryExporter(queries.get_query_class(query_name),
+                             {'uris': uris, 'endpoint_url': self.ENDPOINT_URL},
+                             'user', 'password', block_size=10,
+                             concurrency=3, **kwargs)
+
+    def test_offset_paging_yields_every_row_in_order(self):
+        rows = [{'actor': 'a{0}'.format(i), 'count': '1'} for i in range(25)]
+        exporter = self.make_exporter('actors_of_a_type', ['dbo:Company'],
+                                      rows)
+        assert_equal(list(exporter), rows)
+        assert_equal(exporter.truncated, False)
+
+    def test_cursor_paging_yields_every_row_in_order(self):
+        rows = [{'datetime': '{0:04d}'.format(i), 'event': 'e',
+                 'event_label': 'l', 'event_size': '1'} for i in range(30)]
+        exporter = self.make_exporter('summary_of_events_with_actor',
+                                      ['dbpedia:Alan_Mulally'], rows)
+        assert_equal(list(exporter), rows)
+
+    def test_count_which_ran_out_of_time_is_not_split(self):
+        rows = [{'datetime': '{0:04d}'.format(i), 'event': 'e',
+                 'event_label': 'l', 'event_size': '1'} for i in range(25)]
+        exporter = self.make_exporter('summary_of_events_with_actor',
+                                      ['dbpedia:Alan_Mulally'], rows)
+        exporter.supports_cursor = False
+        counted = []
+
+        def count(datefilter):
+            counted.append(datefilter)
+            return None
+
+        exporter._count = count
+        assert_equal(list(exporter), rows)
+        assert_equal(counted, [None])
+
+    def test_background_deadline_replaces_that_of_the_query_class(self):
+        exporter = self.make_exporter(
+            'eso_frequency_count', [], [],
+            deadline_seconds=queries.queries.MAX_QUERY_DEADLINE * 2)
+        query = exporter._make_query()
+        assert_equal(query.deadline,
+                     query.started + queries.queries.MAX_QUERY_DEADLINE * 2)
+
+    def test_non_tabular_query_is_refused(self):
+        with assert_raises(queries.QueryException):
+            QueryExporter(queries.get_query_class('describe_uri'),
+                          {'uris': ['dbpedia:Alan_Mulally'],
+                           'endpoint_url': self.ENDPOINT_URL},
+                          'user', 'password')
+
+    def test_datefilters_split_into_months_then_days(self):
+        assert '2004' in split_datefilter(None)
+        assert_equal(split_datefilter('2004')[:2], ['2004-01', '2004-02'])
+        assert_equal(len(split_datefilter('2004-02')), 29)
+        assert_equal(split_datefilter('2004-02-01'), [])
+
+
+class UriValuesTestCase(unittest.TestCase):
+    ENDPOINT_URL = 'https://example.org/nwr/test/{action}'
+
+    def test_all_uris_are_looked_up_in_one_query(self):
+        query = queries.get_query_class("summary_of_events_with_actor")(
+            uris=['dbpedia:Alan_Mulally', 'dbpedia:Martin_Winterkorn'],
+            endpoint_url=self.ENDPOINT_URL)
+        assert ('VALUES ?actor { <http://dbpedia.org/resource/Alan_Mulally> '
+                '<http://dbpedia.org/resource/Martin_Winterkorn> }'
+                in query.query)
+
+    def test_property_uri_is_not_a_value(self):
+        query = queries.get_query_class("property_of_an_actor")(
+            uris=['dbpedia:Barack_Obama', 'dbo:birthPlace',
+                  'dbpedia:Angela_Merkel'],
+            endpoint_url=self.ENDPOINT_URL)
+        assert_equal(query.uri_values,
+                     ['<http://dbpedia.org/resource/Barack_Obama>',
+                      '<http://dbpedia.org/resource/Angela_Merkel>'])
+        assert '?actor <http://dbpedia.org/ontology/birthPlace>' in query.query
+
+    def test_cursor_is_refused_for_several_uris(self):
+        with assert_raises(queries.QueryException):
+            queries.get_query_class("summary_of_events_with_actor")(
+                uris=['dbpedia:Alan_Mulally', 'dbpedia:Martin_Winterkorn'],
+                cursor=encode_cursor(['2004', 'e', 'l']),
+                endpoint_url=self.ENDPOINT_URL)
+
+    def test_too_many_uris_are_refused(self):
+        uris = ['dbpedia:Actor_{0}'.format(i) for i in range(101)]
+        with assert_raises(queries.QueryException):
+            queries.get_query_class("describe_uri")(
+                uris=uris, endpoint_url=self.ENDPOINT_URL)
+
+
+class BlockFetchTestCase(unittest.TestCase):
+    def setUp(self):
+        result_cache.clear()
+
+    def make_query(self, offset):
+        return queries.get_query_class("summary_of_events_with_actor")(
+            offset=offset, limit=20, uris=['dbpedia:Alan_Mulally'],
+            endpoint_url='https://example.org/nwr/test/{action}')
+
+    def make_response(self, number_of_rows):
+        bindings = [{"event": {"type": "uri",
+                               "value": "http://example.org/ev{0}".format(i)}}
+                    for i in range(number_of_rows)]
+        fake_response = mock.Mock()
+        fake_response.status_code = 200
+        fake_response.iter_content.return_value = iter([json.dumps(
+            {"head": {"vars": ["event"]},
+             "results": {"bindings": bindings}}).encode('utf-8')])
+        return fake_response
+
+    def test_pages_in_a_block_are_served_without_upstream_calls(self):
+        with patch.object(queries.queries, 'block_sizer', BlockSizer()), \
+                patch.object(requests.Session, 'get') as mock_method:
+            mock_method.return_value = self.make_response(160)
+            query = self.make_query(20)
+            query.submit_query('mock_username', 'mock_password')
+            sent = mock_method.call_args[1]['params']['query']
+            assert 'OFFSET 0' in sent
+            assert 'LIMIT 160' in sent
+            assert_equal('http://example.org/ev20',
+                         query.clean_json[0]['event'])
+            assert_equal(20, len(query.clean_json))
+
+            query = self.make_query(140)
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal('http://example.org/ev140',
+                         query.clean_json[0]['event'])
+        assert_equal(1, mock_method.call_count)
+
+    def test_block_size_adapts_to_latency_and_row_size(self):
+        sizer = BlockSizer(max_pages=16, target_seconds=2.0,
+                           max_bytes=100000)
+        assert_equal(8, sizer.pages('q'))
+        sizer.record('q', 20, 160, 0.1, 16000)
+        assert_equal(16, sizer.pages('q'))
+        for _ in range(10):
+            sizer.record('q', 20, 320, 10.0, 32000)
+        assert_equal(1, sizer.pages('q'))
+        sizer = BlockSizer(max_pages=16, target_seconds=2.0,
+                           max_bytes=100000)
+        sizer.record('q', 20, 160, 0.1, 160000)
+        assert_equal(4, sizer.pages('q'))
+
+
+class MaterializedTablesTestCase(unittest.TestCase):
+    ENDPOINT_URL = 'https://example.org/nwr/test/{action}'
+    ROWS = [{'type': 'http://dbpedia.org/ontology/RacingDriver',
+             'count': '30'},
+            {'type': 'http://dbpedia.org/ontology/SoccerPlayer',
+             'count': '20'},
+            {'type': 'http://dbpedia.org/ontology/Company', 'count': '10'}]
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.tables = MaterializedTables(directory)
+        patcher = patch.object(queries.queries, 'materialized_tables',
+                               self.tables)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_query(self, **kwargs):
+        return queries.get_query_class('types_of_actors')(
+            endpoint_url=self.ENDPOINT_URL, **kwargs)
+
+    def test_pages_filters_and_counts_are_served_from_the_snapshot(self):
+        self.tables.store(self.ENDPOINT_URL, 'types_of_actors', 'type',
+                          self.ROWS)
+        with patch.object(requests.Session, 'get') as mock_method:
+            query = self.make_query(offset=1, limit=1)
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal(query.clean_json, self.ROWS[1:2])
+            assert_equal(query.get_total_result_count('u', 'p'), 3)
+
+            query = self.make_query(filter='driver OR company')
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal(query.clean_json, [self.ROWS[0], self.ROWS[2]])
+            assert_equal(query.get_total_result_count('u', 'p'), 2)
+            assert_equal(query.snapshot_age, 0)
+        assert_equal(mock_method.call_count, 0)
+
+    def test_incomplete_snapshot_serves_only_the_rows_it_holds(self):
+        self.tables.store(self.ENDPOINT_URL, 'types_of_actors', 'type',
+                          self.ROWS, complete=False)
+        query = self.make_query(limit=2)
+        query.submit_query('mock_username', 'mock_password')
+        assert_equal(query.clean_json, self.ROWS[:2])
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = ConnectionError
+            query = self.make_query(filter='driver')
+            with assert_raises(queries.QueryException):
+                query.submit_query('mock_username', 'mock_password')
+            assert_equal(query.snapshot_age, None)
+
+    def test_readers_share_a_read_only_connection_which_sees_refreshes(self):
+        self.tables.store(self.ENDPOINT_URL, 'types_of_actors', 'type',
+                          self.ROWS)
+        connection = self.tables._connect(self.ENDPOINT_URL)
+        assert_equal(self.tables.count(self.ENDPOINT_URL, 'types_of_actors',
+                                       'none'), 3)
+        self.tables.store(self.ENDPOINT_URL, 'types_of_actors', 'type',
+                          self.ROWS[:1])
+        assert_equal(self.tables.count(self.ENDPOINT_URL, 'types_of_actors',
+                                       'none'), 1)
+        assert self.tables._connect(self.ENDPOINT_URL) is connection
+        with assert_raises(sqlite3.OperationalError):
+            connection.execute('DELETE FROM rows')
+
+    def test_refresh_stores_every_row(self):
+        def submit_query(query, username, password):
+            query.clean_json = self.ROWS[query.offset:
+                                         query.offset + query.limit]
+            if len(query.clean_json) == 0:
+                raise queries.QueryException("Result empty")
+
+        with patch.object(queries.SparqlQuery, 'submit_query',
+                          submit_query):
+            refreshed = refresh_endpoint(self.ENDPOINT_URL, 'u', 'p',
+                                         tables=self.tables)
+        assert 'types_of_actors' in refreshed
+        assert_equal(self.tables.page(self.ENDPOINT_URL, 'types_of_actors',
+                                      'none', 0, 10), self.ROWS)
+        assert_equal(refresh_endpoint(self.ENDPOINT_URL, 'u', 'p',
+                                      max_age=60, tables=self.tables), [])
+
+
+    def test_refresh_goes_on_after_a_query_fails(self):
+        def submit_query(query, username, password):
+            if query.url == 'eso_frequency_count':
+                raise queries.QueryException("Response code not OK: 500")
+            query.clean_json = self.ROWS[query.offset:
+                                         query.offset + query.limit]
+            if len(query.clean_json) == 0:
+                raise queries.QueryException("Result empty")
+
+        with patch.object(queries.SparqlQuery, 'submit_query',
+                          submit_query):
+            refreshed = refresh_endpoint(self.ENDPOINT_URL, 'u', 'p',
+                                         tables=self.tables)
+        assert 'eso_frequency_count' not in refreshed
+        assert 'types_of_actors' in refreshed
+
+
+class SnapshotBackendTestCase(unittest.TestCase):
+    ENDPOINT_URL = 'https://example.org/nwr/test/{action}'
+    DBPEDIA = 'http://dbpedia.org/resource/'
+    PERSON = 'http://dbpedia.org/ontology/Person'
+    # name: (uri, size, datetime, year, label, actors)
+    EVENTS = [('http://example.org/ev1', 5, '2004-03', 2004, 'buy',
+               ['Alan_Mulally', 'Bill_Ford']),
+              ('http://example.org/ev2', 7, '2005-01', 2005, 'sell',
+               ['Alan_Mulally', 'Bill_Ford', 'Henry_Ford']),
+              ('http://example.org/ev3', 3, '2004-11', 2004, 'takeover',
+               ['Alan_Mulally', 'Henry_Ford'])]
+    ACTOR_LABELS = [('Alan_Mulally', 'Alan Mulally'),
+                    ('Bill_Ford', 'William Clay Ford Jr.')]
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = SnapshotStore(directory)
+        patcher = patch.object(queries.queries, 'snapshot_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_snapshot(self):
+        writer = self.store.writer(self.ENDPOINT_URL)
+        for uri, size, datetime, year, label, actors in self.EVENTS:
+            event_id = writer.event_id(uri, size)
+            writer.add('event_times', (event_id, datetime, year, None, None))
+            writer.add('event_labels', (event_id, label, label))
+            for actor in actors:
+                actor_id = writer.actor_id(self.DBPEDIA + actor)
+                writer.add('event_actors', (event_id, actor_id, 'actor'))
+        for actor in ['Alan_Mulally', 'Bill_Ford', 'Henry_Ford']:
+            writer.add('actor_types', (writer.actor_id(self.DBPEDIA + actor),
+                                       self.PERSON))
+        for actor, label in self.ACTOR_LABELS:
+            writer.add('actor_labels', (writer.actor_id(self.DBPEDIA + actor),
+                                        label, label.lower()))
+        writer.commit()
+
+    def make_query(self, name, **kwargs):
+        return queries.get_query_class(name)(
+            endpoint_url=self.ENDPOINT_URL, backend='snapshot', **kwargs)
+
+    def test_summary_pages_with_the_same_headers_and_cursor(self):
+        self.write_snapshot()
+        with patch.object(requests.Session, 'get') as mock_method:
+            query = self.make_query('summary_of_events_with_actor',
+                                    uris=['dbpedia:Alan_Mulally'], limit=2)
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal([row['event_label'] for row in query.clean_json],
+                         ['buy', 'takeover'])
+            assert_equal(sorted(query.clean_json[0]),
+                         sorted(query.headers))
+            assert_equal(query.get_total_result_count('u', 'p'), 3)
+
+            query = self.make_query('summary_of_events_with_actor',
+                                    uris=['dbpedia:Alan_Mulally'], limit=2,
+                                    cursor=query.next_cursor)
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal([row['event_label'] for row in query.clean_json],
+                         ['sell'])
+
+            query = self.make_query('summary_of_events_with_actor',
+                                    uris=['dbpedia:Alan_Mulally'],
+                                    datefilter='2004')
+            assert_equal(query.get_total_result_count('u', 'p'), 2)
+        assert_equal(mock_method.call_count, 0)
+
+    def test_malformed_datefilter_is_a_query_error(self):
+        self.write_snapshot()
+        query = self.make_query('summary_of_events_with_actor',
+                                uris=['dbpedia:Alan_Mulally'],
+                                datefilter='2014-xx')
+        assert_raises(queries.QueryException, query.submit_query,
+                      'mock_username', 'mock_password')
+
+    def test_people_sharing_event_with_a_person(self):
+        self.write_snapshot()
+        query = self.make_query('people_sharing_event_with_a_person',
+                                uris=['dbpedia:Bill_Ford'])
+        query.submit_query('mock_username', 'mock_password')
+        assert_equal([(row['actor2'], row['numEvent'])
+                      for row in query.clean_json],
+                     [(self.DBPEDIA + 'Alan_Mulally', '2'),
+                      (self.DBPEDIA + 'Henry_Ford', '1')])
+        assert_equal(query.get_total_result_count('u', 'p'), 2)
+
+    def test_people_sharing_event_from_the_actor_event_index(self):
+        self.write_snapshot()
+        rows = {}
+        for use_index in [False, True]:
+            with patch.object(queries.cooccurrence, 'COOCCURRENCE_INDEX',
+                              use_index):
+                query = self.make_query('people_sharing_event_with_a_person',
+                                        uris=['dbpedia:Alan_Mulally'],
+                                        offset=1, limit=1)
+                query.submit_query('mock_username', 'mock_password')
+                rows[use_index] = query.clean_json
+                assert_equal(query.get_total_result_count('u', 'p'), 2)
+        assert_equal(rows[True], rows[False])
+        assert_equal(rows[True][0]['actor2'], self.DBPEDIA + 'Henry_Ford')
+
+        with patch.object(queries.cooccurrence, 'COOCCURRENCE_INDEX', True):
+            index = queries.cooccurrence.get_cooccurrence_index(
+                self.store, self.ENDPOINT_URL)
+        assert_equal(list(index.events_of(
+            index.ids[self.DBPEDIA + 'Alan_Mulally'])), [1, 2, 3])
+        assert_equal(index.top_partners(self.DBPEDIA + 'Henry_Ford', 0, 5),
+                     [(self.DBPEDIA + 'Alan_Mulally', 2, None),
+                      (self.DBPEDIA + 'Bill_Ford', 1, None)])
+
+    def test_actors_are_filtered_on_their_labels(self):
+        self.write_snapshot()
+        for filter_string, actors in [('none', ['Alan_Mulally', 'Bill_Ford',
+                                                'Henry_Ford']),
+                                      ('william', ['Bill_Ford']),
+                                      ('bill', []),
+                                      ('ford OR alan', ['Alan_Mulally',
+                                                        'Bill_Ford'])]:
+            query = self.make_query('actors_of_a_type', uris=['dbo:Person'],
+                                    filter=filter_string)
+            assert_equal(sorted(row['actor'] for row in
+                                query._query_snapshot()),
+                         [self.DBPEDIA + actor for actor in actors])
+            assert_equal(query.get_total_result_count('u', 'p'),
+                         len(actors))
+
+    def test_endpoint_without_a_snapshot_uses_the_knowledgestore(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = ConnectionError
+            query = self.make_query('actors_of_a_type', uris=['dbo:Person'])
+            with assert_raises(queries.QueryException):
+                query.submit_query('mock_username', 'mock_password')
+        assert_equal(mock_method.call_count, 1)
+
+    def test_ingest_copies_each_relation(self):
+        relations = {
+            'ingest_events': [{'event': 'http://example.org/ev1',
+                               'size': '5'}],
+            'ingest_event_times': [{'event': 'http://example.org/ev1',
+                                    'datetime': '2004-03', 'year': '2004',
+                                    'month': '3'}],
+            'ingest_event_labels': [{'event': 'http://example.org/ev1',
+                                     'event_label': 'Buy'}],
+            'ingest_event_actors': [{'event': 'http://example.org/ev1',
+                                     'actor': self.DBPEDIA + 'Alan_Mulally',
+                                     'role': 'actor'}],
+            'ingest_actor_types': [{'actor': self.DBPEDIA + 'Alan_Mulally',
+                                    'type': self.PERSON}],
+            'ingest_actor_labels': [{'actor': self.DBPEDIA + 'Alan_Mulally',
+                                     'label': 'Alan Mulally'}]}
+
+        def submit_query(query, username, password):
+            rows = relations.get(query.url, [])
+            query.clean_json = [] if query.cursor else rows
+            if len(query.clean_json) == 0:
+                raise queries.QueryException("Result empty")
+            query.next_cursor = query._make_next_cursor()
+
+        with patch.object(queries.SparqlQuery, 'submit_query',
+                          submit_query):
+            assert_equal(ingest_endpoint(self.ENDPOINT_URL, 'u', 'p',
+                                         store=self.store), 6)
+        query = self.make_query('actors_of_a_type', uris=['dbo:Person'],
+                                filter='mulally')
+        assert_equal(query.get_total_result_count('u', 'p'), 1)
+        query = self.make_query('summary_of_events_with_event_label',
+                                filter='buy', datefilter='2004-03')
+        query.submit_query('mock_username', 'mock_password')
+        assert_equal(query.clean_json,
+                     [{'event': 'http://example.org/ev1',
+                       'event_size': '5', 'datetime': '2004-03',
+                       'event_label': 'Buy'}])
+
+
+class DeadlineTestCase(unittest.TestCase):
+    def setUp(self):
+        result_cache.clear()
+
+    def make_query(self, **kwargs):
+        return queries.get_query_class("summary_of_events_with_actor")(
+            limit=20, uris=['dbpedia:Alan_Mulally'],
+            endpoint_url='https://example.org/nwr/test/{action}', **kwargs)
+
+    def make_response(self, rows, headers=None):
+        fake_response = mock.Mock()
+        fake_response.status_code = 200
+        fake_response.headers = headers or {}
+        fake_response.iter_content.return_value = iter([json.dumps(
+            {"head": {"vars": ["event"]},
+             "results": {"bindings": [
+                 {"event": {"type": "uri", "value": "http://example.org/ev"}}
+             ] * rows}}).encode('utf-8')])
+        return fake_response
+
+    def test_timeout_parameter_sets_the_deadline(self):
+        query = self.make_query(timeout='5')
+        assert_equal(query.deadline, query.started + 5)
+        query = self.make_query(timeout=10000)
+        assert_equal(query.deadline,
+                     query.started + queries.queries.MAX_QUERY_DEADLINE)
+        with assert_raises(queries.QueryException):
+            self.make_query(timeout='soon')
+
+    def test_upstream_calls_are_bounded_by_the_deadline(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.return_value = self.make_response(20)
+            query = self.make_query(timeout=5)
+            query.block_fetch = False
+            query.submit_query('mock_username', 'mock_password')
+        kwargs = mock_method.call_args[1]
+        assert 0 < kwargs['params']['timeout'] <= 5000
+        assert kwargs['timeout'][1] <= 5 + queries.queries.DEADLINE_GRACE
+
+    def test_document_fetch_is_bounded_by_the_deadline(self):
+        query = queries.get_query_class('get_document')(
+            uris=['http://example.org/doc'], timeout=5,
+            endpoint_url='https://example.org/nwr/test/{action}')
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = requests.Timeout
+            with assert_raises(queries.queries.DeadlineExceeded):
+                query.submit_query('mock_username', 'mock_password')
+        assert mock_method.call_args[1]['timeout'][1] <= 5
+
+    def test_count_is_none_when_it_runs_out_of_time(self):
+        def get(url, **kwargs):
+            if 'Counting Query' in kwargs['params']['query']:
+                raise requests.Timeout
+            return self.make_response(20)
+
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.side_effect = get
+            query = self.make_query()
+            count = query.submit_query_and_count('mock_username',
+                                                 'mock_password')
+        assert_equal(count, None)
+        assert_equal(len(query.clean_json), 20)
+
+    def test_partial_results_are_flagged_and_not_cached(self):
+        with patch.object(requests.Session, 'get') as mock_method:
+            mock_method.return_value = self.make_response(
+                3, {'X-SQL-State': 'S1TAT'})
+            query = self.make_query()
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal(query.partial, True)
+            assert_equal(query.next_cursor, None)
+
+            mock_method.return_value = self.make_response(20)
+            query = self.make_query()
+            query.submit_query('mock_username', 'mock_password')
+            assert_equal(query.partial, False)
+        assert_equal(mock_method.call_count, 2)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        result_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_histograms_are_added_up_over_workers(self):
+        labels = ('actors_of_a_type', 'cars', 'json')
+        worker = Metrics(self.directory)
+        with patch.object(queries.metrics.os, 'getpid', return_value=1):
+            worker.observe('newsreader_upstream_seconds', labels, 0.3)
+            worker.increment('newsreader_cache_lookups_total',
+                             labels + ('page', 'miss'))
+            worker.flush()
+        metrics = Metrics(self.directory)
+        metrics.observe('newsreader_upstream_seconds', labels, 2)
+        text = metrics.render()
+        assert ('newsreader_upstream_seconds_bucket{query="actors_of_a_type",'
+                'endpoint="cars",format="json",le="0.5"} 1') in text
+        assert ('newsreader_upstream_seconds_bucket{query="actors_of_a_type",'
+                'endpoint="cars",format="json",le="+Inf"} 2') in text
+        assert ('newsreader_upstream_seconds_sum{query="actors_of_a_type",'
+                'endpoint="cars",format="json"} 2.3') in text
+        assert ('newsreader_cache_lookups_total{query="actors_of_a_type",'
+                'endpoint="cars",format="json",lookup="page",result="miss"} 1'
+                ) in text
+
+    def test_query_timings_and_cache_lookups_are_recorded(self):
+        metrics = Metrics(self.directory)
+        with patch.object(requests.Session, 'get') as mock_method:
+            fake_response = mock.Mock()
+            fake_response.status_code = 200
+            fake_response.headers = {}
+            fake_response.iter_content.side_effect = lambda size: iter([
+                json.dumps({"head": {"vars": ["count"]},
+                            "results": {"bindings": [{"count": {
+                                "type": "literal", "value": "7"}}]}})])
+            mock_method.return_value = fake_response
+            for _ in range(2):
+                query = queries.get_query_class('types_of_actors')(
+                    endpoint_url='https://example.org/nwr/metrics/{action}',
+                    output='json')
+                query.materialized = False
+                query.submit_query('mock_username', 'mock_password')
+                metrics.record_query(query, 'cars', 100)
+        assert 'upstream' not in query.timings
+        text = metrics.render()
+        assert ('newsreader_upstream_seconds_count{query="types_of_actors",'
+                'endpoint="cars",format="json"} 1') in text
+        assert ('newsreader_response_bytes_count{query="types_of_actors",'
+                'endpoint="cars",format="json"} 2') in text
+        for result in ('hit', 'miss'):
+            assert ('newsreader_cache_lookups_total{query="types_of_actors",'
+                    'endpoint="cars",format="json",lookup="page",'
+                    'result="' + result + '"} 1') in text
+
+    def test_session_pool_statistics_are_collected(self):
+        url = 'https://example.org/nwr/metrics-sessions/'
+        with get_session_pool(url).session('mock_username', 'mock_password'):
+            pass
+        metrics = Metrics(self.directory,
+                          collectors=[queries.metrics.session_pool_samples])
+        text = metrics.render()
+        assert ('newsreader_http_sessions{endpoint_url="' + url + '"} 1'
+                ) in text
+        assert ('newsreader_http_session_events_total{endpoint_url="' + url +
+                '",event="checkouts"} 1') in text
+
+    def test_cache_tier_statistics_are_collected(self):
+        cache = TieredCache([MemoryTier(max_bytes=1024)])
+        cache.set('key', 'value', ttl=60)
+        cache.get('key')
+        metrics = Metrics(self.directory, collectors=[
+            lambda: queries.metrics.cache_tier_samples(cache)])
+        text = metrics.render()
+        assert ('newsreader_cache_tier_events_total{tier="MemoryTier",'
+                'event="hits"} 1') in text
+        assert 'newsreader_cache_tier_entries{tier="MemoryTier"} 1' in text
+
+    def test_unknown_outputs_share_one_label(self):
+        metrics = Metrics(self.directory)
+        for output in ('xml', '{"a": 1}'):
+            query = queries.get_query_class('types_of_actors')(
+                endpoint_url='https://example.org/nwr/metrics/{action}',
+                output=output)
+            metrics.record_query(query, 'cars', 100)
+        assert ('newsreader_response_bytes_count{query="types_of_actors",'
+                'endpoint="cars",format="other"} 2') in metrics.render()
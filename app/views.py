@@ -5,11 +5,14 @@ from __future__ import unicode_literals, division
 import json
 
 from flask import (abort, render_template, request, url_for, make_response,
-                   send_from_directory)
+                   send_from_directory, stream_with_context, Response)
+from markupsafe import escape
 from app import app
 from pagination import Pagination
+from profiling import RequestProfiler
 from collections import namedtuple, OrderedDict
 import functools
+import hashlib
 import queries
 import jsonurl
 import cStringIO as StringIO
@@ -17,8 +20,13 @@ import unicodecsv as csv
 import logging
 import math
 import os
+import time
 import urllib
 from app import make_documentation
+from queries.export import QueryExporter
+from queries.materialized import start_scheduler
+from queries.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, metrics
+from queries.queries import BULK_POOL_SIZE, get_bulk_executor, iter_ordered
 
 # TODO:
 # 1. Wrap error responses in the appropriate manner (HTML, JSON, JSONP)
@@ -29,13 +37,44 @@ from app import make_documentation
 logging.basicConfig()
 
 PER_PAGE = 20
+# Exports are written to the client in chunks of about this many bytes.
+EXPORT_CHUNK_BYTES = 64 * 1024
+# Queries of a batch run at once, and the most a batch may hold.
+BATCH_CONCURRENCY = int(os.environ.get('NEWSREADER_BATCH_CONCURRENCY',
+                                       BULK_POOL_SIZE))
+BATCH_MAX_QUERIES = int(os.environ.get('NEWSREADER_BATCH_MAX_QUERIES', 50))
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson; charset=utf-8',
+                  'csv': 'text/csv; charset=utf-8'}
 DEFAULT_ENDPOINT = 'cars'
+# The stages of SparqlQuery.timings given in the Server-Timing header, with
+# their descriptions.
+SERVER_TIMINGS = [('cache', 'Page cache lookup'),
+                  ('upstream', 'Upstream page query'),
+                  ('parse', 'Parse'),
+                  ('count_cache', 'Count cache lookup'),
+                  ('count', 'Count query'),
+                  ('render', 'Render')]
+# Seconds between refreshes of the materialized tables by each worker, and
+# the endpoints they are kept for; 0 leaves refreshing to materialize.py.
+MATERIALIZE_EVERY = int(os.environ.get('NEWSREADER_MATERIALIZE_EVERY', 0))
+MATERIALIZE_ENDPOINTS = os.environ.get('NEWSREADER_MATERIALIZE_ENDPOINTS',
+                                       'cars,wikinews').split(',')
+# Endpoints whose queries are answered from their local snapshot where
+# possible; see ingest_snapshot.py.
+SNAPSHOT_ENDPOINTS = os.environ.get('NEWSREADER_SNAPSHOT_ENDPOINTS',
+                                    '').split(',')
 
 
 class ViewerException(Exception):
     pass
 
 
+def validate_admin_api_key(api_key):
+    """ Return True if api_key may use the operator-only parameters. """
+    admin_api_keys = os.environ.get('NEWSREADER_ADMIN_API_KEY', '')
+    return bool(api_key) and api_key in admin_api_keys.split(',')
+
+
 def validate_api_key(api_key, endpoint):
     public_api_keys = os.environ['NEWSREADER_PUBLIC_API_KEY'].split(',')
     private_api_keys = os.environ['NEWSREADER_PRIVATE_API_KEY'].split(',')
@@ -48,61 +87,120 @@ def validate_api_key(api_key, endpoint):
     return validated
 
 
-def index(function_list):
+# Stands in for the user's API key in cached documentation pages.
+API_KEY_PLACEHOLDER = '__NEWSREADER_API_KEY__'
+
+IndexPage = namedtuple('IndexPage', 'body content_type etag')
+
+# Rendered documentation keyed by (DocsCreator, root URL, endpoint path,
+# output format), where the output format is 'json' or 'html'.
+_index_pages = {}
+
+
+def get_index_page(docs_creator, endpoint_path, output):
+    """ Return the documentation page for an endpoint, built once.
+
+    The page has API_KEY_PLACEHOLDER in place of the user's API key.
+    """
+    root_url = get_root_url()
+    key = (docs_creator, root_url, endpoint_path, output)
+    page = _index_pages.get(key)
+    if page is None:
+        function_list = docs_creator(root_url, API_KEY_PLACEHOLDER,
+                                     endpoint_path).make_docs()
+        if output == 'json':
+            body = json.dumps(function_list, ensure_ascii=False,
+                              sort_keys=True)
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = render_template('index.html', help=function_list)
+            content_type = 'text/html; charset=utf-8'
+        etag = hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+        page = IndexPage(body, content_type, etag)
+        _index_pages[key] = page
+    return page
+
+
+def index(docs_creator, endpoint_path):
     """ Provide documentation when accessing the root page """
-    output = parse_query_string(request.query_string)
-    if "output" not in output.keys():
-        output['output'] = 'html'
-    if output['output'] == 'json':
-        response = make_response(json.dumps(
-            function_list, ensure_ascii=False, sort_keys=True))
-        response.headers[str('Content-type')] = str(
-            'application/json; charset=utf-8')
-        response.headers[str('Access-Control-Allow-Origin')] = str('*')
-        return response
-    elif output['output'] == 'html':
-        return render_template('index.html', help=function_list)
+    # Any other output, however given, gets the HTML page; only these two
+    # are ever cached.
+    output = 'html'
+    if parse_query_string(request.query_string).get('output') == 'json':
+        output = 'json'
+    page = get_index_page(docs_creator, endpoint_path, output)
+
+    user_api_key = request.args.get('api_key') or '<YOUR_API_KEY>'
+    if output == 'json':
+        api_key = json.dumps(user_api_key)[1:-1]
+    else:
+        api_key = unicode(escape(user_api_key))
+    response = make_response(page.body.replace(API_KEY_PLACEHOLDER, api_key))
+    response.headers[str('Content-type')] = str(page.content_type)
+    key_hash = hashlib.sha1(user_api_key.encode('utf-8')).hexdigest()[:8]
+    response.set_etag(page.etag + '-' + key_hash)
+    return response.make_conditional(request)
+
+
+INDEX_DOCS_CREATORS = [
+    (make_documentation.CarsDocsCreator, '/cars'),
+    (make_documentation.WorldCupDocsCreator, '/world_cup'),
+    (make_documentation.WikiNewsDocsCreator, '/wikinews'),
+    (make_documentation.FTDocsCreator, '/ft'),
+]
+
+
+@app.before_first_request
+def build_index_pages():
+    """ Build the documentation for every endpoint before serving. """
+    for docs_creator, endpoint_path in INDEX_DOCS_CREATORS:
+        for output in ('html', 'json'):
+            get_index_page(docs_creator, endpoint_path, output)
+
+
+@app.before_first_request
+def start_materialize_scheduler():
+    """ Keep the materialized tables fresh, if so configured. """
+    if MATERIALIZE_EVERY <= 0:
+        return
+    endpoints = []
+    for api_endpoint in MATERIALIZE_ENDPOINTS:
+        ks_credentials = get_endpoint_credentials(api_endpoint)
+        # Private endpoints have no materialized tables.
+        if not ks_credentials.private:
+            endpoints.append((ks_credentials.url, ks_credentials.username,
+                              ks_credentials.password))
+    start_scheduler(endpoints, MATERIALIZE_EVERY)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """ Return the metrics of every worker for Prometheus to scrape. """
+    response = make_response(metrics.render())
+    response.headers[str('Content-type')] = str(METRICS_CONTENT_TYPE)
+    return response
 
 
-# TODO: wrap these into a single function which takes DocsCreator() object
 @app.route('/')
 @app.route('/cars')
 def cars_index():
-    root_url = get_root_url()
-    endpoint_path = '/cars'
-    user_api_key = request.args.get('api_key')
-    function_list = make_documentation.CarsDocsCreator(root_url, user_api_key,
-                                                       endpoint_path).make_docs()
-    return index(function_list)
+    return index(make_documentation.CarsDocsCreator, '/cars')
 
 
 @app.route('/world_cup')
 def worldcup_index():
-    root_url = get_root_url()
-    endpoint_path = '/world_cup'
-    user_api_key = request.args.get('api_key')
-    function_list = make_documentation.WorldCupDocsCreator(root_url,
-                                                           user_api_key,
-                                                           endpoint_path).make_docs()
-    return index(function_list)
+    return index(make_documentation.WorldCupDocsCreator, '/world_cup')
+
 
 @app.route('/wikinews')
 def wikinews_index():
-    root_url = get_root_url()
-    endpoint_path = '/wikinews'
-    user_api_key = request.args.get('api_key')
-    function_list = make_documentation.WikiNewsDocsCreator(root_url, user_api_key,
-                                                       endpoint_path).make_docs()
-    return index(function_list)
+    return index(make_documentation.WikiNewsDocsCreator, '/wikinews')
+
 
 @app.route('/ft')
 def ft_index():
-    root_url = get_root_url()
-    endpoint_path = '/ft'
-    user_api_key = request.args.get('api_key')
-    function_list = make_documentation.FTDocsCreator(root_url, user_api_key,
-                                                       endpoint_path).make_docs()
-    return index(function_list)
+    return index(make_documentation.FTDocsCreator, '/ft')
+
 
 def parse_query_string(query_string):
     """ Return dict containing query string values.
@@ -114,28 +212,36 @@ def parse_query_string(query_string):
         parsed_query = jsonurl.parse_query(query_string)
         if "output" not in parsed_query.keys():
             parsed_query['output'] = 'html'
-        # Hack to escape words in Unicode strings for Virtuoso.
-        # Can't just escape the whole string as e.g. "bribe OR bribery" fails.
         if "filter" in parsed_query.keys():
-            filter_words = []
-            for each in parsed_query['filter'].split():
-                try:
-                    filter_words.append(each.decode('ascii'))
-                except UnicodeEncodeError:
-                    filter_words.append("'" + each + "'")
-            parsed_query['filter'] = ' '.join(filter_words)
+            parsed_query['filter'] = escape_filter(parsed_query['filter'])
         return parsed_query
     except ValueError as e:
         raise ViewerException("Query URL is malformed: {}".format(e.message))
 
 
+def escape_filter(filter_string):
+    """ Hack to escape words in Unicode strings for Virtuoso.
+
+    Can't just escape the whole string as e.g. "bribe OR bribery" fails.
+    """
+    filter_words = []
+    for each in filter_string.split():
+        try:
+            filter_words.append(each.decode('ascii'))
+        except UnicodeEncodeError:
+            filter_words.append("'" + each + "'")
+    return ' '.join(filter_words)
+
+
 def get_endpoint_credentials(api_endpoint):
     """ Take name of API endpoint as string; return KS SPARQL URL. """
-    Credentials = namedtuple("Credentials", "url username password")
+    Credentials = namedtuple("Credentials",
+                             "url username password private backend")
     # Cars as default endpoint
     url = ('https://knowledgestore2.fbk.eu/nwr/cars-hackathon/{action}')
     username = os.environ.get('NEWSREADER_PUBLIC_USERNAME')
     password = os.environ.get('NEWSREADER_PUBLIC_PASSWORD')
+    private = False
 
     if api_endpoint == 'world_cup':
         # TODO: check if this URL is  correct (though a dead link now anyway).
@@ -146,12 +252,17 @@ def get_endpoint_credentials(api_endpoint):
                '/nwr/ft/{action}')
         username = os.environ.get('NEWSREADER_PRIVATE_USERNAME')
         password = os.environ.get('NEWSREADER_PRIVATE_PASSWORD')
+        private = True
     elif api_endpoint == 'wikinews':
         url = ('https://knowledgestore2.fbk.eu'
                '/nwr/wikinews/{action}')
         username = ''
         password = ''
-    return Credentials(url, username, password)
+    # Snapshots are never made for private endpoints; see ingest_snapshot.py.
+    backend = 'sparql'
+    if api_endpoint in SNAPSHOT_ENDPOINTS and not private:
+        backend = 'snapshot'
+    return Credentials(url, username, password, private, backend)
 
 
 # TODO: consider getting rid of this first line. Get query exceptions
@@ -166,6 +277,10 @@ def run_query(page, query_to_use, api_endpoint):
     """ Return response of selected query using query string values. """
     if not validate_api_key(request.args.get('api_key', None), api_endpoint):
         abort(401)
+    profiling = 'profile' in request.args
+    explaining = 'explain' in request.args
+    if profiling and not validate_admin_api_key(request.args.get('api_key')):
+        abort(403)
 
     ks_credentials = get_endpoint_credentials(api_endpoint)
     if ks_credentials.url is None:
@@ -182,25 +297,294 @@ def run_query(page, query_to_use, api_endpoint):
             print "**we are doing a special parse for get_mention_metadata**"
             query_args = parse_get_mention_metadata(request.query_string)
             print query_args
+        query_args.pop('profile', None)
+        query_args.pop('explain', None)
+
+        if profiling:
+            return profile_query(query_to_use, query_args, page,
+                                 ks_credentials)
+        current_query, count = execute_query(query_to_use, query_args, page,
+                                             ks_credentials)
+    except (ViewerException, queries.QueryException,
+            ResultPageLimitExceededException) as e:
+        return produce_error_response(e, query_args)
+    else:
+        if explaining:
+            return produce_explain_response(current_query, count)
+        response = produce_response(current_query, page,
+                                    query_args['offset'], count)
+        metrics.record_query(current_query, api_endpoint,
+                             response.calculate_content_length())
+        return response
 
-        query_args['endpoint_url'] = ks_credentials.url
-        current_query = assemble_query(query_to_use, query_args, page)
+
+def execute_query(query_to_use, query_args, page, ks_credentials,
+                  count_concurrently=True):
+    """ Assemble and submit a query for a page; return (query, count).
+
+    Raises ViewerException, QueryException or
+    ResultPageLimitExceededException.
+    """
+    query_args['endpoint_url'] = ks_credentials.url
+    query_args['private_endpoint'] = ks_credentials.private
+    query_args['backend'] = ks_credentials.backend
+    if 'cursor' in query_args and page != 1:
+        raise ViewerException("cursor cannot be combined with a page "
+                              "number")
+    current_query = assemble_query(query_to_use, query_args, page)
+    # Reject pages beyond the end before going upstream, if we can.
+    cached_count = current_query.get_cached_count()
+    if cached_count and final_page_exceeded(cached_count, page):
+        raise ResultPageLimitExceededException(
+            "Exceeded final result page.")
+
+    if count_concurrently:
+        count = current_query.submit_query_and_count(ks_credentials.username,
+                                                     ks_credentials.password)
+    else:
         current_query.submit_query(ks_credentials.username,
                                    ks_credentials.password)
         count = current_query.get_total_result_count(ks_credentials.username,
                                                      ks_credentials.password)
 
-        if count > 0 and final_page_exceeded(count, page):
-            raise ResultPageLimitExceededException(
-                "Exceeded final result page.")
+    # The count is None if it ran out of time.
+    if count is not None and count > 0 and final_page_exceeded(count, page):
+        raise ResultPageLimitExceededException(
+            "Exceeded final result page.")
+    return current_query, count
+
+
+def profile_query(query_to_use, query_args, page, ks_credentials):
+    """ Run a query and make its response under the profiler; return a
+    JSON report of where the time went in place of the response.
+
+    The count is run in this thread after the page, so that the profile
+    covers all of the work.
+    """
+    profiler = RequestProfiler()
+    current_query, count = profiler.call(execute_query, query_to_use,
+                                         query_args, page, ks_credentials,
+                                         count_concurrently=False)
+    t0 = time.time()
+    response = profiler.call(produce_response, current_query, page,
+                             query_args['offset'], count)
+    # A streamed body, e.g. CSV, is written as it is read, so read it here
+    # for it to be profiled and measured.
+    body = profiler.call(response.get_data)
+    current_query.timings['render'] = time.time() - t0
+    report = profiler.report()
+    report['query'] = query_to_use
+    report['timings'] = current_query.timings
+    report['response_bytes'] = len(body)
+    profile_path = profiler.save()
+    if profile_path is not None:
+        report['profile_file'] = profile_path
+    response = make_response(json.dumps(report, sort_keys=True))
+    response.headers[str('Content-type')] = str(
+        'application/json; charset=utf-8')
+    return response
+
+
+@app.route('/batch', methods=['POST'],
+           defaults={'api_endpoint': DEFAULT_ENDPOINT})
+@app.route('/<api_endpoint>/batch', methods=['POST'])
+def run_batch(api_endpoint):
+    """ Run a JSON list of query specs concurrently; return their results.
 
+    Each spec is an object with a "query" name, an optional "id" and "page",
+    and any of the query string parameters, e.g. "uris", "filter" and
+    "datefilter". Results are keyed by id, or by position in the list.
+    """
+    if not validate_api_key(request.args.get('api_key', None), api_endpoint):
+        abort(401)
 
+    ks_credentials = get_endpoint_credentials(api_endpoint)
+    try:
+        if ks_credentials.url is None:
+            raise ViewerException("Endpoint not known.")
+        specs = parse_batch_specs(request.get_json(force=True, silent=True))
+    except ViewerException as e:
+        response = make_response(json.dumps({"error": e.message}), 400)
+        response.headers[str('Content-type')] = str(
+            'application/json; charset=utf-8')
+        return response
+
+    t0 = time.time()
+    tasks = [functools.partial(run_batch_spec, spec, ks_credentials,
+                               api_endpoint)
+             for _, spec in specs]
+    results = iter_ordered(tasks, BATCH_CONCURRENCY, get_bulk_executor())
+    output = {"results": dict((key, result) for (key, _), result
+                              in zip(specs, results)),
+              "seconds": round(time.time() - t0, 3)}
+    response = make_response(json.dumps(output, sort_keys=True))
+    response.headers[str('Content-type')] = str(
+        'application/json; charset=utf-8')
+    response.headers[str('Access-Control-Allow-Origin')] = str('*')
+    return response
+
+
+def parse_batch_specs(body):
+    """ Return a list of (key, spec) from a batch request body. """
+    if not isinstance(body, list) or not all(isinstance(spec, dict)
+                                             for spec in body):
+        raise ViewerException("Batch body must be a JSON list of objects")
+    if len(body) > BATCH_MAX_QUERIES:
+        raise ViewerException("A batch may have at most {0} queries"
+                              .format(BATCH_MAX_QUERIES))
+    specs = []
+    for position, spec in enumerate(body):
+        key = unicode(spec.get('id', position))
+        if key in [existing for existing, _ in specs]:
+            raise ViewerException("Batch id {0} is repeated".format(key))
+        specs.append((key, spec))
+    return specs
+
+
+def run_batch_spec(spec, ks_credentials, api_endpoint):
+    """ Run one query spec of a batch; return its result or error. """
+    t0 = time.time()
+    query_to_use = spec.get('query')
+    query_args = dict((unicode(key), value) for key, value in spec.iteritems()
+                      if key not in ('id', 'query', 'page'))
+    query_args['output'] = 'json'
+    if 'filter' in query_args:
+        query_args['filter'] = escape_filter(unicode(query_args['filter']))
+    result = {"query": query_to_use}
+    try:
+        try:
+            page = int(spec.get('page', 1))
+        except (TypeError, ValueError):
+            raise ViewerException("page must be a number")
+        if page < 1:
+            raise ViewerException("page must be 1 or more")
+        result['page number'] = page
+        # The specs already run concurrently, each on one executor thread.
+        current_query, count = execute_query(query_to_use, query_args, page,
+                                             ks_credentials,
+                                             count_concurrently=False)
     except (ViewerException, queries.QueryException,
             ResultPageLimitExceededException) as e:
+        result['error'] = e.message
+    except Exception as e:
+        logging.exception("Batch query %s failed", query_to_use)
+        result['error'] = 'Query raised an exception: {0}'.format(
+            type(e).__name__)
+    else:
+        metrics.record_query(current_query, api_endpoint)
+        result['payload'] = current_query.clean_json
+        result['count'] = count
+        if current_query.partial:
+            result['partial'] = True
+        result['query_time'] = current_query.query_time
+        result['count_time'] = current_query.count_time
+        if current_query.next_cursor is not None:
+            result['next cursor'] = current_query.next_cursor
+    result['seconds'] = round(time.time() - t0, 3)
+    return result
+
+
+@app.route('/<query_to_use>/export',
+           defaults={'api_endpoint': DEFAULT_ENDPOINT})
+@app.route('/<api_endpoint>/<query_to_use>/export')
+def export_query(query_to_use, api_endpoint):
+    """ Stream every result row of a query as NDJSON or CSV. """
+    if not validate_api_key(request.args.get('api_key', None), api_endpoint):
+        abort(401)
+
+    ks_credentials = get_endpoint_credentials(api_endpoint)
+    if ks_credentials.url is None:
+        return render_template('error.html',
+                               error_message='Endpoint not known.',
+                               root_url=get_root_url())
+    query_args = {'output': 'json'}
+    try:
+        query_args = parse_query_string(request.query_string)
+        export_format = query_args.pop('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            raise ViewerException("format must be one of: {0}".format(
+                ', '.join(sorted(EXPORT_FORMATS))))
+        try:
+            query_class = queries.get_query_class(query_to_use)
+        except KeyError:
+            raise ViewerException('Query **{0}** does not exist'
+                                  .format(query_to_use))
+        query_args['endpoint_url'] = ks_credentials.url
+        query_args['private_endpoint'] = ks_credentials.private
+        query_args['backend'] = ks_credentials.backend
+        exporter = QueryExporter(query_class, query_args,
+                                 ks_credentials.username,
+                                 ks_credentials.password)
+    except (ViewerException, queries.QueryException) as e:
+        query_args['output'] = 'json'
         return produce_error_response(e, query_args)
+
+    if export_format == 'csv':
+        chunks = iter_csv_export(exporter)
     else:
-        return produce_response(current_query, page, query_args['offset'],
-                                count)
+        chunks = iter_ndjson_export(exporter)
+    response = Response(chunks, content_type=EXPORT_FORMATS[export_format])
+    response.headers[str('Access-Control-Allow-Origin')] = str('*')
+    if export_format == 'csv':
+        response.headers[str('Content-disposition')] = str(
+            'attachment;filename={0}.csv'.format(query_to_use))
+    return response
+
+
+def iter_ndjson_export(exporter):
+    """ Yield an export as chunks of NDJSON, one row per line.
+
+    A failure part way through is reported as a final line with an "error"
+    key, as is an export cut short by the OFFSET limit.
+    """
+    lines = []
+    size = 0
+    try:
+        for row in exporter:
+            line = json.dumps(row, sort_keys=True) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                yield ''.join(lines)
+                lines = []
+                size = 0
+        if exporter.truncated:
+            lines.append(json.dumps(
+                {"error": "Export reached the OFFSET limit, add filter or "
+                          "datefilter to narrow results"}) + '\n')
+    except queries.QueryException as e:
+        lines.append(json.dumps({"error": e.message}) + '\n')
+    except Exception:
+        logging.exception("Export failed")
+        lines.append(json.dumps({"error": "Export failed"}) + '\n')
+    yield ''.join(lines)
+
+
+def iter_csv_export(exporter):
+    """ Yield an export as chunks of CSV with a header row.
+
+    CSV has no way to report a failure part way through, so one ends the
+    export early and is logged.
+    """
+    fieldnames = OrderedDict(zip(exporter.headers,
+                                 [None]*len(exporter.headers)))
+    output = StringIO.StringIO()
+    dw = csv.DictWriter(output, fieldnames=fieldnames,
+                        extrasaction='ignore')
+    dw.writeheader()
+    try:
+        for row in exporter:
+            dw.writerow(row)
+            if output.tell() >= EXPORT_CHUNK_BYTES:
+                yield output.getvalue()
+                output = StringIO.StringIO()
+                dw = csv.DictWriter(output, fieldnames=fieldnames,
+                                    extrasaction='ignore')
+    except queries.QueryException as e:
+        logging.error("Export failed: %s", e.message)
+    except Exception:
+        logging.exception("Export failed")
+    yield output.getvalue()
 
 
 class ResultPageLimitExceededException(Exception):
@@ -227,12 +611,12 @@ def parse_get_mention_metadata(query_string):
 
 def assemble_query(query_to_use, query_args, page):
     try:
-        query_name = getattr(queries, query_to_use)
-        query_args = add_offset_and_limit(query_args, page)
-        current_query = query_name(**query_args)
-    except AttributeError:
+        query_name = queries.get_query_class(query_to_use)
+    except KeyError:
         raise ViewerException('Query **{0}** does not exist'
                               .format(query_to_use))
+    query_args = add_offset_and_limit(query_args, page)
+    current_query = query_name(**query_args)
 
     return current_query
 
@@ -282,7 +666,7 @@ def produce_error_response(e, query_args):
 
 def produce_response(query, page_number, offset, count):
     """ Get desired result output from completed query; create a response. """
-
+    t0 = time.time()
     if query.output == 'json':
         response = produce_json_response(query, page_number, count)
     elif query.output == 'jsonp':
@@ -292,23 +676,95 @@ def produce_response(query, page_number, offset, count):
     elif query.output == 'html':
         response = produce_html_response(query, page_number, count, offset)
     else:
-        response = json.dumps(
-            {"error": "query result cannot be written as csv"})
+        response = make_response(json.dumps(
+            {"error": "query result cannot be written as csv"}))
+    if not response.is_streamed:
+        # A streamed body is only written once this has returned, so its
+        # render time is not known here.
+        query.timings['render'] = time.time() - t0
+    add_server_timing(response, query)
     response.headers[str('Access-Control-Allow-Origin')] = str('*')
     return response
 
 
+def add_server_timing(response, query):
+    """ Give the time taken by each stage of query in a Server-Timing
+    header of response, for browser developer tools.
+    """
+    timings = ['{0};desc="{1}";dur={2:.1f}'.format(
+        name, description, query.timings[name] * 1000)
+        for name, description in SERVER_TIMINGS if name in query.timings]
+    if timings:
+        response.headers[str('Server-Timing')] = str(', '.join(timings))
+
+
+def produce_explain_response(query, count):
+    """ Describe how a query was answered, in place of its results: the
+    SPARQL of its page and count queries, where each result came from, the
+    bytes received from the endpoint and the time taken by each stage.
+    """
+    t0 = time.time()
+    page_query = {"sparql": query.query, "cache": query.cache_status,
+                  "upstream bytes": query.response_bytes,
+                  "rows": len(query.clean_json or [])}
+    if query.block_query is not None:
+        # The page was served from a block of pages fetched with this.
+        page_query['block sparql'] = query.block_query
+    output = {"page query": page_query, "count": count,
+              "partial": query.partial}
+    if getattr(query, 'count_template', None):
+        output['count query'] = {"sparql": query._build_count_query(),
+                                 "cache": query.count_cache_status,
+                                 "upstream bytes": query.count_response_bytes}
+    if query.snapshot_age is not None:
+        output['snapshot age'] = query.snapshot_age
+    query.timings['render'] = time.time() - t0
+    output['timings'] = dict((name, round(seconds, 4))
+                             for name, seconds in query.timings.items())
+    response = make_response(json.dumps(output, sort_keys=True))
+    response.headers[str('Content-type')] = str(
+        'application/json; charset=utf-8')
+    add_server_timing(response, query)
+    response.headers[str('Access-Control-Allow-Origin')] = str('*')
+    return response
+
+
+def known_result_count(query, page_number, count):
+    """ Return count, or if the count ran out of time, the least it could
+    be given this page: one more than its rows if the page is full.
+    """
+    if count is not None:
+        return int(count)
+    known = (page_number - 1) * PER_PAGE + len(query.clean_json)
+    if len(query.clean_json) >= query.limit:
+        known += 1
+    return known
+
+
 def produce_json_response(query, page_number, count):
     root_url = get_root_url()
-    pagination = Pagination(page_number, PER_PAGE, int(count))
+    pagination = Pagination(page_number, PER_PAGE,
+                            known_result_count(query, page_number, count))
     output = {}
     output['payload'] = query.clean_json
     output['count'] = count
     output['page number'] = page_number
-
-    if pagination.has_next:
+    if query.partial:
+        # The endpoint stopped at the deadline with only some rows.
+        output['partial'] = True
+
+    if query.cursor is not None:
+        # Keyset paging; the count says nothing about where we are.
+        if query.next_cursor is not None:
+            output['next page'] = (root_url +
+                                   url_for_cursor(query.next_cursor))
+    elif pagination.has_next:
         output['next page'] = (root_url +
                                url_for_other_page(pagination.page + 1))
+    if query.next_cursor is not None:
+        output['next cursor'] = query.next_cursor
+    if query.snapshot_age is not None:
+        output['snapshot age'] = query.snapshot_age
 
     response = make_response(json.dumps(output, sort_keys=True))
     response.headers[str('Content-type')] = str(
@@ -316,25 +772,38 @@ def produce_json_response(query, page_number, count):
     return response
 
 
-def produce_csv_response(query, page_number, count):
+def iter_csv_rows(headers, rows):
+    """ Yield CSV of rows, in the order of headers, a row at a time after
+    a header row.
+    """
+    fieldnames = OrderedDict(zip(headers, [None]*len(headers)))
     output = StringIO.StringIO()
-    fieldnames = OrderedDict(zip(query.headers,
-                                 [None]*len(query.headers)))
-    dw = csv.DictWriter(output, fieldnames=fieldnames)
+    # The response has been sent by the time a row is written, so values
+    # without a header are left out rather than failing it.
+    dw = csv.DictWriter(output, fieldnames=fieldnames,
+                        extrasaction='ignore')
     dw.writeheader()
-    for row in query.clean_json:
+    yield output.getvalue()
+    for row in rows:
+        output.seek(0)
+        output.truncate()
         dw.writerow(row)
+        yield output.getvalue()
+
 
+def produce_csv_response(query, page_number, count):
     filename = 'results-page-{0}.csv'.format(page_number)
-    response = make_response(output.getvalue())
-    response.headers[str('Content-type')] = str('text/csv; charset=utf-8')
+    response = Response(stream_with_context(
+        iter_csv_rows(query.headers, query.clean_json)),
+        content_type=str('text/csv; charset=utf-8'))
     response.headers[str('Content-disposition')] = str(
         'attachment;filename='+filename)
     return response
 
 
 def produce_html_response(query, page_number, count, offset):
-    pagination = Pagination(page_number, PER_PAGE, int(count))
+    pagination = Pagination(page_number, PER_PAGE,
+                            known_result_count(query, page_number, count))
     result = query.parse_query_results()
     response = make_response(render_template(query.jinja_template,
                              title=query.query_title,
@@ -347,6 +816,8 @@ def produce_html_response(query, page_number, count, offset):
                              filter=query.filter,
                              query_time=query.query_time,
                              count_time=query.count_time,
+                             partial=query.partial,
+                             snapshot_age=query.snapshot_age,
                              datefilter=query.datefilter,
                              uris=query.uris,
                              root_url=get_root_url()))
@@ -365,6 +836,13 @@ def url_for_other_page(page):
     return url_for(request.endpoint, **args)
 
 
+def url_for_cursor(cursor):
+    args = dict(request.view_args.items() + request.args.to_dict().items())
+    args['page'] = 1
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **args)
+
+
 def get_root_url():
     if app.config['DEBUG']:
         root_url = "http://127.0.0.1:5000"
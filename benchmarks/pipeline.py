@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# encoding: utf-8
+""" Time each stage of the request pipeline, in isolation, for every query
+class.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline [rows] [repeats]
+
+Each query is built from its cars_example URL, and given a SPARQL JSON
+result of rows rows (default a page) made up to match its headers, as no
+endpoint is called. Prints a JSON document with one entry per query class
+and stage, giving the seconds per call.
+"""
+from __future__ import unicode_literals, print_function
+
+import json
+import os
+import sys
+import timeit
+
+# The app refuses to start without API keys.
+os.environ.setdefault('NEWSREADER_PUBLIC_API_KEY', 'benchmark')
+os.environ.setdefault('NEWSREADER_PRIVATE_API_KEY', 'benchmark')
+
+from app import app, views
+from app.queries.queries import CRUDQuery, convert_raw_json_to_clean
+from app.queries.registry import METADATA_QUERY_ARGS, registry
+
+REPEATS = 5
+# Calls of a stage per repeat; the fastest stages take microseconds.
+NUMBER = 100
+ENDPOINT = views.DEFAULT_ENDPOINT
+
+EVENT_STUB = ('http://www.newsreader-project.eu/data/cars/2004/04/30/'
+              '4C6H-TSY0-TX37-G2D4.xml#ev')
+INTEGER_HEADERS = ['count', 'event_size', 'numEvent', 'type_count',
+                   'value_count']
+TEXT_HEADERS = ['event_label', 'comment', 'value', 'object', 'content',
+                'datetime']
+ONTOLOGY_HEADERS = ['type', 'eso', 'frame', 'property', 'predicate',
+                    'object_type']
+
+
+def make_binding(header, i):
+    """ Return a SPARQL JSON binding like those of the column header. """
+    if header in INTEGER_HEADERS:
+        return {'type': 'typed-literal', 'value': unicode(1 + i * 7 % 500),
+                'datatype': 'http://www.w3.org/2001/XMLSchema#integer'}
+    if header == 'datetime':
+        return {'type': 'literal',
+                'value': '2004-04-{0:02d}'.format(1 + i % 28)}
+    if header in TEXT_HEADERS:
+        return {'type': 'literal', 'xml:lang': 'en',
+                'value': 'Ford sells its stake in Aston Martin, part '
+                         '{0} of "the deal"'.format(i)}
+    if header in ONTOLOGY_HEADERS:
+        return {'type': 'uri',
+                'value': 'http://dbpedia.org/ontology/Property{0}'.format(i)}
+    if header in ('event', 'subject', 'timeline', 'graph'):
+        return {'type': 'uri', 'value': EVENT_STUB + unicode(i)}
+    return {'type': 'uri',
+            'value': 'http://dbpedia.org/resource/Person_{0}'.format(i)}
+
+
+def make_fixture(query, number_of_rows):
+    """ Return a SPARQL JSON result for query, of number_of_rows rows. """
+    if not query.result_is_tabular:
+        # An RDF/JSON graph, as returned by DESCRIBE and the CRUD endpoint.
+        return {EVENT_STUB + unicode(i): {
+            'http://www.w3.org/2000/01/rdf-schema#label': [
+                make_binding('event_label', i)],
+            'http://semanticweb.cs.vu.nl/2009/11/sem/hasActor': [
+                make_binding('actor', i)]} for i in range(number_of_rows)}
+    return {"head": {"link": [], "vars": query.headers},
+            "results": {"distinct": False, "ordered": True,
+                        "bindings": [dict((header, make_binding(header, i))
+                                          for header in query.headers)
+                                     for i in range(number_of_rows)]}}
+
+
+def parse_example(query_class):
+    """ Return (path, page, query string) of the cars_example of
+    query_class.
+    """
+    example = query_class(**METADATA_QUERY_ARGS).cars_example
+    path, _, query_string = example.partition('?')
+    page = 1
+    if '/page/' in path:
+        path, _, page = path.partition('/page/')
+        page = int(page)
+    return path, page, query_string
+
+
+def example_path(path, page):
+    if page == 1:
+        return path
+    return '{0}/page/{1}'.format(path, page)
+
+
+def parse_arguments(name, query_string):
+    """ Return the query arguments of query_string, as run_query would. """
+    if name == 'get_mention_metadata':
+        return views.parse_get_mention_metadata(query_string)
+    return views.parse_query_string(query_string)
+
+
+def measure(function, repeats):
+    times = timeit.repeat(function, repeat=repeats, number=NUMBER)
+    times = sorted(t / NUMBER for t in times)
+    return {"min_seconds": times[0], "median_seconds": times[len(times) // 2]}
+
+
+def stages(name, number_of_rows):
+    """ Yield (stage, function) for each stage of the pipeline of the query
+    called name.
+    """
+    query_class = registry.get_class(name)
+    path, page, query_string = parse_example(query_class)
+    query_args = parse_arguments(name, query_string)
+    ks_credentials = views.get_endpoint_credentials(ENDPOINT)
+    query_args['endpoint_url'] = ks_credentials.url
+
+    def assemble():
+        return views.assemble_query(name, dict(query_args), page)
+
+    query = assemble()
+    fixture = make_fixture(query, number_of_rows)
+    query.clean_json = convert_raw_json_to_clean(fixture)
+    query.json_result = fixture
+    count = number_of_rows * 10
+    offset = views.PER_PAGE * (page - 1)
+
+    yield 'parse_query_string', lambda: parse_arguments(name, query_string)
+    yield 'assemble_query', assemble
+    yield 'build_query', query._build_query
+    if not isinstance(query, CRUDQuery) and query.count_template:
+        yield 'build_count_query', query._build_count_query
+    yield 'convert_raw_json_to_clean', lambda: convert_raw_json_to_clean(
+        fixture)
+    yield 'produce_json_response', lambda: views.produce_json_response(
+        query, page, count)
+    if query.result_is_tabular:
+        yield 'parse_query_results', query.parse_query_results
+        # The CSV is streamed, so is only written as it is read.
+        yield 'produce_csv_response', lambda: views.produce_csv_response(
+            query, page, count).get_data()
+        yield 'produce_html_response', lambda: views.produce_html_response(
+            query, page, count, offset)
+
+
+def main(number_of_rows=views.PER_PAGE, repeats=REPEATS):
+    results = []
+    for name in registry.names():
+        path, page, query_string = parse_example(registry.get_class(name))
+        # The responses are made as they would be for the example URL,
+        # which is on the default endpoint.
+        with app.test_request_context('/' + example_path(path, page) + '?' +
+                                      query_string):
+            for stage, function in stages(name, number_of_rows):
+                result = {"query": name, "name": stage}
+                result.update(measure(function, repeats))
+                results.append(result)
+    return {"benchmark": "pipeline", "rows": number_of_rows,
+            "repeats": repeats, "results": results}
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    print(json.dumps(main(*[int(a) for a in arguments]), indent=2,
+                     sort_keys=True))
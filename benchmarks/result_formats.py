@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+""" Compare transfer size and parse time of the SPARQL result formats.
+
+Run from the repository root:
+
+    python -m benchmarks.result_formats [rows]
+
+Prints a JSON document with one entry per format.
+"""
+from __future__ import unicode_literals, print_function
+
+import json
+import sys
+import timeit
+
+from app.queries.queries import convert_raw_json_to_clean
+from app.queries.streaming import RESULT_CHUNK_SIZE, iter_clean_rows
+
+REPEATS = 5
+
+
+def make_rows(number_of_rows):
+    """ Rows shaped like those of summary_of_events_with_actor. """
+    rows = []
+    for i in range(number_of_rows):
+        rows.append({
+            'event': 'http://www.newsreader-project.eu/data/cars/2004/04/30/'
+                     '4C6H-TSY0-TX37-G2D4.xml#ev{0}'.format(i),
+            'event_size': str(10 + i % 90),
+            'datetime': '2004-04-{0:02d}'.format(1 + i % 28),
+            'event_label': 'announce "plan"' if i % 2 else 'sell, buy',
+        })
+    return rows
+
+
+def to_json(rows):
+    types = {'event': 'uri', 'event_size': 'typed-literal',
+             'datetime': 'literal', 'event_label': 'literal'}
+    bindings = [dict((key, {'type': types[key], 'value': value})
+                     for key, value in row.items()) for row in rows]
+    return json.dumps({"head": {"link": [], "vars": sorted(types)},
+                       "results": {"distinct": False, "ordered": True,
+                                   "bindings": bindings}}).encode('utf-8')
+
+
+def to_tsv(rows):
+    names = ['event', 'event_size', 'datetime', 'event_label']
+    lines = ['\t'.join('?' + name for name in names)]
+    for row in rows:
+        lines.append('\t'.join([
+            '<' + row['event'] + '>',
+            row['event_size'],
+            '"' + row['datetime'] + '"',
+            '"' + row['event_label'].replace('"', '\\"') + '"']))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def to_csv(rows):
+    names = ['event', 'event_size', 'datetime', 'event_label']
+
+    def quote(value):
+        if any(c in value for c in ',"\n'):
+            return '"' + value.replace('"', '""') + '"'
+        return value
+
+    lines = [','.join(names)]
+    for row in rows:
+        lines.append(','.join(quote(row[name]) for name in names))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def chunked(body):
+    return [body[i:i + RESULT_CHUNK_SIZE]
+            for i in range(0, len(body), RESULT_CHUNK_SIZE)]
+
+
+def measure(function):
+    times = timeit.repeat(function, repeat=REPEATS, number=1)
+    times.sort()
+    return {"min_seconds": times[0], "median_seconds": times[len(times) // 2]}
+
+
+def main(number_of_rows=20000):
+    rows = make_rows(number_of_rows)
+    bodies = {'json': to_json(rows), 'tsv': to_tsv(rows), 'csv': to_csv(rows)}
+
+    results = []
+    body = bodies['json']
+    result = {"name": "json-whole-document", "bytes": len(body)}
+    result.update(measure(
+        lambda: convert_raw_json_to_clean(json.loads(body))))
+    results.append(result)
+
+    for result_format in ['json', 'tsv', 'csv']:
+        chunks = chunked(bodies[result_format])
+        result = {"name": result_format + "-streaming",
+                  "bytes": len(bodies[result_format])}
+        result.update(measure(
+            lambda: list(iter_clean_rows(chunks, result_format))))
+        results.append(result)
+
+    return {"benchmark": "result_formats", "rows": number_of_rows,
+            "results": results}
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    print(json.dumps(main(*[int(a) for a in arguments]), indent=2,
+                     sort_keys=True))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+""" Time the cold import of the app and the loading of query classes.
+
+Run from the repository root:
+
+    python -m benchmarks.startup [repeats]
+
+Each import is timed in a fresh interpreter, so nothing is already in
+sys.modules. Prints a JSON document with one entry per stage.
+"""
+from __future__ import unicode_literals, print_function
+
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+REPEATS = 5
+
+# Each snippet prints the seconds taken by the stage it times.
+STAGES = [
+    ("import-queries", """
+import time
+start = time.time()
+import app.queries
+print(time.time() - start)
+"""),
+    ("import-app", """
+import time
+start = time.time()
+import app
+print(time.time() - start)
+"""),
+    ("load-all-query-classes", """
+import time
+import app
+from app.queries import registry
+start = time.time()
+for name in registry.names():
+    registry.get_class(name)
+print(time.time() - start)
+"""),
+]
+
+
+def time_in_fresh_interpreter(snippet):
+    environment = dict(os.environ)
+    # The app refuses to start without API keys.
+    environment.setdefault('NEWSREADER_PUBLIC_API_KEY', 'benchmark')
+    environment.setdefault('NEWSREADER_PRIVATE_API_KEY', 'benchmark')
+    output = subprocess.check_output([sys.executable, '-c', snippet],
+                                     env=environment)
+    return float(output.strip().splitlines()[-1])
+
+
+def summarise(times):
+    times = sorted(times)
+    return {"min_seconds": times[0], "median_seconds": times[len(times) // 2]}
+
+
+def main(repeats=REPEATS):
+    results = []
+    for name, snippet in STAGES:
+        result = {"name": name}
+        result.update(summarise([time_in_fresh_interpreter(snippet)
+                                 for _ in range(repeats)]))
+        results.append(result)
+
+    from app.queries import get_query_class
+    get_query_class('describe_uri')
+    number = 10000
+    times = timeit.repeat(lambda: get_query_class('describe_uri'),
+                          repeat=repeats, number=number)
+    result = {"name": "lookup-loaded-query-class"}
+    result.update(summarise([t / number for t in times]))
+    results.append(result)
+
+    return {"benchmark": "startup", "repeats": repeats, "results": results}
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    print(json.dumps(main(*[int(a) for a in arguments]), indent=2,
+                     sort_keys=True))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Copies the events, actors, labels, times and types of the endpoints named
+# on the command line into local snapshots, e.g.
+#
+#     python ingest_snapshot.py cars wikinews
+#
+# See "Offline snapshots" in README.md.
+import logging
+import sys
+
+from app.queries.ingest import ingest_endpoint
+from app.views import get_endpoint_credentials
+
+if __name__ == '__main__':
+    api_endpoints = sys.argv[1:]
+    if not api_endpoints:
+        sys.exit("Usage: ingest_snapshot.py ENDPOINT...")
+    logging.getLogger().setLevel(logging.INFO)
+    for api_endpoint in api_endpoints:
+        ks_credentials = get_endpoint_credentials(api_endpoint)
+        if ks_credentials.private:
+            sys.exit("Results from the private endpoint {0} are not written "
+                     "to disk".format(api_endpoint))
+        rows = ingest_endpoint(ks_credentials.url, ks_credentials.username,
+                               ks_credentials.password)
+        print "Ingested {0} rows from {1}".format(rows, api_endpoint)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Fetches the materialized tables for the endpoints named on the command
+# line, e.g.
+#
+#     python materialize.py cars wikinews
+#
+# See "Materialized tables" in README.md.
+import logging
+import sys
+
+from app.queries.materialized import refresh_endpoint
+from app.views import get_endpoint_credentials
+
+if __name__ == '__main__':
+    api_endpoints = sys.argv[1:]
+    if not api_endpoints:
+        sys.exit("Usage: materialize.py ENDPOINT...")
+    logging.getLogger().setLevel(logging.INFO)
+    for api_endpoint in api_endpoints:
+        ks_credentials = get_endpoint_credentials(api_endpoint)
+        if ks_credentials.private:
+            sys.exit("Results from the private endpoint {0} are not written "
+                     "to disk".format(api_endpoint))
+        refresh_endpoint(ks_credentials.url, ks_credentials.username,
+                         ks_credentials.password)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+# This starts a single-process gevent server listening on PORT.
+#
+# Sockets are made cooperative before the app is imported, so a request
+# waiting on the KnowledgeStore yields to the others rather than holding a
+# worker, and one process can have hundreds of upstream calls in flight.
+# The same effect is available under gunicorn with `-k gevent`.
+
+# See https://pypi.python.org/pypi/gevent
+try:
+    from gevent import monkey
+except ImportError:
+    raise SystemExit("gevent is not installed; install it with "
+                     "`pip install -r requirements-gevent.txt`")
+monkey.patch_all()
+
+import os
+
+# A session is held for the duration of each upstream call, so allow as many
+# as we expect calls in flight.
+os.environ.setdefault('NEWSREADER_SESSION_POOL_SIZE', '200')
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import app
+
+PORT = int(os.environ.get('PORT', 8000))
+MAX_CONNECTIONS = int(os.environ.get('NEWSREADER_MAX_CONNECTIONS', 1000))
+
+if __name__ == '__main__':
+    print("Running on port {}".format(PORT))
+    WSGIServer(('0.0.0.0', PORT), app,
+               spawn=Pool(MAX_CONNECTIONS)).serve_forever()